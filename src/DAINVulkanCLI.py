@@ -5,6 +5,7 @@ AI-Powered video interpolater (eg. 30fps -> 60fps) for Vulkan devices. Based on
 """
 # Built-in modules
 import argparse
+import contextlib
 import json
 import logging
 import math
@@ -15,16 +16,49 @@ import shutil
 
 # Local modules
 import definitions
-import dain_ncnn_vulkan
 # import cain_ncnn_vulkan
+import chunked_pipeline
 import ffmpeg
 import ffprobe
 # import video_extract
 import interpolator
 import image_similarity
+import job_queue
+import overlap_encoder
+import profiler
+import progress
+import stream_pipeline
 
 
 def main(input_file, output_folder, **kwargs):
+    """
+    Runs the steps on input_file
+    progress_json: path of a JSON-lines file ("-" for stdout) that stage progress events are written to
+    progress_callback: function called with every progress event (eg. the GUI)
+    profile: record the time, CPU, frames and I/O of every stage to info.json and print a summary
+    overlap_encode: encode the interpolated frames while step 2 writes them (overlap_delete_frames: delete them after)
+    """
+    progressListeners = []
+    if ("progress_json" in kwargs) and (kwargs["progress_json"] is not None):
+        progressListeners.append(progress.JsonLinesSink(kwargs["progress_json"]))
+    if ("progress_callback" in kwargs) and (kwargs["progress_callback"] is not None):
+        progressListeners.append(kwargs["progress_callback"])
+    # Events are tagged with the input file, the listeners of this job don't get the events of other jobs
+    for listener in progressListeners:
+        progress.add_listener(listener, job_id=input_file)
+    try:
+        # jobCleanup undoes what a failed run leaves behind (eg. the overlapped encoder)
+        with progress.job_scope(input_file), profiler.Profiler(enabled=kwargs.get("profile") is True) as jobProfiler, \
+                contextlib.ExitStack() as jobCleanup:
+            _main(input_file, output_folder, jobProfiler, jobCleanup, **kwargs)
+    finally:
+        for listener in progressListeners:
+            progress.remove_listener(listener)
+            if isinstance(listener, progress.JsonLinesSink):
+                listener.close()
+
+
+def _main(input_file, output_folder, job_profiler, job_cleanup, **kwargs):
     # System Info
     print("Platform:", system())
 
@@ -38,6 +72,41 @@ def main(input_file, output_folder, **kwargs):
     loop_frames = definitions.DEFAULT_LOOP
     if ("loop_video" in kwargs) and (kwargs["loop_video"] is not None):
         loop_frames = kwargs["loop_video"]
+    pipeline = definitions.DEFAULT_PIPELINE
+    if ("pipeline" in kwargs) and (kwargs["pipeline"] is not None):
+        pipeline = kwargs["pipeline"]
+    print("Pipeline:", pipeline)
+    intermediate_format = definitions.DEFAULT_INTERMEDIATE_FORMAT
+    if ("intermediate_format" in kwargs) and (kwargs["intermediate_format"] is not None):
+        intermediate_format = kwargs["intermediate_format"]
+    if intermediate_format not in ffmpeg.engine_intermediate_formats():
+        print("ERROR: The interpolation engines can't read {} frames on {} (available: {})".format(
+            intermediate_format, system(), ", ".join(ffmpeg.engine_intermediate_formats())))
+        exit(1)
+    png_compression = None
+    if ("png_compression" in kwargs) and (kwargs["png_compression"] is not None):
+        png_compression = kwargs["png_compression"]
+    vfr_extract = False
+    if ("vfr_extract" in kwargs) and (kwargs["vfr_extract"] is True):
+        if (pipeline == "folder") and (kwargs.get("interpolation_mode") == "dynamic"):
+            vfr_extract = True
+        else:
+            print("WARNING: --vfr-extract only works with the folder pipeline in dynamic mode, ignoring")
+    # Preview: a part of the video and/or smaller frames for trying out settings, kept in its own working folder
+    preview = None
+    if any(kwargs.get(option) is not None for option in ("start", "duration", "preview_scale")):
+        if pipeline == "folder":
+            preview = {"start": kwargs.get("start"), "duration": kwargs.get("duration"),
+                       "scale": kwargs.get("preview_scale")}
+            print("Preview:", preview)
+            if (vfr_extract is True) and ((preview["start"] is not None) or (preview["duration"] is not None)):
+                print("WARNING: --vfr-extract doesn't support --start/--duration, ignoring")
+                vfr_extract = False
+        else:
+            print("WARNING: --start, --duration and --preview-scale only work with the folder pipeline, ignoring")
+    if (pipeline == "stream") and (interpolator_engine not in stream_pipeline.STREAM_ENGINES):
+        print("ERROR: Stream pipeline only supports the engines:", ", ".join(stream_pipeline.STREAM_ENGINES))
+        exit(1)
 
     # Optional arguments for interpolators
     interpolatorOptions = {}
@@ -48,6 +117,10 @@ def main(input_file, output_folder, **kwargs):
     if ("threads" in kwargs) and (kwargs["threads"] is not None):
         interpolatorOptions["threads"] = kwargs["threads"]
     print("Interpolator Options:", interpolatorOptions)
+    shardWorkers = None
+    if ("shard_gpu_ids" in kwargs) and (kwargs["shard_gpu_ids"] is not None):
+        shardWorkers = kwargs["shard_gpu_ids"].split(",")
+        print("Sharding step 2 across GPUs:", shardWorkers)
 
     # Parse step selection
     stepsSelection = None
@@ -61,12 +134,43 @@ def main(input_file, output_folder, **kwargs):
     outputFolder = os.path.abspath(output_folder)
     print("Input file:", inputFile)
 
+    # Setup working folder and predefined output folders
+    folderBase = os.path.join(outputFolder, inputFileName)
+    if preview is not None:  # Doesn't replace the frames of a full run
+        folderBase = os.path.join(outputFolder, inputFileName + "-preview")
+    pathlib.Path(folderBase).mkdir(parents=True, exist_ok=True)  # Create base folder at start
+    print("Working Directory:", folderBase)
+    job_profiler.folder = folderBase
+    folderOriginalFrames = os.path.join(folderBase, "original_frames")
+    folderInterpolatedFrames = os.path.join(folderBase, "interpolated_frames")
+    folderOutputVideos = os.path.join(folderBase, "output_videos")
+    infoJsonFilePath = os.path.join(folderBase, "info.json")
+    timestampIndexFile = os.path.join(folderBase, ffmpeg.TIMESTAMP_INDEX_FILENAME)
+
+    # Read info from json
+    infoJsonFile = {}
+    if os.path.isfile(infoJsonFilePath):
+        try:
+            infoJsonFile = json.load(open(infoJsonFilePath, 'r'))
+            print("info.json read:", infoJsonFile)
+        except ValueError:
+            print("info.json not read")
+    else:
+        print("Creating info.json")
+        pathlib.Path(infoJsonFilePath).touch()
+
     # Input FPS, prioritize specified over detected
+    inputFingerprint = ffprobe.fingerprint_file(inputFile)
+    inputFileProperties = None
     if ("input_fps" in kwargs) and (kwargs["input_fps"] is not None):
         inputFileFps = kwargs["input_fps"]
     else:
         print("FFprobe: Scanning video metadata for framerate...")
-        inputFileProperties = ffprobe.analyze_video_stream_metadata(inputFile)
+        with job_profiler.stage("ffprobe"):
+            # Cached in info.json while the input file is unchanged
+            inputFileProperties = ffprobe.analyze_video_stream_metadata(inputFile,
+                                                                        cache=infoJsonFile.setdefault("ffprobe", {}),
+                                                                        fingerprint=inputFingerprint)
         print(inputFileProperties)
         fracNum, fracDenom = inputFileProperties["fpsReal"].split("/")
         inputFileFps = int(fracNum) / int(fracDenom)
@@ -92,59 +196,173 @@ def main(input_file, output_folder, **kwargs):
                 frame_multiplier = 2 ** (int(float(frame_multiplier_precise).hex().split('p+')[1]) + 1)
     print("Multiplier:", frame_multiplier)
 
-    # Setup working folder and predefined output folders
-    folderBase = os.path.join(outputFolder, inputFileName)
-    pathlib.Path(folderBase).mkdir(parents=True, exist_ok=True)  # Create base folder at start
-    print("Working Directory:", folderBase)
-    folderOriginalFrames = os.path.join(folderBase, "original_frames")
-    folderInterpolatedFrames = os.path.join(folderBase, "interpolated_frames")
-    folderOutputVideos = os.path.join(folderBase, "output_videos")
-    infoJsonFilePath = os.path.join(folderBase, "info.json")
-
-    # Read info from json
-    infoJsonFile = {}
-    if os.path.isfile(infoJsonFilePath):
-        try:
-            infoJsonFile = json.load(open(infoJsonFilePath, 'r'))
-            print("info.json read:", infoJsonFile)
-        except ValueError:
-            print("info.json not read")
-    else:
-        print("Creating info.json")
-        pathlib.Path(infoJsonFilePath).touch()
+    # Exact resampling when the target framerate isn't a whole multiple, only the needed frames are interpolated
+    resampleFps = None
+    if (kwargs.get("frame_multiplier") is None) and (kwargs.get("target_fps") is not None) and \
+            (pipeline == "folder") and (kwargs.get("interpolation_mode") != "dynamic") and \
+            (float(kwargs["target_fps"]) != inputFileFps * frame_multiplier):
+        resampleFps = float(kwargs["target_fps"])
+        print("Resampling to exactly {}fps instead of {}x".format(resampleFps, frame_multiplier))
+    resampleTolerance = interpolator.RESAMPLE_TOLERANCE
+    if ("resample_tolerance" in kwargs) and (kwargs["resample_tolerance"] is not None):
+        resampleTolerance = kwargs["resample_tolerance"]
+    outputFps = resampleFps if (resampleFps is not None) else inputFileFps * frame_multiplier
 
     # Step 1: Original Video -> Original Frames
-    if (stepsSelection is None) or ("1" in stepsSelection):
-        print("\nStep 1: Extracting frames to original_frames")
-        ffmpeg.extract_frames(inputFile, folderOriginalFrames)
-        folderOriginalFramesExtractedCount = len(os.listdir(folderOriginalFrames))
+    # Step 1 is skipped when original_frames was made from the same input with the same settings
+    step1Settings = {
+        "fingerprint": inputFingerprint,
+        "format": intermediate_format,
+        "png_compression": png_compression,
+        "vfr_extract": vfr_extract,
+        "duplicate_auto_delete": kwargs.get("duplicate_auto_delete"),
+        "duplicate_backend": kwargs.get("duplicate_backend"),
+        "scene_cut_threshold": kwargs.get("scene_cut_threshold"),
+        "preview": preview
+    }
+    step1Done = ("step1" in infoJsonFile) and (infoJsonFile["step1"].get("settings") == step1Settings) and \
+        os.path.isdir(folderOriginalFrames) and \
+        (len(os.listdir(folderOriginalFrames)) == infoJsonFile["step1"].get("original_frames"))
+    if (pipeline == "folder") and ((stepsSelection is None) or ("1" in stepsSelection)) and (step1Done is True):
+        print("\nStep 1: original_frames already extracted from this input, skipping (delete it to re-extract)")
+    elif (pipeline == "folder") and ((stepsSelection is None) or ("1" in stepsSelection)):
+        print("\nStep 1: Extracting frames to original_frames as", intermediate_format)
+        infoJsonFile.pop("step1", None)  # An interrupted extraction must not look finished to the next run
+        json.dump(infoJsonFile, open(infoJsonFilePath, "w"))
+        if os.path.isdir(folderOriginalFrames):  # Frames of an earlier run (maybe another format) would be mixed in
+            shutil.rmtree(folderOriginalFrames)
+        # Previews are cut and scaled by ffmpeg while decoding
+        previewStartFrame = None
+        previewFrameCount = None
+        previewScale = None
+        if preview is not None:
+            if preview["start"] is not None:
+                previewStartFrame = round(preview["start"] * inputFileFps)
+            if preview["duration"] is not None:
+                previewFrameCount = max(round(preview["duration"] * inputFileFps), 1)
+            previewScale = preview["scale"]
+        with job_profiler.stage("extract") as stageRecord:
+            if vfr_extract is True:  # Real frames only, their timestamps give the gaps for dynamic interpolation
+                stageRecord["frames"] = ffmpeg.extract_frames_vfr(inputFile, folderOriginalFrames,
+                                                                  timestampIndexFile, image_format=intermediate_format,
+                                                                  png_compression=png_compression,
+                                                                  stream_metadata=inputFileProperties,
+                                                                  scale=previewScale)
+                # Length of the video in frames at the output framerate, which the real frames are spread over
+                frameTimestamps, endTime = ffmpeg.read_timestamp_index(timestampIndexFile)
+                folderOriginalFramesExtractedCount = max(
+                    round((endTime - frameTimestamps[0]) * inputFileFps),
+                    round((frameTimestamps[-1] - frameTimestamps[0]) * inputFileFps) + 1)
+                print("Real frames extracted:", stageRecord["frames"])
+            else:
+                ffmpeg.extract_frames(inputFile, folderOriginalFrames, start_frame=previewStartFrame,
+                                      frame_count=previewFrameCount, image_format=intermediate_format,
+                                      png_compression=png_compression, stream_metadata=inputFileProperties,
+                                      scale=previewScale)
+                folderOriginalFramesExtractedCount = len(os.listdir(folderOriginalFrames))
+                stageRecord["frames"] = folderOriginalFramesExtractedCount
         infoJsonFile["extracted_frames"] = folderOriginalFramesExtractedCount
         print("Extracted frame count:", folderOriginalFramesExtractedCount)
 
         if ("duplicate_auto_delete" in kwargs) and (kwargs["duplicate_auto_delete"] is not None):
             print("Auto-deleting original_frames over {} similarity...".format(kwargs["duplicate_auto_delete"]))
-            image_similarity.delete_similar_images(folderOriginalFrames, kwargs["duplicate_auto_delete"])
+            duplicateBackend = kwargs.get("duplicate_backend") or image_similarity.DEFAULT_BACKEND
+            duplicateOptions = {"backend": duplicateBackend}
+            if duplicateBackend == "numpy":
+                duplicateOptions["cache_path"] = os.path.join(folderBase, image_similarity.FINGERPRINT_CACHE_FILENAME)
+            with job_profiler.stage("dedupe", frames=folderOriginalFramesExtractedCount):
+                image_similarity.delete_similar_images(folderOriginalFrames, kwargs["duplicate_auto_delete"],
+                                                       **duplicateOptions)
+
+        if ("scene_cut_threshold" in kwargs) and (kwargs["scene_cut_threshold"] is not None):
+            print("Detecting scene cuts under {} similarity...".format(kwargs["scene_cut_threshold"]))
+            with job_profiler.stage("scene detection", frames=len(os.listdir(folderOriginalFrames))):
+                infoJsonFile["scene_cuts"] = image_similarity.detect_scene_cuts(
+                    folderOriginalFrames, kwargs["scene_cut_threshold"], backend="numpy",
+                    cache_path=os.path.join(folderBase, image_similarity.FINGERPRINT_CACHE_FILENAME))
+            print("Scene cuts found:", len(infoJsonFile["scene_cuts"]))
 
         # print("Removing alpha layer from original_frames...")
         # video_extract.png_directory_remove_alpha_channel(folderOriginalFrames)
 
-    print("original_frames count:", len(os.listdir(folderOriginalFrames)))
+        infoJsonFile["step1"] = {"settings": step1Settings, "original_frames": len(os.listdir(folderOriginalFrames))}
+        json.dump(infoJsonFile, open(infoJsonFilePath, "w"))
+
+    if pipeline == "folder":
+        print("original_frames count:", len(os.listdir(folderOriginalFrames)))
 
     # Step 2: Original Frames -> Interpolated Frames
-    if (stepsSelection is None) or ("2" in stepsSelection):
+    overlapEncoder = None
+    if (pipeline == "folder") and ((stepsSelection is None) or ("2" in stepsSelection)):
         print("\nStep 2: Processing frames to interpolated_frames using", interpolator_engine)
         print("Interpolating to: {}x".format(frame_multiplier))
+        step2Record = job_profiler.start("interpolate")  # Engine passes are recorded as its sub-stages
 
         infoJsonFile["outputSuffixes"] = []  # Overwrite suffixes since step 2 is ran
         currentInterpolatorFolder = folderOriginalFrames
 
+        # Pairs across a scene cut are filled with duplicates instead of being interpolated
+        sceneCuts = None
+        if ("scene_cut_threshold" in kwargs) and (kwargs["scene_cut_threshold"] is not None):
+            if "scene_cuts" in infoJsonFile:
+                sceneCuts = infoJsonFile["scene_cuts"]
+            else:
+                print("WARNING: No scene cuts in info.json, run step 1 with --scene-cut-threshold first")
+
+        # Resume if the last run of step 2 was interrupted with the same settings
+        step2Settings = {
+            "engine": interpolator_engine,
+            "mode": kwargs.get("interpolation_mode"),
+            "multiplier": frame_multiplier,
+            "resample_fps": resampleFps,
+            "original_frames": len(os.listdir(folderOriginalFrames)),
+            "scene_cuts": sceneCuts,
+            "vfr_extract": vfr_extract,
+            "preview": preview
+        }
+        step2Resume = ("step2" in infoJsonFile) and (infoJsonFile["step2"].get("status") == "running") and \
+                      (infoJsonFile["step2"].get("settings") == step2Settings)
+        if (step2Resume is True) and (resampleFps is not None):
+            print("WARNING: Resampling to --target-fps can't resume, interpolating from the start")
+            step2Resume = False
+        if step2Resume is True:
+            print("Resuming interrupted step 2 from existing frames")
+        infoJsonFile["step2"] = {"settings": step2Settings, "status": "running", "stages": {}}
+        json.dump(infoJsonFile, open(infoJsonFilePath, "w"))
+
+        def step2_checkpoint(stage, progress):
+            infoJsonFile["step2"]["stages"][stage] = progress
+            json.dump(infoJsonFile, open(infoJsonFilePath, "w"))
+
+        # Step 3's encoder reads interpolated_frames while it's written
+        if ("overlap_encode" in kwargs) and (kwargs["overlap_encode"] is True):
+            if (stepsSelection is not None) and ("3" not in stepsSelection):
+                print("WARNING: --overlap-encode needs steps 2 and 3 in the same run, ignoring")
+            elif (loop_frames is True) and (kwargs.get("interpolation_mode") != "dynamic"):
+                # The last frames are duplicates until the loop pair replaces them, they could be encoded before
+                print("WARNING: --overlap-encode doesn't work with --loop-video in static mode, ignoring")
+            else:
+                if (step2Resume is False) and os.path.isdir(folderInterpolatedFrames):
+                    shutil.rmtree(folderInterpolatedFrames)  # Frames of an older run would be encoded
+                overlapOutputFile = os.path.join(folderOutputVideos, inputFileName + "-overlap." + video_type)
+                overlapEncoder = overlap_encoder.OverlapEncoder(
+                    folderInterpolatedFrames, overlapOutputFile, str(outputFps),
+                    delete_frames=kwargs.get("overlap_delete_frames") is True,
+                    preset=kwargs.get("encode_preset"), threads=kwargs.get("encode_threads"))
+                job_cleanup.callback(overlapEncoder.stop)
+                overlapEncoder.start()
+
         # Dynamic interpolation
         if ("interpolation_mode" in kwargs) and (kwargs["interpolation_mode"] == "dynamic"):
             if interpolator_engine.startswith("dain-ncnn"):  # Timestep-based dynamic
                 folderDynamic = os.path.join(folderBase, "dynamic-1x")
+                frameTimestamps = None
+                if vfr_extract is True:
+                    frameTimestamps = ffmpeg.read_timestamp_index(timestampIndexFile)[0]
                 interpolator.interpolate_dynamic(currentInterpolatorFolder, folderDynamic,
                                                  infoJsonFile["extracted_frames"], loop=loop_frames,
-                                                 **interpolatorOptions)
+                                                 resume=step2Resume, scene_cuts=sceneCuts, timestamps=frameTimestamps,
+                                                 framerate=inputFileFps, **interpolatorOptions)
 
                 currentInterpolatorFolder = folderDynamic
                 infoJsonFile["outputSuffixes"].append("-Dynamic1x".format(frame_multiplier))
@@ -153,26 +371,32 @@ def main(input_file, output_folder, **kwargs):
                 print("ERROR: Dynamic interpolation not currently supported by", interpolator_engine)
 
         # Static interpolation
-        if frame_multiplier >= 2:
-            folderInterpolatedFramesCount = len(os.listdir(folderOriginalFrames)) * frame_multiplier
+        if resampleFps is not None:
+            if loop_frames is True:
+                print("WARNING: --loop-video isn't supported when resampling to --target-fps, ignoring")
+            if sceneCuts:
+                print("WARNING: Scene cuts aren't supported when resampling to --target-fps, ignoring")
+            if shardWorkers and (len(shardWorkers) > 1):
+                print("WARNING: --shard-gpu-ids isn't supported when resampling to --target-fps, ignoring")
+            interpolatedFrameCount = interpolator.interpolate_resample(currentInterpolatorFolder,
+                                                                       folderInterpolatedFrames, inputFileFps,
+                                                                       resampleFps, interpolator_engine,
+                                                                       tolerance=resampleTolerance,
+                                                                       **interpolatorOptions)
+            currentInterpolatorFolder = folderInterpolatedFrames
+            infoJsonFile["outputSuffixes"].append("-{}{:g}fps".format(interpolator_engine.split("-")[0].capitalize(),
+                                                                      resampleFps))
+        elif frame_multiplier >= 2:
+            folderInterpolatedFramesCount = len(os.listdir(currentInterpolatorFolder)) * frame_multiplier
             print("interpolated_frames count", folderInterpolatedFramesCount)
-            if interpolator_engine.startswith("dain-ncnn"):
-                dain_ncnn_vulkan.interpolate_folder_mode(currentInterpolatorFolder, folderInterpolatedFrames,
-                                                         frame_multiplier, **interpolatorOptions)
-                currentInterpolatorFolder = folderInterpolatedFrames
-                infoJsonFile["outputSuffixes"].append("-Dain{}x".format(frame_multiplier))
-            elif interpolator_engine.startswith("cain-ncnn"):
-                interpolator.folder_multiplier_handler(currentInterpolatorFolder, folderInterpolatedFrames,
-                                                       frame_multiplier, engine="cain-ncnn",
-                                                       **interpolatorOptions)
+            if interpolator_engine.startswith(("dain-ncnn", "cain-ncnn", "rife-ncnn")):
+                interpolatedFrameCount = interpolator.interpolate_static(
+                    currentInterpolatorFolder, folderInterpolatedFrames, frame_multiplier, interpolator_engine,
+                    loop=loop_frames, resume=step2Resume, checkpoint=step2_checkpoint, scene_cuts=sceneCuts,
+                    workers=shardWorkers, **interpolatorOptions)
                 currentInterpolatorFolder = folderInterpolatedFrames
-                infoJsonFile["outputSuffixes"].append("-Cain{}x".format(frame_multiplier))
-            elif interpolator_engine.startswith("rife-ncnn"):
-                interpolator.folder_multiplier_handler(currentInterpolatorFolder, folderInterpolatedFrames,
-                                                       frame_multiplier, engine="rife-ncnn",
-                                                       **interpolatorOptions)
-                currentInterpolatorFolder = folderInterpolatedFrames
-                infoJsonFile["outputSuffixes"].append("-Rife{}x".format(frame_multiplier))
+                infoJsonFile["outputSuffixes"].append("-{}{}x".format(interpolator_engine.split("-")[0].capitalize(),
+                                                                      frame_multiplier))
             # elif interpolator_engine.startswith("rife"):
             #     import rife_pytorch
             #     rife_pytorch.interpolate_folder_mode(currentInterpolatorFolder, folderInterpolatedFrames,
@@ -185,19 +409,67 @@ def main(input_file, output_folder, **kwargs):
 
         # Rename last folder to interpolated_frames if not already
         if currentInterpolatorFolder is not folderInterpolatedFrames:
+            # Counted before the overlapped encoder can see (and delete) the frames
+            interpolatedFrameCount = len(os.listdir(currentInterpolatorFolder))
             if os.path.isdir(folderInterpolatedFrames) is True:
                 print("\"{}\" already exists, deleting".format(folderInterpolatedFrames))
                 shutil.rmtree(folderInterpolatedFrames)
             os.rename(currentInterpolatorFolder, folderInterpolatedFrames)
+        if preview is not None:
+            infoJsonFile["outputSuffixes"].append("-preview")
+        infoJsonFile["step2"]["status"] = "done"
+        # Frame count the interpolation targeted, interpolated_frames may be emptied by the overlapped encoder
+        step2Record["frames"] = interpolatedFrameCount
+        job_profiler.finish(step2Record)
 
     # Step 3: Interpolated Frames -> Output Video
     if (stepsSelection is None) or ("3" in stepsSelection):
-        print("\nStep 3: Extracting frames to output_videos")
-        outputFile = os.path.join(folderOutputVideos, inputFileName + "".join(infoJsonFile["outputSuffixes"]) +
-                                  "." + video_type)
-        ffmpeg.encode_frames(folderInterpolatedFrames,
-                             outputFile,
-                             str(inputFileFps * frame_multiplier))
+        if pipeline == "stream":  # Steps 1, 2 and 3 in one pass without intermediate frames
+            print("\nSteps 1-3: Streaming frames to output_videos using", interpolator_engine)
+            infoJsonFile["outputSuffixes"] = ["-Stream{}{}x".format(interpolator_engine.capitalize(),
+                                                                    frame_multiplier)]
+            outputFile = os.path.join(folderOutputVideos, inputFileName + "".join(infoJsonFile["outputSuffixes"]) +
+                                      "." + video_type)
+            queueDepth = stream_pipeline.DEFAULT_QUEUE_DEPTH
+            if ("stream_queue_depth" in kwargs) and (kwargs["stream_queue_depth"] is not None):
+                queueDepth = kwargs["stream_queue_depth"]
+            with job_profiler.stage("stream"):
+                stream_pipeline.interpolate_stream(inputFile, outputFile, str(inputFileFps * frame_multiplier),
+                                                   frame_multiplier, engine=interpolator_engine,
+                                                   queue_depth=queueDepth)
+        elif pipeline == "chunked":  # Steps 1, 2 and 3 per window of frames
+            print("\nSteps 1-3: Processing chunks to output_videos using", interpolator_engine)
+            if ("duplicate_auto_delete" in kwargs) and (kwargs["duplicate_auto_delete"] is not None):
+                print("WARNING: --duplicate-auto-delete is not supported by the chunked pipeline, ignoring")
+            infoJsonFile["outputSuffixes"] = ["-{}{}x".format(interpolator_engine.split("-")[0].capitalize(),
+                                                              frame_multiplier)]
+            outputFile = os.path.join(folderOutputVideos, inputFileName + "".join(infoJsonFile["outputSuffixes"]) +
+                                      "." + video_type)
+            chunkSize = chunked_pipeline.DEFAULT_CHUNK_SIZE
+            if ("chunk_size" in kwargs) and (kwargs["chunk_size"] is not None):
+                chunkSize = kwargs["chunk_size"]
+            with job_profiler.stage("chunked"):
+                chunked_pipeline.interpolate_chunked(inputFile, outputFile, str(inputFileFps * frame_multiplier),
+                                                     frame_multiplier, interpolator_engine, folderBase,
+                                                     chunk_size=chunkSize, video_type=video_type,
+                                                     stream_metadata=inputFileProperties, **interpolatorOptions)
+        else:
+            print("\nStep 3: Extracting frames to output_videos")
+            outputFile = os.path.join(folderOutputVideos, inputFileName + "".join(infoJsonFile["outputSuffixes"]) +
+                                      "." + video_type)
+            if overlapEncoder is not None:  # Started with step 2, only the frames it hasn't read yet are left
+                print("Waiting for the overlapped encoder...")
+                with job_profiler.stage("encode", frames=step2Record["frames"]):
+                    overlapEncoder.finish(step2Record["frames"])
+                os.replace(overlapEncoder.output_file, outputFile)
+            else:
+                with job_profiler.stage("encode", frames=len(os.listdir(folderInterpolatedFrames))):
+                    ffmpeg.encode_frames(folderInterpolatedFrames,
+                                         outputFile,
+                                         str(outputFps),
+                                         preset=kwargs.get("encode_preset"),
+                                         threads=kwargs.get("encode_threads"),
+                                         segments=kwargs.get("encode_segments") or 1)
 
         if ("copy_audio" in kwargs) and (kwargs["copy_audio"] is True):
             print("Copying audio to output...")
@@ -205,7 +477,12 @@ def main(input_file, output_folder, **kwargs):
             last_output_file = outputFile
             outputFile = os.path.join(folderOutputVideos, inputFileName + "".join(infoJsonFile["outputSuffixes"]) +
                                       "." + video_type)
-            ffmpeg.combine_video_audio(last_output_file, inputFile, outputFile)
+            with job_profiler.stage("audio mux"):
+                if preview is not None:  # Only the part of the audio under the preview
+                    ffmpeg.combine_video_audio(last_output_file, inputFile, outputFile,
+                                               audio_start=preview["start"] or 0)
+                else:
+                    ffmpeg.combine_video_audio(last_output_file, inputFile, outputFile)
 
         if ("copy_mtime" in kwargs) and (kwargs["copy_mtime"] is True):  # Copy mtime to output
             print("Copying mtime to output...")
@@ -214,7 +491,13 @@ def main(input_file, output_folder, **kwargs):
 
         if ("output_file" in kwargs) and (kwargs["output_file"] is not None):  # Copy output file to destination
             print("Copying output file to --output-file...")
-            shutil.copy2(outputFile, os.path.dirname(inputFile))
+            with job_profiler.stage("copy"):
+                shutil.copy2(outputFile, os.path.dirname(inputFile))
+
+    if job_profiler.enabled is True:
+        infoJsonFile["profile"] = job_profiler.records
+        print("\nProfile:")
+        print(job_profiler.summary())
 
     # Write info to json at the end
     json.dump(infoJsonFile, open(infoJsonFilePath, "w"))
@@ -228,40 +511,106 @@ if __name__ == "__main__":
     # Console arguments
     parser = argparse.ArgumentParser()
     # Path options
-    parser.add_argument("-i", "--input-file", required=True, help="Path to input video")
+    parser.add_argument("-i", "--input-file", required=True, nargs="+",
+                        help="Path to input video, several videos or folders of videos are processed as a batch")
     parser.add_argument("-O", "--output-folder", required=True, help="Folder to output work to")
     parser.add_argument("-o", "--output-file", help="Path to copy final video to (can be directory or file path)")
     parser.add_argument("--delete-output-folder", action="store_true",
                         help="Delete output folder at the end, intended to be used with --output-file")
+    # Batch options
+    parser.add_argument("--batch-gpu-jobs", type=int, default=job_queue.DEFAULT_GPU_JOBS,
+                        help="Batch: interpolation steps ran at once (default=%(default)s)")
+    parser.add_argument("--batch-cpu-jobs", type=int, default=job_queue.DEFAULT_CPU_JOBS,
+                        help="Batch: extraction/encoding steps of other videos ran at once while interpolating "
+                             "(default=%(default)s)")
     # Interpolation options
     parser.add_argument("-m", "--interpolation-mode", default=definitions.DEFAULT_INTERPOLATOR_MODE,
                         help="Interpolation type (static/dynamic, default=static)")
     parser.add_argument("-x", "--frame-multiplier", type=int,
                         help="Frame multiplier 2x,3x,etc (default=2)")
-    parser.add_argument("--target-fps", help="Calculates frame multiplier based on a target framerate")
+    parser.add_argument("--target-fps",
+                        help="Calculates frame multiplier based on a target framerate, framerates that aren't a "
+                             "whole multiple are resampled exactly (only the needed frames are interpolated)")
+    parser.add_argument("--resample-tolerance", type=float, default=interpolator.RESAMPLE_TOLERANCE,
+                        help="Largest timing error of a --target-fps frame with cain/rife, in output frames, smaller "
+                             "values interpolate more midpoints (default={})".format(interpolator.RESAMPLE_TOLERANCE))
     parser.add_argument("-e", "--interpolator-engine", default=definitions.DEFAULT_INTERPOLATOR_ENGINE,
-                        help="Pick interpolator: dain-ncnn, cain-ncnn, rife-ncnn (default=dain-ncnn)")
+                        help="Pick interpolator: dain-ncnn, cain-ncnn, rife-ncnn, rife, blend (default=dain-ncnn)")
     parser.add_argument("--loop-video", action="store_true",
-                        help="[Unimplemented] Interpolates video as a loop (last frame leads into the first)")
+                        help="Interpolates video as a loop (last frame leads into the first)")
     parser.add_argument("--duplicate-auto-delete", type=float,
                         help="Based on a percentage (Eg. 0.95) will delete any frames found to be more similar")
+    parser.add_argument("--duplicate-backend", choices=["ssim-pil", "numpy"],
+                        help="SSIM implementation of --duplicate-auto-delete, numpy is much faster and caches "
+                             "fingerprints but scores differently so thresholds need adjusting "
+                             "(default={})".format(image_similarity.DEFAULT_BACKEND))
+    parser.add_argument("--scene-cut-threshold", type=float,
+                        help="Based on a percentage (Eg. 0.4) frames less similar than the previous frame start a "
+                             "new scene, pairs across a scene cut are duplicated instead of interpolated")
+    # Pipeline options
+    parser.add_argument("--pipeline", default=definitions.DEFAULT_PIPELINE, choices=["folder", "stream", "chunked"],
+                        help="folder: frames are written to disk between steps, stream: frames are piped between "
+                             "ffmpeg and the interpolator in memory (engines: rife, blend), chunked: steps 1-3 are "
+                             "ran per --chunk-size frames to limit disk usage (default=folder)")
+    parser.add_argument("--chunk-size", type=int,
+                        help="Number of original frames per chunk for the chunked pipeline "
+                             "(default={})".format(chunked_pipeline.DEFAULT_CHUNK_SIZE))
+    parser.add_argument("--stream-queue-depth", type=int,
+                        help="Maximum number of decoded frames held in memory by the stream pipeline "
+                             "(default={})".format(stream_pipeline.DEFAULT_QUEUE_DEPTH))
+    parser.add_argument("--intermediate-format", default=definitions.DEFAULT_INTERMEDIATE_FORMAT,
+                        choices=ffmpeg.engine_intermediate_formats(),
+                        help="Lossless image format of original_frames, bmp and ppm skip compression "
+                             "(no ppm on Windows), interpolated frames are always png (default={})".format(
+                                 definitions.DEFAULT_INTERMEDIATE_FORMAT))
+    parser.add_argument("--png-compression", type=int, choices=range(10), metavar="[0-9]",
+                        help="zlib level of extracted png frames, 0-1 are much faster for scratch frames "
+                             "(default=ffmpeg's)")
+    parser.add_argument("--vfr-extract", action="store_true",
+                        help="Dynamic mode: extract only the real frames of vfr videos with their timestamps instead "
+                             "of padding them to cfr with duplicates, gaps are interpolated from the timestamps")
     # Dain-ncnn/Cain-ncnn pass-through options
     parser.add_argument("-g", "--gpu-id", help="GPU to use (default=auto) can be 0,1,2 for multi-gpu")
     parser.add_argument("-t", "--tile-size",
                         help="Tile size (>=128, default=256) must be multiple of 32, can be 256,256,128 for multi-gpu")
     parser.add_argument("-j", "--threads",
                         help="Thread count for load/process/save (default=1:2:2) can be 1:2,2,2:2 for multi-gpu")
+    parser.add_argument("--shard-gpu-ids",
+                        help="Split step 2 into frame ranges and run one engine process per listed GPU "
+                             "(eg. 0,1,2 or 0,0 for two processes on one GPU)")
+    # Preview options
+    parser.add_argument("--start", type=float, help="Preview: start at this many seconds into the video")
+    parser.add_argument("--duration", type=float, help="Preview: only process this many seconds of the video")
+    parser.add_argument("--preview-scale", type=float,
+                        help="Preview: scale the frames by this factor while extracting (eg. 0.5 for half resolution)")
     # Step options
     parser.add_argument("--steps", help="If specified only run certain steps 1,2,3 (eg. 1,2 for 1 & 2 only)")
     # Output file options
     parser.add_argument("--video-type", default=definitions.DEFAULT_VIDEO_TYPE,
                         help="Video type for output video eg. mp4, webm, mkv (default=mp4)")
+    parser.add_argument("--encode-preset", help="Encoder preset, eg. ultrafast-veryslow for x264 (default=medium)")
+    parser.add_argument("--encode-threads", type=int, help="Encoder threads (per segment with --encode-segments)")
+    parser.add_argument("--encode-segments", type=int,
+                        help="Encode this many GOP-aligned parts of the video at once and join them losslessly, "
+                             "faster on many-core machines (default=1)")
+    parser.add_argument("--overlap-encode", action="store_true",
+                        help="Encode the interpolated frames while step 2 is still writing them "
+                             "(folder pipeline, steps 2 and 3 in one run)")
+    parser.add_argument("--overlap-delete-frames", action="store_true",
+                        help="With --overlap-encode, delete interpolated frames once they're encoded "
+                             "(step 3 can't be run again on its own afterwards)")
     parser.add_argument("--copy-mtime", action="store_true", help="Copy the modified timestamp to output")
     parser.add_argument("--copy-audio", action="store_true", help="Copy the input audio to output")
     # Debug options
     parser.add_argument("--input-fps", type=float, help="Manually specify framerate of input video")
     parser.add_argument("--verbose", action="store_true", help="Print additional info to the commandline")
     parser.add_argument("--debug", action="store_true", help="Print debug messages to the commandline")
+    parser.add_argument("--profile", action="store_true",
+                        help="Record wall/CPU time, frames/sec, disk I/O and peak memory of every stage to info.json "
+                             "and print a summary table")
+    parser.add_argument("--progress-json", metavar="PATH",
+                        help="Write progress events (stage, frames done/total, fps, ETA) as JSON lines to a file, "
+                             "\"-\" for stdout")
     arguments = vars(parser.parse_args())
 
     # Logging
@@ -270,4 +619,10 @@ if __name__ == "__main__":
     if arguments["debug"] is True:
         logging.basicConfig(level=logging.DEBUG)
 
-    main(**arguments)
+    inputFiles = arguments.pop("input_file")
+    batchGpuJobs = arguments.pop("batch_gpu_jobs")
+    batchCpuJobs = arguments.pop("batch_cpu_jobs")
+    if (len(inputFiles) == 1) and (not os.path.isdir(inputFiles[0])):
+        main(inputFiles[0], **arguments)
+    elif job_queue.run_batch(inputFiles, gpu_jobs=batchGpuJobs, cpu_jobs=batchCpuJobs, **arguments) is False:
+        exit(1)
@@ -3,6 +3,7 @@
 # Built-in modules
 import os
 import sys
+import time
 
 # Local modules
 import dain_ncnn_vulkan
@@ -23,16 +24,22 @@ def error_popup(message):
     msg.exec_()
 
 
+class WorkerSignals(QObject):
+    # Progress events are emitted from the worker thread, Qt queues them to the GUI thread
+    progress = pyqtSignal(dict)
+
+
 class Worker(QRunnable):
     def __init__(self, *args, **kwargs):
         super(Worker, self).__init__()
         self.args = args
         self.kwargs = kwargs
+        self.signals = WorkerSignals()
 
     @pyqtSlot()
     def run(self):
         print(self.kwargs)
-        DAINVulkanCLI.main(**self.kwargs)
+        DAINVulkanCLI.main(progress_callback=self.signals.progress.emit, **self.kwargs)
         print("Done!")
 
 
@@ -64,6 +71,20 @@ class MainWindow(QMainWindow):
         elif self.engine_combo_box.currentText().lower().startswith("cain-ncnn"):
             self.tile_size_line_edit.setPlaceholderText(str(cain_ncnn_vulkan.DEFAULT_TILE_SIZE))
 
+    def progress_update(self, event):
+        message = "{}: {} frames".format(event["stage"], event["frames_done"])
+        if event["frames_total"] is not None:
+            message = "{}: {}/{} frames".format(event["stage"], event["frames_done"], event["frames_total"])
+        if event["event"] == "error":
+            message += ", error: {}".format(event["message"])
+        elif event["event"] == "end":
+            message += ", done"
+        else:
+            message += ", {:.1f} fps".format(event["fps_average"])
+            if event["eta"] is not None:
+                message += ", ETA {}".format(time.strftime("%H:%M:%S", time.gmtime(event["eta"])))
+        self.statusBar().showMessage(message)
+
     def worker_execute(self):
         # Required arguments
         if not self.input_file:
@@ -89,6 +110,7 @@ class MainWindow(QMainWindow):
 
         # Execute
         worker = Worker(**kwargs)
+        worker.signals.progress.connect(self.progress_update)
         self.threadpool.start(worker)
 
     def __init__(self):
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the frame pipeline
+
+intermediate-formats: extracts a video with every intermediate format (and png compression level)
+then encodes the frames again, reporting the CPU time and disk space each choice costs
+`python benchmark.py intermediate-formats -i input.mp4 --frames 300`
+
+pipeline: generates synthetic videos with ffmpeg's lavfi sources (cfr, vfr and duplicate-heavy)
+and runs DAINVulkanCLI.main on them with the engine binaries swapped for benchmark_stub_engine.py,
+recording the time of every step (--profile) to a JSON file, so the pipeline's own overhead is measured without a GPU
+(the vfr and duplicate-heavy videos are deduplicated first so dedupe and the gaps of dynamic mode are timed too)
+`python benchmark.py pipeline -o results.json` then `python benchmark.py compare before.json results.json`
+
+encode-segments: encodes the same frames as one ffmpeg process and split into N segments encoded at once
+`python benchmark.py encode-segments --segments 1,2,4,8`
+"""
+# Built-in modules
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import pathlib
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+try:
+    import resource  # Unix only, CPU time isn't reported without it
+except ImportError:
+    resource = None
+# Local modules
+import DAINVulkanCLI
+import definitions
+import ffmpeg
+
+DEFAULT_PNG_COMPRESSIONS = [None, 0, 1, 9]  # None is ffmpeg's default level
+VIDEO_KINDS = ("cfr", "vfr", "duplicates")
+DEFAULT_SIZES = ["426x240", "1280x720"]
+DEFAULT_DURATIONS = [4]
+DEFAULT_ENGINES = ["dain-ncnn", "rife-ncnn"]
+DEFAULT_MODES = ["static", "dynamic"]
+DEFAULT_MULTIPLIER = 2
+DEFAULT_DUPLICATE_THRESHOLD = 0.95  # --duplicate-auto-delete of the kinds in DEDUPE_KINDS
+DEDUPE_KINDS = ("vfr", "duplicates")  # Kinds with repeated frames (vfr gaps are padded with duplicates)
+SYNTHETIC_FPS = 30
+STUB_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_stub_engine.py")
+
+
+def _children_cpu_time():
+    """User + system CPU time of every finished child process (ffmpeg)"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _folder_size(folder):
+    return sum(os.path.getsize(os.path.join(folder, file)) for file in os.listdir(folder))
+
+
+def _measure(function, *args, **kwargs):
+    """Returns (wall seconds, child CPU seconds or None) for running function"""
+    cpuStart = _children_cpu_time()
+    wallStart = time.perf_counter()
+    function(*args, **kwargs)
+    wallTime = time.perf_counter() - wallStart
+    cpuTime = None if cpuStart is None else _children_cpu_time() - cpuStart
+    return wallTime, cpuTime
+
+
+def benchmark_intermediate_formats(input_file, working_folder=None, formats=None, png_compressions=None,
+                                   frame_count=None):
+    """Extracts and encodes input_file once per format, returns one result dict per format/compression level"""
+    if formats is None:
+        formats = list(ffmpeg.INTERMEDIATE_FORMATS)
+    if png_compressions is None:
+        png_compressions = DEFAULT_PNG_COMPRESSIONS
+    cases = []
+    for image_format in formats:
+        if image_format == "png":
+            cases.extend(("png", level) for level in png_compressions)
+        else:
+            cases.append((image_format, None))
+
+    results = []
+    folderBenchmark = tempfile.mkdtemp(prefix="benchmark-", dir=working_folder)
+    try:
+        for image_format, png_compression in cases:
+            print("\n{} (compression: {})".format(image_format, "default" if png_compression is None
+                                                 else png_compression))
+            folderFrames = os.path.join(folderBenchmark, "frames")
+            extractWall, extractCpu = _measure(ffmpeg.extract_frames, input_file, folderFrames,
+                                               frame_count=frame_count, image_format=image_format,
+                                               png_compression=png_compression)
+            frames = len(os.listdir(folderFrames))
+            diskBytes = _folder_size(folderFrames)
+            encodeWall, encodeCpu = _measure(ffmpeg.encode_frames, folderFrames,
+                                             os.path.join(folderBenchmark, "encoded.mp4"), 30,
+                                             image_format=image_format)
+            results.append({"format": image_format, "png_compression": png_compression, "frames": frames,
+                            "disk_bytes": diskBytes, "extract_wall": extractWall, "extract_cpu": extractCpu,
+                            "encode_wall": encodeWall, "encode_cpu": encodeCpu})
+            shutil.rmtree(folderFrames)
+    finally:
+        shutil.rmtree(folderBenchmark)
+    return results
+
+
+def benchmark_encode_segments(input_file=None, segment_counts=None, preset=None, working_folder=None):
+    """Encodes the frames of input_file (a synthetic 720p video by default) with each segment count,
+    returns one result dict per count
+    """
+    if segment_counts is None:
+        segment_counts = [1, 2, 4]
+    results = []
+    folderBenchmark = tempfile.mkdtemp(prefix="benchmark-", dir=working_folder)
+    try:
+        if input_file is None:
+            input_file = os.path.join(folderBenchmark, "input.mp4")
+            generate_test_video(input_file, "1280x720", 20)
+        folderFrames = os.path.join(folderBenchmark, "frames")
+        ffmpeg.extract_frames(input_file, folderFrames, image_format="bmp")  # No png decoding cost in the encodes
+        frames = len(os.listdir(folderFrames))
+        for segments in segment_counts:
+            print("\n{} segment(s)".format(segments))
+            outputFile = os.path.join(folderBenchmark, "encoded.mp4")
+            wallTime, cpuTime = _measure(ffmpeg.encode_frames, folderFrames, outputFile, SYNTHETIC_FPS,
+                                         preset=preset, segments=segments)
+            results.append({"segments": segments, "frames": frames, "wall": wallTime, "cpu": cpuTime,
+                            "fps": frames / wallTime, "bytes": os.path.getsize(outputFile)})
+            os.remove(outputFile)
+    finally:
+        shutil.rmtree(folderBenchmark)
+    return results
+
+
+def print_encode_segment_results(results):
+    print("\n{:>9} {:>8} {:>9} {:>9} {:>9} {:>9} {:>8}".format("segments", "frames", "wall s", "cpu s", "fps",
+                                                                 "MB", "speedup"))
+    for result in results:
+        print("{:>9} {:>8} {:>9.2f} {:>9} {:>9.1f} {:>9.1f} {:>7.2f}x".format(
+            result["segments"], result["frames"], result["wall"],
+            "-" if result["cpu"] is None else "{:.2f}".format(result["cpu"]), result["fps"],
+            result["bytes"] / 1000000, results[0]["wall"] / result["wall"]))
+
+
+def print_intermediate_format_results(results):
+    def seconds(value):
+        return "-" if value is None else "{:.2f}".format(value)
+
+    print("\n{:<12} {:>7} {:>11} {:>12} {:>11} {:>12} {:>11}".format(
+        "format", "frames", "MB", "extract cpu", "extract s", "encode cpu", "encode s"))
+    for result in results:
+        name = result["format"]
+        if result["png_compression"] is not None:
+            name += "-{}".format(result["png_compression"])
+        print("{:<12} {:>7} {:>11.1f} {:>12} {:>11} {:>12} {:>11}".format(
+            name, result["frames"], result["disk_bytes"] / 1000000, seconds(result["extract_cpu"]),
+            seconds(result["extract_wall"]), seconds(result["encode_cpu"]), seconds(result["encode_wall"])))
+
+
+def generate_test_video(output_file, size, duration, kind="cfr", framerate=SYNTHETIC_FPS):
+    """Synthetic video from ffmpeg's testsrc2
+    cfr: every frame differs, vfr: a third of every second is dropped (timestamps keep the gaps),
+    duplicates: a third of the framerate with every frame repeated 3 times
+    """
+    source = "testsrc2=size={}:rate={}:duration={}".format(size, framerate, duration)
+    vsync = "cfr"
+    if kind == "vfr":
+        source += r",select=not(between(mod(n\,{0})\,{1}\,{2}))".format(framerate, framerate // 3,
+                                                                        framerate // 3 * 2 - 1)
+        vsync = "vfr"
+    elif kind == "duplicates":
+        source = "testsrc2=size={}:rate={}:duration={},fps={}".format(size, framerate / 3, duration, framerate)
+    elif kind != "cfr":
+        raise ValueError("Invalid video kind: {}".format(kind))
+    cmd = [definitions.FFMPEG_BIN, "-hide_banner", "-loglevel", "error",
+           "-f", "lavfi", "-i", source,
+           "-vsync", vsync,
+           "-c:v", "libx264", "-pix_fmt", "yuv420p", "-crf", "18",
+           "-y", output_file]
+    subprocess.run(cmd, check=True)
+
+
+@contextlib.contextmanager
+def stub_engines(folder):
+    """Points every ncnn engine binary in definitions at the stub engine for the duration of the block"""
+    if platform.system() == "Windows":
+        stubBin = os.path.join(folder, "stub-engine.cmd")
+        with open(stubBin, "w") as file:
+            file.write("@\"{}\" \"{}\" %*\n".format(sys.executable, STUB_ENGINE))
+    else:
+        stubBin = os.path.join(folder, "stub-engine")
+        with open(stubBin, "w") as file:
+            file.write("#!/bin/sh\nexec \"{}\" \"{}\" \"$@\"\n".format(sys.executable, STUB_ENGINE))
+        os.chmod(stubBin, 0o755)
+    names = ("DAIN_NCNN_VULKAN_BIN", "DAIN_NCNN_VULKAN_LOCATION", "CAIN_NCNN_VULKAN_BIN",
+             "CAIN_NCNN_VULKAN_LOCATION", "RIFE_NCNN_VULKAN_BIN", "RIFE_NCNN_VULKAN_LOCATION")
+    original = {name: getattr(definitions, name) for name in names}
+    for name in names:
+        setattr(definitions, name, stubBin if name.endswith("_BIN") else folder)
+    try:
+        yield stubBin
+    finally:
+        for name, value in original.items():
+            setattr(definitions, name, value)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_pipeline(sizes=None, durations=None, kinds=VIDEO_KINDS, engines=None, modes=None,
+                       multiplier=DEFAULT_MULTIPLIER, working_folder=None,
+                       duplicate_threshold=DEFAULT_DUPLICATE_THRESHOLD):
+    """
+    Runs every synthetic video through every engine/mode with stub engines, returns the results dict
+    duplicate_threshold: --duplicate-auto-delete of the DEDUPE_KINDS videos, None to never deduplicate
+    """
+    sizes = DEFAULT_SIZES if sizes is None else sizes
+    durations = DEFAULT_DURATIONS if durations is None else durations
+    engines = DEFAULT_ENGINES if engines is None else engines
+    modes = DEFAULT_MODES if modes is None else modes
+
+    results = {"commit": _git_commit(), "platform": platform.platform(), "python": platform.python_version(),
+               "cpu_count": os.cpu_count(), "time": time.time(), "runs": []}
+    folderBenchmark = tempfile.mkdtemp(prefix="benchmark-", dir=working_folder)
+    try:
+        with stub_engines(folderBenchmark):
+            for size, duration, kind in itertools.product(sizes, durations, kinds):
+                case = "{}-{}-{:g}s".format(kind, size, duration)
+                inputFile = os.path.join(folderBenchmark, case + ".mp4")
+                generate_test_video(inputFile, size, duration, kind)
+                duplicateThreshold = duplicate_threshold if kind in DEDUPE_KINDS else None
+                for engine, mode in itertools.product(engines, modes):
+                    if (mode == "dynamic") and (not engine.startswith("dain-ncnn")):
+                        continue  # Only dain-ncnn supports dynamic interpolation
+                    print("\nBenchmark: {} {} {}".format(case, engine, mode))
+                    folderRun = os.path.join(folderBenchmark, "run")
+                    wallStart = time.perf_counter()
+                    DAINVulkanCLI.main(inputFile, folderRun, interpolator_engine=engine, interpolation_mode=mode,
+                                       frame_multiplier=multiplier, duplicate_auto_delete=duplicateThreshold,
+                                       profile=True)
+                    wallTime = time.perf_counter() - wallStart
+                    with open(os.path.join(folderRun, case, "info.json")) as file:
+                        infoJson = json.load(file)
+                    profile = infoJson["profile"]
+                    if (duplicateThreshold is not None) and ("dedupe" not in [record["name"] for record in profile]):
+                        raise RuntimeError("{}: dedupe stage wasn't profiled".format(case))
+                    results["runs"].append({
+                        "case": case, "kind": kind, "size": size, "duration": duration, "engine": engine,
+                        "mode": mode, "multiplier": multiplier, "duplicate_auto_delete": duplicateThreshold,
+                        "wall": wallTime,
+                        "frames_deduplicated": infoJson["extracted_frames"] - infoJson["step1"]["original_frames"],
+                        "stages": {record["name"]: {key: record[key] for key in ("wall", "cpu", "frames", "fps",
+                                                                                 "folder_bytes")}
+                                   for record in profile}})
+                    shutil.rmtree(folderRun)
+    finally:
+        shutil.rmtree(folderBenchmark)
+    return results
+
+
+def _run_key(run):
+    runKey = "{} {} {} {}x".format(run["case"], run["engine"], run["mode"], run["multiplier"])
+    if run.get("duplicate_auto_delete") is not None:
+        runKey += " dedupe {:g}".format(run["duplicate_auto_delete"])
+    return runKey
+
+
+def print_pipeline_results(results):
+    print("\nCommit: {}, {}, Python {}".format(results["commit"], results["platform"], results["python"]))
+    for run in results["runs"]:
+        print("\n{} ({:.2f}s, {} duplicates removed)".format(_run_key(run), run["wall"],
+                                                             run.get("frames_deduplicated", 0)))
+        for name, stage in run["stages"].items():
+            print("  {:<20} {:>8.2f}s {:>8} frames".format(name, stage["wall"], "-" if stage["frames"] is None
+                                                         else stage["frames"]))
+
+
+def compare_pipeline_results(base_results, results):
+    """Prints the wall time of every step of the runs both results have, with the change from base"""
+    def change(base, new):
+        return "-" if not base else "{:+.1f}%".format((new - base) / base * 100)
+
+    baseRuns = {_run_key(run): run for run in base_results["runs"]}
+    print("Base: {}, compared: {}".format(base_results["commit"], results["commit"]))
+    print("{:<48} {:<20} {:>9} {:>9} {:>9}".format("run", "stage", "base s", "new s", "change"))
+    for run in results["runs"]:
+        baseRun = baseRuns.get(_run_key(run))
+        if baseRun is None:
+            print("{:<48} only in {}".format(_run_key(run), results["commit"]))
+            continue
+        for name, stage in run["stages"].items():
+            if name in baseRun["stages"]:
+                baseWall = baseRun["stages"][name]["wall"]
+                print("{:<48} {:<20} {:>9.2f} {:>9.2f} {:>9}".format(_run_key(run), name, baseWall, stage["wall"],
+                                                                     change(baseWall, stage["wall"])))
+        print("{:<48} {:<20} {:>9.2f} {:>9.2f} {:>9}".format(_run_key(run), "total", baseRun["wall"], run["wall"],
+                                                             change(baseRun["wall"], run["wall"])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    formatsParser = subparsers.add_parser("intermediate-formats",
+                                          help="CPU time and disk space of each intermediate frame format")
+    formatsParser.add_argument("-i", "--input-file", required=True, help="Path to input video")
+    formatsParser.add_argument("--frames", type=int, help="Only use the first N frames of the video")
+    formatsParser.add_argument("--formats", default=",".join(ffmpeg.INTERMEDIATE_FORMATS),
+                               help="Comma separated formats to compare (default=%(default)s)")
+    formatsParser.add_argument("--png-compressions", default="default,0,1,9",
+                               help="Comma separated png levels to compare, \"default\" is ffmpeg's "
+                                    "(default=%(default)s)")
+    formatsParser.add_argument("--working-folder", help="Where frames are written (default=system temp folder)")
+    pipelineParser = subparsers.add_parser("pipeline",
+                                           help="Time every step on synthetic videos with stub engines (no GPU)")
+    pipelineParser.add_argument("-o", "--output-file", required=True, help="JSON file to write results to")
+    pipelineParser.add_argument("--sizes", default=",".join(DEFAULT_SIZES),
+                                help="Comma separated video sizes (default=%(default)s)")
+    pipelineParser.add_argument("--durations", default=",".join(str(duration) for duration in DEFAULT_DURATIONS),
+                                help="Comma separated video lengths in seconds (default=%(default)s)")
+    pipelineParser.add_argument("--kinds", default=",".join(VIDEO_KINDS),
+                                help="Comma separated synthetic video kinds (default=%(default)s)")
+    pipelineParser.add_argument("--engines", default=",".join(DEFAULT_ENGINES),
+                                help="Comma separated ncnn engines to stub (default=%(default)s)")
+    pipelineParser.add_argument("--modes", default=",".join(DEFAULT_MODES),
+                                help="Comma separated interpolation modes, dynamic only runs with dain-ncnn "
+                                     "(default=%(default)s)")
+    pipelineParser.add_argument("-x", "--frame-multiplier", type=int, default=DEFAULT_MULTIPLIER,
+                                help="Frame multiplier (default=%(default)s)")
+    pipelineParser.add_argument("--duplicate-threshold", type=float, default=DEFAULT_DUPLICATE_THRESHOLD,
+                                help="--duplicate-auto-delete of the {} videos, 0 to skip dedupe "
+                                     "(default=%(default)s)".format(" and ".join(DEDUPE_KINDS)))
+    pipelineParser.add_argument("--working-folder", help="Where videos and frames are written "
+                                                         "(default=system temp folder)")
+    segmentsParser = subparsers.add_parser("encode-segments",
+                                           help="Throughput of one encoder against segments encoded at once")
+    segmentsParser.add_argument("-i", "--input-file", help="Video whose frames are encoded "
+                                                           "(default=synthetic 20s 720p video)")
+    segmentsParser.add_argument("--segments", default="1,2,4",
+                                help="Comma separated segment counts to compare, the first is the baseline "
+                                     "(default=%(default)s)")
+    segmentsParser.add_argument("--preset", help="Encoder preset (default=ffmpeg's)")
+    segmentsParser.add_argument("--working-folder", help="Where frames are written (default=system temp folder)")
+    compareParser = subparsers.add_parser("compare", help="Compare two pipeline result files (eg. between commits)")
+    compareParser.add_argument("base_file", help="Results to compare against")
+    compareParser.add_argument("results_file", help="New results")
+    args = vars(parser.parse_args())
+
+    if args["benchmark"] == "intermediate-formats":
+        pngCompressions = [None if level == "default" else int(level) for level in args["png_compressions"].split(",")]
+        print_intermediate_format_results(benchmark_intermediate_formats(
+            args["input_file"], args["working_folder"], args["formats"].split(","), pngCompressions, args["frames"]))
+    elif args["benchmark"] == "pipeline":
+        pipelineResults = benchmark_pipeline(args["sizes"].split(","),
+                                             [float(duration) for duration in args["durations"].split(",")],
+                                             args["kinds"].split(","), args["engines"].split(","),
+                                             args["modes"].split(","), args["frame_multiplier"], args["working_folder"],
+                                             args["duplicate_threshold"] or None)
+        pathlib.Path(os.path.dirname(os.path.abspath(args["output_file"]))).mkdir(parents=True, exist_ok=True)
+        with open(args["output_file"], "w") as file:
+            json.dump(pipelineResults, file, indent=2)
+        print_pipeline_results(pipelineResults)
+    elif args["benchmark"] == "encode-segments":
+        print_encode_segment_results(benchmark_encode_segments(
+            args["input_file"], [int(segments) for segments in args["segments"].split(",")], args["preset"],
+            args["working_folder"]))
+    elif args["benchmark"] == "compare":
+        with open(args["base_file"]) as baseFile, open(args["results_file"]) as resultsFile:
+            compare_pipeline_results(json.load(baseFile), json.load(resultsFile))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Stub interpolation engine for benchmarks
+
+Accepts the command line of dain/cain/rife-ncnn-vulkan (pair and folder mode) and writes
+cross-faded frames instead of running a model, so the pipeline can be timed without a GPU.
+It prints the same "done" lines on stderr that the wrappers count for progress.
+`python benchmark.py pipeline` points definitions.*_NCNN_VULKAN_BIN at it,
+it can also be used directly with the DAIN_NCNN_VULKAN_BIN/CAIN_NCNN_VULKAN_BIN/RIFE_NCNN_VULKAN_BIN variables
+"""
+# Built-in modules
+import argparse
+import math
+import os
+import sys
+# External modules
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.ppm')
+STUB_PNG_COMPRESSION = 1  # Keeps the stub's own cost small next to the pipeline it measures
+
+
+def blend_frames(image0_file, image1_file, output_file, time_step):
+    image0 = Image.open(image0_file).convert("RGB")
+    if time_step <= 0:
+        image = image0
+    else:
+        image = Image.blend(image0, Image.open(image1_file).convert("RGB"), time_step)
+    image.save(output_file, compress_level=STUB_PNG_COMPRESSION)
+    print("{} {} {:f} -> {} done".format(image0_file, image1_file, time_step, output_file), file=sys.stderr,
+          flush=True)
+
+
+def interpolate_folder(input_folder, output_folder, target_frames=None, pattern="%08d.png"):
+    """Output i is at time i * N / target_frames of the N input frames, like the ncnn binaries"""
+    inputFiles = sorted(os.path.join(input_folder, file) for file in os.listdir(input_folder)
+                        if file.lower().endswith(IMAGE_EXTENSIONS))
+    if target_frames is None:
+        target_frames = len(inputFiles) * 2
+    os.makedirs(output_folder, exist_ok=True)
+    for i in range(target_frames):
+        position = i * len(inputFiles) / target_frames
+        frame0 = math.floor(position)
+        frame1 = min(frame0 + 1, len(inputFiles) - 1)
+        timeStep = position - frame0 if frame1 > frame0 else 0.0
+        blend_frames(inputFiles[frame0], inputFiles[frame1], os.path.join(output_folder, pattern % (i + 1)),
+                     timeStep)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-0", dest="input0", help="input0 image (pair mode)")
+    parser.add_argument("-1", dest="input1", help="input1 image (pair mode)")
+    parser.add_argument("-i", dest="input_folder", help="input folder (folder mode)")
+    parser.add_argument("-o", dest="output", required=True, help="output image or folder")
+    parser.add_argument("-n", dest="target_frames", type=int, help="output frame count (default=N*2)")
+    parser.add_argument("-s", dest="time_step", type=float, default=0.5, help="time step (pair mode)")
+    parser.add_argument("-f", dest="pattern", default="%08d.png", help="output filename pattern")
+    # Accepted so the wrappers' command lines work, the stub has nothing to tune
+    for option in ("-t", "-g", "-j", "-m"):
+        parser.add_argument(option)
+    parser.add_argument("-v", action="store_true")
+    args = parser.parse_args()
+
+    print("[0 Benchmark stub engine]", file=sys.stderr, flush=True)
+    if args.input_folder is not None:
+        interpolate_folder(args.input_folder, args.output, args.target_frames, args.pattern)
+    elif (args.input0 is not None) and (args.input1 is not None):
+        blend_frames(args.input0, args.input1, args.output, args.time_step)
+    else:
+        parser.error("either -i or -0 and -1 are required")
@@ -0,0 +1,100 @@
+"""
+Chunked pipeline (steps 1, 2 and 3 per window of frames)
+
+Long videos are processed a window of chunk_size frames at a time so peak disk usage
+depends on the chunk size instead of the length of the video.
+Each window is extracted with one extra frame of overlap so the pair at the chunk edge
+is still interpolated, then encoded to a segment and its frames are deleted.
+The segments are joined with ffmpeg's concat demuxer at the end.
+"""
+# Built-in modules
+import os
+import pathlib
+import shutil
+# Local modules
+import ffmpeg
+import ffprobe
+import interpolator
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def interpolate_chunked(input_file, output_file, framerate, multiplier, interpolator_engine,
+                        working_folder, chunk_size=DEFAULT_CHUNK_SIZE, video_type="mp4", stream_metadata=None,
+                        **kwargs):
+    """Run steps 1-3 on windows of chunk_size frames and concat the encoded segments into output_file
+    Segments that already exist are kept so an interrupted job continues from the last finished chunk
+    stream_metadata: ffprobe.analyze_video_stream_metadata() of input_file if the caller already has it
+    """
+    if chunk_size < 1:
+        raise ValueError("Chunk size must be at least 1")
+    folderChunks = os.path.join(working_folder, "chunks")
+    folderChunkOriginal = os.path.join(folderChunks, "original_frames")
+    folderChunkInterpolated = os.path.join(folderChunks, "interpolated_frames")
+    pathlib.Path(folderChunks).mkdir(parents=True, exist_ok=True)
+    if stream_metadata is None:  # Probed once instead of once per chunk
+        stream_metadata = ffprobe.analyze_video_stream_metadata(input_file)
+
+    segmentFiles = []
+    chunkStart = 0
+    while True:
+        segmentFile = os.path.join(folderChunks, "segment_{:06d}.{}".format(len(segmentFiles), video_type))
+        segmentLastFile = os.path.join(folderChunks, "segment_{:06d}.last".format(len(segmentFiles)))
+        if os.path.isfile(segmentFile):  # Finished by a previous run
+            print("Chunk {}: segment already encoded, skipping".format(len(segmentFiles)))
+            segmentFiles.append(segmentFile)
+            if os.path.isfile(segmentLastFile):
+                break
+            chunkStart += chunk_size
+            continue
+
+        # Step 1: Extract the window plus one frame of overlap
+        print("\nChunk {}: Extracting frames {}-{}".format(len(segmentFiles), chunkStart, chunkStart + chunk_size))
+        for folder in (folderChunkOriginal, folderChunkInterpolated):
+            if os.path.isdir(folder):
+                shutil.rmtree(folder)
+        # Raises if ffmpeg fails, a short window is then the end of the video and not a truncated extraction
+        ffmpeg.extract_frames(input_file, folderChunkOriginal, start_frame=chunkStart, frame_count=chunk_size + 1,
+                              stream_metadata=stream_metadata)
+        extractedCount = len(os.listdir(folderChunkOriginal))
+        if extractedCount == 0:  # Previous chunk ended exactly at the end of the video
+            if not segmentFiles:
+                raise RuntimeError("No frames extracted from \"{}\"".format(input_file))
+            pathlib.Path(segmentFiles[-1][:-len(video_type)] + "last").touch()
+            break
+        lastChunk = extractedCount <= chunk_size
+
+        # Step 2: Interpolate the window, the overlap frame's outputs belong to the next chunk
+        if extractedCount == 1:  # Nothing to interpolate, duplicate the frame to keep N * multiplier frames
+            pathlib.Path(folderChunkInterpolated).mkdir(parents=True, exist_ok=True)
+            firstFrame = os.path.join(folderChunkOriginal, sorted(os.listdir(folderChunkOriginal))[0])
+            for i in range(multiplier):
+                shutil.copyfile(firstFrame, os.path.join(folderChunkInterpolated, "{:08d}.png".format(i + 1)))
+        else:
+            interpolator.interpolate_static(folderChunkOriginal, folderChunkInterpolated, multiplier,
+                                            interpolator_engine, **kwargs)
+
+        # Step 3: Encode the segment, written to a temporary name so a crash can't leave a partial segment
+        encodeCount = (extractedCount if lastChunk else extractedCount - 1) * multiplier
+        segmentTempFile = os.path.join(folderChunks, "segment_temp.{}".format(video_type))
+        try:
+            ffmpeg.encode_frames(folderChunkInterpolated, segmentTempFile, framerate, frame_count=encodeCount)
+        except RuntimeError:
+            if os.path.isfile(segmentTempFile):
+                os.remove(segmentTempFile)
+            raise
+        if lastChunk:
+            pathlib.Path(segmentLastFile).touch()
+        os.replace(segmentTempFile, segmentFile)
+        segmentFiles.append(segmentFile)
+
+        # Frames of this chunk are no longer needed
+        shutil.rmtree(folderChunkOriginal)
+        shutil.rmtree(folderChunkInterpolated)
+        if lastChunk:
+            break
+        chunkStart += chunk_size
+
+    print("\nJoining {} segments...".format(len(segmentFiles)))
+    ffmpeg.concat_videos(segmentFiles, output_file)
+    shutil.rmtree(folderChunks)
@@ -9,8 +9,7 @@ import shutil
 import subprocess
 # Local modules
 import definitions
-# External modules
-from alive_progress import alive_bar
+import progress
 
 # Interpolation Defaults
 DEFAULT_TIME_STEP = 0.5
@@ -39,10 +38,13 @@ def interpolate_file_mode(input0_file, input1_file, output_file, time_step=DEFAU
 
 def interpolate_folder_mode(input_folder, output_folder, multiplier=DEFAULT_MULTIPLIER,
                             tile_size=DEFAULT_TILE_SIZE, gpu_id=DEFAULT_GPU_ID, threads=DEFAULT_THREADS,
-                            verbose=False):
-    """Folder-mode Interpolation"""
+                            verbose=False, show_progress=True, target_frames=None):
+    """Folder-mode Interpolation
+    target_frames overrides the multiplier with an exact output frame count
+    """
     # Calculate double input frames as default
-    target_frames = len(os.listdir(input_folder)) * int(multiplier)
+    if target_frames is None:
+        target_frames = len(os.listdir(input_folder)) * int(multiplier)
 
     if os.path.isdir(output_folder):  # Delete output_folder if it exists to avoid conflicts
         shutil.rmtree(output_folder)
@@ -59,14 +61,15 @@ def interpolate_folder_mode(input_folder, output_folder, multiplier=DEFAULT_MULT
     if verbose is True:
         print(" ".join(cmd))
     # subprocess.run(cmd, cwd=definitions.DAIN_NCNN_VULKAN_LOCATION)
-    with alive_bar(target_frames, enrich_print=False) as bar:
+    # Progress bar can be disabled when several engine processes run at once
+    with progress.StageProgress("dain-ncnn", target_frames, show_bar=show_progress) as stageProgress:
         with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                               cwd=definitions.DAIN_NCNN_VULKAN_LOCATION, bufsize=1, universal_newlines=True) as process:
             for line in process.stderr:
                 if line.startswith("["):  # Starting GPU info
                     print(line, end="")
                 elif line.endswith("done\n"):  # Verbose progress output
-                    bar()
+                    stageProgress.advance()
                 elif line.startswith("invalid tilesize argument"):  # Tilesize error
                     raise ValueError(line.replace("\n", ""))
                 elif line.startswith(("find_blob_index_by_name", "fopen")):  # Model not found error
@@ -77,3 +80,5 @@ def interpolate_folder_mode(input_folder, output_folder, multiplier=DEFAULT_MULT
                     raise RuntimeError("Vulkan error: {}".format(line.replace("\n", "")))
                 else:
                     print(line, end="")
+        if process.wait() != 0:  # Crashes without one of the errors above
+            raise RuntimeError("dain-ncnn-vulkan exited with code {}".format(process.returncode))
@@ -13,14 +13,16 @@ DEFAULT_INTERPOLATOR_MODE = "static"
 DEFAULT_INTERPOLATOR_ENGINE = "dain-ncnn"
 DEFAULT_LOOP = False
 DEFAULT_VIDEO_TYPE = "mp4"
+DEFAULT_PIPELINE = "folder"
+DEFAULT_INTERMEDIATE_FORMAT = "png"
 
-# Dain-ncnn-vulkan binary locations
+# Dain-ncnn-vulkan binary locations (engine binaries can be overridden with environment variables, eg. with stubs)
 DAIN_NCNN_VULKAN = {
     "Windows": os.path.join(ROOT_DIR, "dependencies", "dain-ncnn-vulkan", "dain-ncnn-vulkan.exe"),
     "Darwin": os.path.join(ROOT_DIR, "dependencies", "dain-ncnn-vulkan", "dain-ncnn-vulkan-macos"),
     "Linux": os.path.join(ROOT_DIR, "dependencies", "dain-ncnn-vulkan", "dain-ncnn-vulkan-ubuntu")
 }
-DAIN_NCNN_VULKAN_BIN = DAIN_NCNN_VULKAN[system()]
+DAIN_NCNN_VULKAN_BIN = os.environ.get("DAIN_NCNN_VULKAN_BIN", DAIN_NCNN_VULKAN[system()])
 DAIN_NCNN_VULKAN_LOCATION = os.path.dirname(DAIN_NCNN_VULKAN_BIN)
 
 # Cain-ncnn-vulkan binary locations
@@ -29,7 +31,7 @@ CAIN_NCNN_VULKAN = {
     "Darwin": os.path.join(ROOT_DIR, "dependencies", "cain-ncnn-vulkan", "cain-ncnn-vulkan-macos"),
     "Linux": os.path.join(ROOT_DIR, "dependencies", "cain-ncnn-vulkan", "cain-ncnn-vulkan-ubuntu")
 }
-CAIN_NCNN_VULKAN_BIN = CAIN_NCNN_VULKAN[system()]
+CAIN_NCNN_VULKAN_BIN = os.environ.get("CAIN_NCNN_VULKAN_BIN", CAIN_NCNN_VULKAN[system()])
 CAIN_NCNN_VULKAN_LOCATION = Path(CAIN_NCNN_VULKAN_BIN).parent
 
 # Rife-ncnn-vulkan binary locations
@@ -38,7 +40,7 @@ RIFE_NCNN_VULKAN = {
     "Darwin": os.path.join(ROOT_DIR, "dependencies", "rife-ncnn-vulkan", "rife-ncnn-vulkan-macos"),
     "Linux": os.path.join(ROOT_DIR, "dependencies", "rife-ncnn-vulkan", "rife-ncnn-vulkan-ubuntu")
 }
-RIFE_NCNN_VULKAN_BIN = RIFE_NCNN_VULKAN[system()]
+RIFE_NCNN_VULKAN_BIN = os.environ.get("RIFE_NCNN_VULKAN_BIN", RIFE_NCNN_VULKAN[system()])
 RIFE_NCNN_VULKAN_LOCATION = Path(RIFE_NCNN_VULKAN_BIN).parent
 
 # FFmpeg binary locations
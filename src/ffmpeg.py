@@ -3,94 +3,452 @@ FFmpeg process wrapper
 """
 # Built-in modules
 # import logging
+import math
 import os
 import pathlib
+import platform
 import re
+import shutil
 import subprocess
+import threading
 # Local modules
 import definitions
 import ffprobe
+import frame_store
+import progress
 # External modules
 from alive_progress import alive_bar
 
+TIMESTAMP_INDEX_FILENAME = "frame_timestamps.csv"
+DEFAULT_SEGMENT_GOP = 250  # Keyframe interval of segmented encodes (x264's default)
+# Frame line of the showinfo filter, duration_time is only logged by newer ffmpeg versions
+SHOWINFO_PATTERN = re.compile(r"Parsed_showinfo.*\bn:\s*\d+\s+pts:\s*-?\d+\s+pts_time:(-?[\d.]+)"
+                              r"(?:.*?\bduration_time:(-?[\d.]+))?")
 
-def extract_frames(input_file, output_folder, verbose=False):
+# Encoder options for each intermediate frame format, all of them are lossless
+INTERMEDIATE_FORMATS = {
+    "png": ["-pix_fmt", "rgb24"],  # Usually defaults to rgba which causes alpha problems
+    "bmp": ["-pix_fmt", "bgr24"],  # Uncompressed
+    "ppm": ["-pix_fmt", "rgb24"],  # Uncompressed
+    "webp": ["-c:v", "libwebp", "-lossless", "1"]
+}
+# Intermediate formats the ncnn engines can't load on a platform (the Windows builds read images through WIC,
+# which has no ppm codec)
+ENGINE_UNREADABLE_FORMATS = {"Windows": ("ppm",)}
+
+
+def engine_intermediate_formats():
+    """Intermediate formats the interpolation engines can read on this platform"""
+    unreadableFormats = ENGINE_UNREADABLE_FORMATS.get(platform.system(), ())
+    return [imageFormat for imageFormat in INTERMEDIATE_FORMATS if imageFormat not in unreadableFormats]
+
+
+def _intermediate_format_options(image_format, png_compression=None):
+    if image_format not in INTERMEDIATE_FORMATS:
+        raise ValueError("Invalid intermediate format: {} (available: {})".format(image_format,
+                                                                                 ", ".join(INTERMEDIATE_FORMATS)))
+    options = list(INTERMEDIATE_FORMATS[image_format])
+    if (image_format == "png") and (png_compression is not None):
+        options.extend(["-compression_level", str(png_compression)])  # zlib level 0-9
+    return options
+
+
+def _filter_options(scale=None, filters=()):
+    """
+    -vf for a scale factor followed by filters, sizes are kept even since most encoders need that for yuv420p
+    """
+    videoFilters = list(filters)
+    if (scale is not None) and (scale != 1):
+        videoFilters.insert(0, "scale=trunc(iw*{0}/2)*2:trunc(ih*{0}/2)*2:flags=area".format(scale))
+    return ["-vf", ",".join(videoFilters)] if videoFilters else []
+
+
+def _detect_frame_format(input_folder):
+    """Extension of the numbered frames in a folder, eg. "png" """
+    for file in sorted(os.listdir(input_folder)):
+        if file[:1].isdigit():
+            return os.path.splitext(file)[1][1:]
+    return "png"
+
+
+def _run_ffmpeg(cmd, on_frames, verbose=False, on_stderr=None):
+    """Runs ffmpeg with machine readable progress (-progress pipe:1), on_frames(frames done) is called as it goes
+    on_stderr(line): called with every stderr line (eg. filter logs), lines it returns True for aren't kept
+    Returns (return code, stderr output)
+    """
+    cmd = cmd[:1] + ["-progress", "pipe:1", "-nostats"] + cmd[1:]
+    if verbose is True:
+        print(" ".join(cmd))
+    stderrLines = []
+    pipeStderr = (verbose is False) or (on_stderr is not None)
+
+    def read_stderr():
+        for line in process.stderr:
+            if (on_stderr is not None) and on_stderr(line):
+                continue
+            if verbose is True:
+                print(line, end="")
+            else:
+                stderrLines.append(line)
+
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE if pipeStderr else None,
+                          bufsize=1, universal_newlines=True) as process:
+        if pipeStderr is True:  # Drained on a thread so a full stderr pipe can't block ffmpeg
+            stderrThread = threading.Thread(target=read_stderr, daemon=True)
+            stderrThread.start()
+        for line in process.stdout:  # Blocks of key=value lines, each ending with progress=continue/end
+            key, _, value = line.strip().partition("=")
+            if (key == "frame") and value.isdigit():
+                on_frames(int(value))
+        if pipeStderr is True:
+            stderrThread.join()
+    return process.returncode, "".join(stderrLines)
+
+
+def _run_with_progress(cmd, stage, frames_total=None, verbose=False, on_stderr=None):
+    """Runs ffmpeg reporting its progress through progress.StageProgress
+    frames_total: None when it isn't known (eg. vfr extraction)
+    Returns ffmpeg's return code
+    """
+    with progress.StageProgress(stage, frames_total) as stageProgress:
+        returnCode, stderrOutput = _run_ffmpeg(cmd, stageProgress.update, verbose=verbose, on_stderr=on_stderr)
+        if returnCode != 0:
+            print(stderrOutput, end="")
+            stageProgress.error("FFmpeg exited with code {}".format(returnCode))
+    return returnCode
+
+
+def extract_frames(input_file, output_folder, start_frame=None, frame_count=None, image_format="png",
+                   png_compression=None, stream_metadata=None, scale=None, verbose=False):
     """Extract video frames to a folder
     for -vsync: "crf" will use "r_frame_rate", "vfr" will use "avg_frame_rate"
+    start_frame/frame_count extract a window of the video (used by chunked processing and previews)
+    image_format: one of INTERMEDIATE_FORMATS, png_compression: zlib level for png (default: ffmpeg's)
+    stream_metadata: ffprobe.analyze_video_stream_metadata() of input_file if the caller already has it
+    scale: resize the frames by this factor while decoding (eg. 0.5 for half resolution previews)
     `ffmpeg -i "$i" original_frames/%06d.png`
     """
-    # TODO add downscaling option
-    stream_metadata = ffprobe.analyze_video_stream_metadata(input_file)
-    frame_count = int(stream_metadata["packetCount"])
+    if stream_metadata is None:
+        stream_metadata = ffprobe.analyze_video_stream_metadata(input_file)
+    frame_count_total = int(stream_metadata["packetCount"])
     vfrBool = (stream_metadata["fpsReal"] != stream_metadata["fpsAverage"])  # Video is cfr when average fps = real fps
 
     pathlib.Path(output_folder).mkdir(parents=True, exist_ok=True)  # Create outputFolder
+    cmd = [definitions.FFMPEG_BIN]
+    if start_frame:
+        # Seek a quarter frame early so rounding can't skip the first frame of the window
+        fracNum, fracDenom = stream_metadata["fpsReal"].split("/")
+        cmd.extend(["-ss", "{:.6f}".format((start_frame - 0.25) * int(fracDenom) / int(fracNum))])
+        frame_count_total = max(frame_count_total - start_frame, 0)
+    cmd.extend(["-i", input_file,
+                "-vsync", "cfr"])
+    cmd.extend(_filter_options(scale))
+    cmd.extend(_intermediate_format_options(image_format, png_compression))
+    if frame_count is not None:
+        cmd.extend(["-frames:v", str(frame_count)])
+        frame_count_total = min(frame_count_total, frame_count)
+    cmd.append(os.path.join(output_folder, "%08d." + image_format))
+    # Frame count isn't known in advance for vfr videos since frames are duplicated/dropped to make them cfr
+    returnCode = _run_with_progress(cmd, "extract", None if vfrBool else frame_count_total, verbose=verbose)
+    if returnCode != 0:
+        raise RuntimeError("FFmpeg extraction failed with exit code {}".format(returnCode))
+
+
+def extract_frames_vfr(input_file, output_folder, index_file, image_format="png", png_compression=None,
+                       stream_metadata=None, scale=None, verbose=False):
+    """Extract only the real frames of a (vfr) video, without padding it to cfr with duplicates
+    The presentation time of every frame is written to index_file ("pts,duration" per frame in seconds, frame n is
+    line n), logged by a showinfo filter in the same ffmpeg process so frames the decoder drops can't shift them
+    scale: resize the frames by this factor while decoding
+    Returns the number of frames extracted
+    `ffmpeg -i input.mp4 -vsync passthrough -vf showinfo original_frames/%08d.png`
+    """
+    if stream_metadata is None:
+        stream_metadata = ffprobe.analyze_video_stream_metadata(input_file)
+    pathlib.Path(output_folder).mkdir(parents=True, exist_ok=True)
+    frameTimes = []  # (pts, duration or None) of every frame written, in order
+
+    def read_showinfo(line):
+        match = SHOWINFO_PATTERN.search(line)
+        if match is None:
+            return False
+        frameTimes.append((float(match.group(1)), None if match.group(2) is None else float(match.group(2))))
+        return True
+
     cmd = [definitions.FFMPEG_BIN,
            "-i", input_file,
-           "-vsync", "cfr",
-           "-pix_fmt", "rgb24",  # Usually defaults to rgba which causes alpha problems
-           os.path.join(output_folder, "%08d.png")]
-    if verbose is True:
-        print(" ".join(cmd))
-    # subprocess.run(cmd)
-    if vfrBool is True:
-        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                              bufsize=1, universal_newlines=True) as process:
-            for line in process.stderr:
-                if line.startswith("frame="):
-                    print(line, end="")
-    else:
-        with alive_bar(frame_count, enrich_print=False) as bar:
-            frame_count_processed_last = 0
-            with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                  bufsize=1, universal_newlines=True) as process:
-                for line in process.stderr:
-                    if line.startswith("frame="):
-                        # Parses inbetween "frame=" and "fps="
-                        frame_count_processed = int(re.findall(r"frame=(.+?)fps=", line)[0])
-                        bar(incr=(frame_count_processed - frame_count_processed_last))
-                        frame_count_processed_last = frame_count_processed
-                    elif verbose is True:
-                        print(line, end="")
-
-
-def encode_frames(input_folder, output_file, framerate, verbose=False):
+           "-vsync", "passthrough"]  # Every decoded frame once, whatever its timestamp
+    cmd.extend(_filter_options(scale, ["showinfo"]))  # Logs the pts of every frame that reaches the output
+    cmd.extend(_intermediate_format_options(image_format, png_compression))
+    cmd.append(os.path.join(output_folder, "%08d." + image_format))
+    returnCode = _run_with_progress(cmd, "extract", int(stream_metadata["packetCount"]), verbose=verbose,
+                                    on_stderr=read_showinfo)
+    if returnCode != 0:
+        raise RuntimeError("FFmpeg extraction failed with exit code {}".format(returnCode))
+
+    frameCount = len(os.listdir(output_folder))
+    if len(frameTimes) != frameCount:
+        raise RuntimeError("{} frames extracted but {} timestamps logged, frame timing would be off".format(
+            frameCount, len(frameTimes)))
+    # Frames without a duration (older ffmpeg) last until the next frame, the last one as long as the one before
+    with open(index_file, "w") as file:
+        for i, (pts, duration) in enumerate(frameTimes):
+            if duration is None:
+                if i + 1 < len(frameTimes):
+                    duration = frameTimes[i + 1][0] - pts
+                else:
+                    duration = pts - frameTimes[i - 1][0] if i > 0 else 0.0
+            file.write("{:.6f},{:.6f}\n".format(pts, duration))
+    return frameCount
+
+
+def read_timestamp_index(index_file):
+    """Returns (pts of every frame, end time of the last frame) from an extract_frames_vfr index"""
+    timestamps = []
+    endTime = 0.0
+    with open(index_file) as file:
+        for line in file:
+            pts, duration = (float(field) for field in line.split(","))
+            timestamps.append(pts)
+            endTime = max(endTime, pts + duration)
+    return timestamps, endTime
+
+
+def _encoder_options(preset=None, threads=None, gop=None):
+    cmd = ["-crf", "18"]
+    if preset is not None:
+        cmd.extend(["-preset", preset])
+    if threads is not None:
+        cmd.extend(["-threads", str(threads)])
+    if gop is not None:
+        cmd.extend(["-g", str(gop)])
+    return cmd
+
+
+def encode_frames(input_folder, output_file, framerate, frame_count=None, image_format=None, preset=None,
+                  threads=None, segments=1, verbose=False):
     """Encode a folder of sequentially named frames into a video
+    If frame_count is specified only the first frame_count frames are encoded
+    image_format: extension of the frames, detected from the folder by default
+    preset: encoder preset (eg. x264's ultrafast-veryslow), threads: encoder threads (default: ffmpeg's)
+    segments: encode this many GOP-aligned parts of the frames at once and join them (see encode_frames_segmented)
     `ffmpeg -framerate 48 -i interpolated_frames/%06d.png -crf 18 output.mp4`
     """
     # TODO add an option for changing quality
-    frame_count = len(os.listdir(input_folder))
+    if frame_count is None:
+        frame_count = len(os.listdir(input_folder))
+    if image_format is None:
+        image_format = _detect_frame_format(input_folder)
+    if segments > 1:
+        encode_frames_segmented(input_folder, output_file, framerate, segments, frame_count, image_format,
+                                preset=preset, threads=threads, verbose=verbose)
+        return
+    pathlib.Path(os.path.dirname(output_file)).mkdir(parents=True, exist_ok=True)  # Create parent folder of outputFile
+    cmd = [definitions.FFMPEG_BIN,
+           "-framerate", str(framerate),
+           "-i", os.path.join(input_folder, "%08d." + image_format),
+           "-frames:v", str(frame_count)]
+    cmd.extend(_encoder_options(preset, threads))
+    cmd.extend(["-y",  # Always write file
+                output_file])
+    returnCode = _run_with_progress(cmd, "encode", frame_count, verbose=verbose)
+    if returnCode != 0:
+        raise RuntimeError("FFmpeg encoding failed with exit code {}".format(returnCode))
+
+
+def plan_segments(frame_count, segments, gop=DEFAULT_SEGMENT_GOP):
+    """Splits frames 1-frame_count into at most segments (start number, frame count) ranges
+    Every range but the last is a whole number of GOPs so segments start where a keyframe would be anyway
+    """
+    gopCount = math.ceil(frame_count / gop)
+    segmentCount = max(1, min(segments, gopCount))
+    # GOPs are spread evenly, segment i starts at GOP gopCount * i // segmentCount
+    bounds = [gop * (gopCount * i // segmentCount) for i in range(segmentCount)] + [frame_count]
+    return [(start + 1, end - start) for start, end in zip(bounds, bounds[1:])]
+
+
+def encode_frames_segmented(input_folder, output_file, framerate, segments, frame_count=None, image_format=None,
+                            preset=None, threads=None, gop=DEFAULT_SEGMENT_GOP, verbose=False):
+    """Encodes GOP-aligned ranges of the frames with one ffmpeg process each at the same time
+    then joins them losslessly with the concat demuxer, for machines where one encoder doesn't use every core
+    threads: encoder threads per segment (default: cores / segments)
+    `ffmpeg -framerate 48 -start_number 501 -i interpolated_frames/%08d.png -frames:v 500 -g 250 segment.mp4`
+    """
+    if frame_count is None:
+        frame_count = len(os.listdir(input_folder))
+    if frame_count <= 0:
+        raise ValueError("No frames to encode in \"{}\"".format(input_folder))
+    if image_format is None:
+        image_format = _detect_frame_format(input_folder)
+    segmentRanges = plan_segments(frame_count, segments, gop)
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // len(segmentRanges))
+    folderSegments = output_file + ".segments"
+    pathlib.Path(folderSegments).mkdir(parents=True, exist_ok=True)
+    segmentFiles = [os.path.join(folderSegments, "segment_{:04d}{}".format(i, os.path.splitext(output_file)[1]))
+                    for i in range(len(segmentRanges))]
+    print("Encoding {} segments of up to {} frames, {} threads each".format(len(segmentRanges),
+                                                                          segmentRanges[0][1], threads))
+
+    framesDone = [0] * len(segmentRanges)
+    failures = []
+    lock = threading.Lock()
+    with progress.StageProgress("encode", frame_count) as stageProgress:
+        def encode_segment(i):
+            startNumber, segmentFrameCount = segmentRanges[i]
+            cmd = [definitions.FFMPEG_BIN,
+                   "-framerate", str(framerate),
+                   "-start_number", str(startNumber),
+                   "-i", os.path.join(input_folder, "%08d." + image_format),
+                   "-frames:v", str(segmentFrameCount)]
+            cmd.extend(_encoder_options(preset, threads, gop))
+            cmd.extend(["-y", segmentFiles[i]])
+
+            def segment_frames(frames):
+                with lock:
+                    framesDone[i] = frames
+                    stageProgress.update(sum(framesDone))
+
+            returnCode, stderrOutput = _run_ffmpeg(cmd, segment_frames, verbose=verbose)
+            if returnCode != 0:
+                with lock:
+                    failures.append("Segment {} exited with code {}\n{}".format(i, returnCode, stderrOutput))
+
+        segmentThreads = [threading.Thread(target=encode_segment, args=(i,)) for i in range(len(segmentRanges))]
+        for thread in segmentThreads:
+            thread.start()
+        for thread in segmentThreads:
+            thread.join()
+        if failures:
+            shutil.rmtree(folderSegments)
+            raise RuntimeError("FFmpeg failed to encode {} of {} segments\n{}".format(
+                len(failures), len(segmentFiles), "".join(failures)))
+
+    pathlib.Path(os.path.dirname(output_file)).mkdir(parents=True, exist_ok=True)
+    concat_videos(segmentFiles, output_file, verbose=verbose)
+    shutil.rmtree(folderSegments)
+
+
+def decode_frames_raw(input_file, width, height, verbose=False):
+    """Decode a video to raw rgb24 frames on stdout and yield them one at a time
+    `ffmpeg -i input.mp4 -vsync cfr -f rawvideo -pix_fmt rgb24 pipe:1`
+    """
+    frame_size = width * height * 3
+    cmd = [definitions.FFMPEG_BIN,
+           "-i", input_file,
+           "-vsync", "cfr",
+           "-f", "rawvideo",
+           "-pix_fmt", "rgb24",
+           "-loglevel", "error",
+           "pipe:1"]
+    if verbose is True:
+        print(" ".join(cmd))
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=frame_size) as process:
+        while True:
+            frame = process.stdout.read(frame_size)
+            if len(frame) < frame_size:  # End of stream (or a truncated last frame)
+                break
+            yield frame
+        process.stdout.close()
+        if process.wait() != 0:
+            raise RuntimeError("FFmpeg decoding failed with exit code {}".format(process.returncode))
+
+
+def encode_frames_raw(output_file, width, height, framerate, verbose=False):
+    """Start an encoder that reads raw rgb24 frames from stdin
+    Frames are written to the returned process' stdin, closing it finishes the video
+    `ffmpeg -f rawvideo -pix_fmt rgb24 -s 1920x1080 -framerate 48 -i pipe:0 -crf 18 output.mp4`
+    """
     pathlib.Path(os.path.dirname(output_file)).mkdir(parents=True, exist_ok=True)  # Create parent folder of outputFile
     cmd = [definitions.FFMPEG_BIN,
+           "-f", "rawvideo",
+           "-pix_fmt", "rgb24",
+           "-s", "{}x{}".format(width, height),
            "-framerate", str(framerate),
-           "-i", os.path.join(input_folder, "%08d.png"),
+           "-i", "pipe:0",
            "-crf", "18",
+           "-loglevel", "error",
            "-y",  # Always write file
            output_file]
     if verbose is True:
         print(" ".join(cmd))
-    # subprocess.run(cmd)
-    with alive_bar(frame_count, enrich_print=False) as bar:
-        frame_count_processed_last = 0
-        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                              bufsize=1, universal_newlines=True) as process:
-            for line in process.stderr:
-                if line.startswith("frame="):
-                    # Parses inbetween "frame=" and "fps="
-                    frame_count_processed = int(re.findall(r"frame=(.+?)fps=", line)[0])
-                    bar(incr=(frame_count_processed - frame_count_processed_last))
-                    frame_count_processed_last = frame_count_processed
-                elif verbose is True:
-                    print(line, end="")
-
-
-def combine_video_audio(video_file, audio_file, output_file):
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+
+def encode_frames_pipe(output_file, framerate, preset=None, threads=None, verbose=False):
+    """Start an encoder that reads image files (eg. whole pngs) one after the other from stdin
+    Frames are written to the returned process' stdin, closing it finishes the video
+    `ffmpeg -f image2pipe -framerate 48 -i pipe:0 -crf 18 output.mp4`
+    """
+    pathlib.Path(os.path.dirname(output_file)).mkdir(parents=True, exist_ok=True)  # Create parent folder of outputFile
+    cmd = [definitions.FFMPEG_BIN,
+           "-f", "image2pipe",
+           "-framerate", str(framerate),
+           "-i", "pipe:0"]
+    cmd.extend(_encoder_options(preset, threads))
+    cmd.extend(["-loglevel", "error",
+                "-y",  # Always write file
+                output_file])
+    if verbose is True:
+        print(" ".join(cmd))
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+
+def encode_frame_store(store_path, output_file, framerate, verbose=False):
+    """Encode the live frames of a frame store, frames are piped to ffmpeg straight from the memory-mapped file"""
+    with frame_store.FrameStore(store_path) as store:
+        indices = store.live_indices()
+        process = encode_frames_raw(output_file, store.width, store.height, framerate, verbose=verbose)
+        try:
+            with alive_bar(len(indices), enrich_print=False) as bar:
+                for i in indices:
+                    process.stdin.write(store.frame_bytes(i))
+                    bar()
+        finally:
+            process.stdin.close()
+            if process.wait() != 0:
+                raise RuntimeError("FFmpeg encoding failed with exit code {}".format(process.returncode))
+
+
+def combine_video_audio(video_file, audio_file, output_file, audio_start=None):
+    """
+    audio_start: seconds of audio_file to skip, the audio is also cut to the length of the video
+    (eg. previews of a part of the video)
+    """
     # ffmpeg -i video.mp4 -i audio.webm -c:v copy -map 0:v:0 -map 1:a:0 output.mp4
     cmd = [definitions.FFMPEG_BIN,
-           "-i", video_file,
-           "-i", audio_file,
-           "-c:v", "copy",  # Don't reencode video stream
-           "-map", "0:v:0",
-           "-map", "1:a:0",
-           output_file]
+           "-i", video_file]
+    if audio_start is not None:
+        cmd.extend(["-ss", str(audio_start)])
+    cmd.extend(["-i", audio_file,
+                "-c:v", "copy",  # Don't reencode video stream
+                "-map", "0:v:0",
+                "-map", "1:a:0"])
+    if audio_start is not None:
+        cmd.append("-shortest")
+    cmd.append(output_file)
     subprocess.run(cmd)
+
+
+def concat_videos(input_files, output_file, verbose=False):
+    """Losslessly join videos with identical encoding settings using the concat demuxer
+    `ffmpeg -f concat -safe 0 -i list.txt -c copy output.mp4`
+    """
+    pathlib.Path(os.path.dirname(output_file)).mkdir(parents=True, exist_ok=True)  # Create parent folder of outputFile
+    listFile = output_file + ".concat.txt"
+    with open(listFile, "w") as file:
+        for input_file in input_files:
+            # Single quotes are escaped as '\'' by the concat demuxer
+            file.write("file '{}'\n".format(os.path.abspath(input_file).replace("'", "'\\''")))
+    cmd = [definitions.FFMPEG_BIN,
+           "-f", "concat",
+           "-safe", "0",  # Allow absolute paths
+           "-i", listFile,
+           "-c", "copy",
+           "-loglevel", "error",
+           "-y",  # Always write file
+           output_file]
+    if verbose is True:
+        print(" ".join(cmd))
+    subprocess.run(cmd, check=True)
+    os.remove(listFile)
@@ -7,34 +7,94 @@ FFprobe process wrapper
 http://svn.ffmpeg.org/doxygen/trunk/structAVStream.html
 "avg_frame_rate" is "Average framerate" aka: duration/framecount
 "r_frame_rate" is "Real base framerate" which is the lowest common framerate of all frames in the video
+
+Counting packets (-count_packets) reads the whole file, so the frame count is taken from the container's
+"nb_frames" or stream duration when it reports them and the video is cfr, packets are only counted otherwise.
+Results can be cached (eg. in info.json) keyed by a fingerprint of the input file.
 """
 # Built-in modules
+import hashlib
 import json
 import logging
+import os
 import subprocess
 # Local modules
 import definitions
 
+FINGERPRINT_SAMPLES = 8  # Chunks hashed evenly across the file
+FINGERPRINT_SAMPLE_SIZE = 1024 * 1024
 
-def analyze_video_stream_metadata(input_file):
-    """Analyzes a video's stream and returns it's properties
-    `ffprobe -show_streams -select_streams v:0 -count_packets -print_format json -loglevel quiet input.mp4`
-    """
+
+def fingerprint_file(input_file):
+    """Identifies a file without reading all of it: size, mtime and a sha1 of chunks sampled across it"""
+    fileSize = os.path.getsize(input_file)
+    sha1 = hashlib.sha1(str(fileSize).encode())
+    with open(input_file, "rb") as file:
+        if fileSize <= FINGERPRINT_SAMPLES * FINGERPRINT_SAMPLE_SIZE:
+            sha1.update(file.read())
+        else:
+            for i in range(FINGERPRINT_SAMPLES):  # First and last chunks included
+                file.seek((fileSize - FINGERPRINT_SAMPLE_SIZE) * i // (FINGERPRINT_SAMPLES - 1))
+                sha1.update(file.read(FINGERPRINT_SAMPLE_SIZE))
+    return {"size": fileSize, "mtime": os.path.getmtime(input_file), "sha1": sha1.hexdigest()}
+
+
+def _probe_stream(input_file, count_packets=False):
     cmd = [definitions.FFPROBE_BIN,
            "-show_streams",
-           "-select_streams", "v:0",
-           "-count_packets",
-           "-print_format", "json",
-           "-loglevel", "quiet",
-           input_file]
+           "-select_streams", "v:0"]
+    if count_packets is True:
+        cmd.append("-count_packets")
+    cmd.extend(["-print_format", "json",
+                "-loglevel", "quiet",
+                input_file])
     logging.info(" ".join(cmd))
     output = subprocess.check_output(cmd, universal_newlines=True)
-    parsed_output = json.loads(output)["streams"][0]
-    return({
+    return json.loads(output)["streams"][0]
+
+
+def _reported_frame_count(stream):
+    """Frame count from the container headers, None when it isn't reported or can't be trusted (vfr)"""
+    if stream["r_frame_rate"] != stream["avg_frame_rate"]:
+        return None
+    if stream.get("nb_frames", "0").isdigit() and int(stream.get("nb_frames", "0")) > 0:
+        return int(stream["nb_frames"]), "nb_frames"
+    fracNum, fracDenom = stream["avg_frame_rate"].split("/")
+    if (stream.get("duration") not in (None, "N/A")) and (int(fracDenom) > 0):
+        return round(float(stream["duration"]) * int(fracNum) / int(fracDenom)), "duration"
+    return None
+
+
+def analyze_video_stream_metadata(input_file, cache=None, fingerprint=None):
+    """Analyzes a video's stream and returns it's properties
+    `ffprobe -show_streams -select_streams v:0 -print_format json -loglevel quiet input.mp4`
+    cache: dict the result is stored in (eg. part of info.json), reused while the input's fingerprint matches
+    fingerprint: fingerprint_file(input_file) if it's already been calculated
+    """
+    if cache is not None:
+        if fingerprint is None:
+            fingerprint = fingerprint_file(input_file)
+        if (cache.get("fingerprint") == fingerprint) and ("stream" in cache):
+            logging.info("FFprobe: using cached metadata of {}".format(input_file))
+            return cache["stream"]
+
+    parsed_output = _probe_stream(input_file)
+    reportedFrameCount = _reported_frame_count(parsed_output)
+    if reportedFrameCount is None:  # Read the whole file
+        parsed_output = _probe_stream(input_file, count_packets=True)
+        reportedFrameCount = int(parsed_output["nb_read_packets"]), "count_packets"
+    metadata = {
         "fpsReal": parsed_output["r_frame_rate"],
         "fpsAverage": parsed_output["avg_frame_rate"],
-        "packetCount": parsed_output["nb_read_packets"]  # Unreliable if video is vfr
-    })
+        "width": parsed_output["width"],
+        "height": parsed_output["height"],
+        "packetCount": reportedFrameCount[0],  # Unreliable if video is vfr
+        "packetCountSource": reportedFrameCount[1]
+    }
+    if cache is not None:
+        cache["fingerprint"] = fingerprint
+        cache["stream"] = metadata
+    return metadata
 
 
 def analyze_video_frame_metadata(input_file):
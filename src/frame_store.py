@@ -0,0 +1,186 @@
+"""
+Single-file frame store
+
+An alternative to folders of numbered PNGs: every frame is stored uncompressed (rgb24, fixed size)
+one after the other in one data file which is memory-mapped for reading, so frames are read without copying.
+A compact index file next to it holds the frame number, timestamp and flags of every frame.
+Import/export adapters convert to/from PNG folders for the ncnn binaries which only read folders.
+
+Files: <path> (raw frames) and <path>.index (header + one record per frame)
+"""
+# Built-in modules
+import os
+import pathlib
+import struct
+# Local modules
+import frame_writer
+# External modules
+from PIL import Image
+import numpy
+
+INDEX_SUFFIX = ".index"
+INDEX_MAGIC = b"DVFS"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<4sHII")  # magic, version, width, height
+INDEX_RECORD = numpy.dtype([("number", "<u4"), ("timestamp", "<f8"), ("flags", "<u1")])
+FRAME_FILENAME = "{:08d}.png"
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.ppm')
+
+FLAG_DROPPED = 1  # Removed (eg. a duplicate), readers skip it but the slot is kept
+FLAG_DUPLICATE = 2  # Copy of the frame before it (eg. filled in at the end of a non-looping video)
+
+
+class FrameStore:
+    """
+    Frame store opened for reading ("r"), for changing flags ("r+") or created for appending ("w")
+    frame(i) returns a read-only (height, width, 3) view into the memory-mapped file
+    """
+    def __init__(self, path, mode="r", width=None, height=None):
+        if mode not in ("r", "r+", "w"):
+            raise ValueError("Invalid mode: {}".format(mode))
+        self.path = os.path.abspath(path)
+        self.index_path = self.path + INDEX_SUFFIX
+        self.mode = mode
+        self._frames = None
+        self._data_file = None
+        if mode == "w":
+            if (width is None) or (height is None):
+                raise ValueError("width and height are required to create a frame store")
+            self.width, self.height = int(width), int(height)
+            self._records = []
+            pathlib.Path(os.path.dirname(self.path)).mkdir(parents=True, exist_ok=True)
+            self._data_file = open(self.path, "wb")
+        else:
+            with open(self.index_path, "rb") as file:
+                magic, version, self.width, self.height = INDEX_HEADER.unpack(file.read(INDEX_HEADER.size))
+                if (magic != INDEX_MAGIC) or (version != INDEX_VERSION):
+                    raise ValueError("\"{}\" is not a frame store index".format(self.index_path))
+                self.index = numpy.frombuffer(file.read(), dtype=INDEX_RECORD).copy()
+            if len(self.index) > 0:
+                self._frames = numpy.memmap(self.path, dtype=numpy.uint8, mode="r",
+                                            shape=(len(self.index), self.height, self.width, 3))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._records) if self.mode == "w" else len(self.index)
+
+    @property
+    def frame_size(self):
+        return self.width * self.height * 3
+
+    def append(self, frame, number=None, timestamp=None, flags=0):
+        """Adds a frame (rgb24 bytes or a (height, width, 3) uint8 array), number defaults to the next frame"""
+        if self.mode != "w":
+            raise ValueError("Frame store isn't open for appending")
+        data = frame.tobytes() if isinstance(frame, numpy.ndarray) else bytes(frame)
+        if len(data) != self.frame_size:
+            raise ValueError("Frame is {} bytes, expected {} ({}x{} rgb24)".format(len(data), self.frame_size,
+                                                                                  self.width, self.height))
+        if number is None:
+            number = self._records[-1][0] + 1 if self._records else 1
+        self._data_file.write(data)
+        self._records.append((number, numpy.nan if timestamp is None else timestamp, flags))
+
+    def frame(self, i):
+        """Zero-copy read-only view of frame i"""
+        return self._frames[i]
+
+    def frame_bytes(self, i):
+        """Zero-copy buffer of frame i (eg. for writing to a pipe)"""
+        return memoryview(self._frames[i]).cast("B")
+
+    def live_indices(self):
+        """Indices of the frames that aren't dropped"""
+        return numpy.flatnonzero((self.index["flags"] & FLAG_DROPPED) == 0).tolist()
+
+    def set_flags(self, i, flags):
+        if self.mode != "r+":
+            raise ValueError("Frame store isn't open for changing flags")
+        self.index["flags"][i] = flags
+
+    def _write_index(self, records):
+        indexTempPath = self.index_path + ".tmp"
+        with open(indexTempPath, "wb") as file:
+            file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.width, self.height))
+            file.write(records.tobytes())
+        os.replace(indexTempPath, self.index_path)  # The index is never left half written
+
+    def close(self):
+        if self.mode == "w":
+            self._data_file.close()
+            self._write_index(numpy.array(self._records, dtype=INDEX_RECORD))
+        elif self.mode == "r+":
+            self._write_index(self.index)
+        self._frames = None
+
+
+def _list_image_files(folder):
+    return sorted(os.path.join(folder, file) for file in os.listdir(folder) if file.endswith(IMAGE_EXTENSIONS))
+
+
+def import_folder(input_folder, store_path, framerate=None):
+    """Packs a folder of numbered frames into a frame store, numbers come from the filenames
+    framerate: fills in timestamps as (number - 1) / framerate
+    """
+    inputFiles = _list_image_files(input_folder)
+    if not inputFiles:
+        raise ValueError("No frames in \"{}\"".format(input_folder))
+    width, height = Image.open(inputFiles[0]).size
+    with FrameStore(store_path, "w", width, height) as store:
+        for inputFile in inputFiles:
+            number = int(pathlib.Path(inputFile).stem)
+            image = Image.open(inputFile).convert("RGB")
+            if image.size != (width, height):
+                raise ValueError("\"{}\" is {}x{}, frames must all be {}x{}".format(inputFile, *image.size,
+                                                                                 width, height))
+            store.append(image.tobytes(), number, None if framerate is None else (number - 1) / float(framerate))
+    return len(inputFiles)
+
+
+def export_folder(store_path, output_folder, include_dropped=False,
+                  png_compression=frame_writer.DEFAULT_PNG_COMPRESSION):
+    """Unpacks a frame store into numbered PNGs (numbered by frame number, so dropped frames leave gaps)"""
+    pathlib.Path(output_folder).mkdir(parents=True, exist_ok=True)
+    with FrameStore(store_path) as store, frame_writer.FrameWriter(png_compression=png_compression) as writer:
+        indices = range(len(store)) if include_dropped else store.live_indices()
+        for i in indices:
+            # The view is only read by the writer, the file is mapped read-only so it can't change under it
+            writer.write_array(os.path.join(output_folder, FRAME_FILENAME.format(int(store.index["number"][i]))),
+                               store.frame(i))
+    return len(indices)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    importParser = subparsers.add_parser("import", help="Pack a folder of numbered frames into a frame store")
+    importParser.add_argument("folder")
+    importParser.add_argument("store")
+    importParser.add_argument("--framerate", type=float, help="Fill in timestamps from the frame numbers")
+    exportParser = subparsers.add_parser("export", help="Unpack a frame store into numbered PNGs")
+    exportParser.add_argument("store")
+    exportParser.add_argument("folder")
+    exportParser.add_argument("--include-dropped", action="store_true", help="Also export dropped frames")
+    exportParser.add_argument("--png-compression", type=int, default=frame_writer.DEFAULT_PNG_COMPRESSION,
+                              help="zlib level 0-9 (default={})".format(frame_writer.DEFAULT_PNG_COMPRESSION))
+    infoParser = subparsers.add_parser("info", help="Print the size and index of a frame store")
+    infoParser.add_argument("store")
+    args = vars(parser.parse_args())
+
+    if args["command"] == "import":
+        print("Imported {} frames".format(import_folder(args["folder"], args["store"], args["framerate"])))
+    elif args["command"] == "export":
+        print("Exported {} frames".format(export_folder(args["store"], args["folder"], args["include_dropped"],
+                                                        args["png_compression"])))
+    elif args["command"] == "info":
+        with FrameStore(args["store"]) as frameStore:
+            print("{} frames ({} live), {}x{}".format(len(frameStore), len(frameStore.live_indices()),
+                                                    frameStore.width, frameStore.height))
+            for record in frameStore.index:
+                print("{:>8} {:>12.6f} {}".format(record["number"], record["timestamp"], record["flags"]))
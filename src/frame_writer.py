@@ -0,0 +1,138 @@
+"""
+Asynchronous frame writer
+
+PNG compression is CPU heavy, FrameWriter moves it off the calling thread (eg. inference) onto a pool of threads.
+zlib releases the GIL while compressing so the threads run in parallel.
+Jobs go through a bounded queue so a producer that's faster than the disk is slowed down instead of filling memory
+"""
+# Built-in modules
+import os
+import queue
+import shutil
+import threading
+import time
+# External modules
+from PIL import Image
+
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+DEFAULT_QUEUE_DEPTH = 32
+DEFAULT_PNG_COMPRESSION = 6  # zlib default, 0 or 1 is enough for scratch frames that are deleted later
+
+_STOP = None  # Queue sentinel
+
+
+def _save_image(image, output_file, png_compression):
+    image.save(output_file, compress_level=png_compression)
+
+
+def _save_array(array, output_file, png_compression):
+    _save_image(Image.fromarray(array), output_file, png_compression)
+
+
+class FrameWriter:
+    """
+    Writes frames on worker threads, use as a context manager (or call close) to wait for every frame
+    workers: number of threads compressing frames at once
+    queue_depth: frames waiting to be written before write_* blocks
+    png_compression: zlib level 0 (fastest, largest) to 9 (slowest, smallest)
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, queue_depth=DEFAULT_QUEUE_DEPTH,
+                 png_compression=DEFAULT_PNG_COMPRESSION):
+        if not 0 <= int(png_compression) <= 9:
+            raise ValueError("PNG compression must be between 0 and 9")
+        self.png_compression = int(png_compression)
+        self.queue_depth = queue_depth
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._lock = threading.Lock()
+        self._errors = []
+        self._frames = 0
+        self._bytes = 0
+        self._queue_depth_max = 0
+        self._blocked_seconds = 0.0
+        self._time_start = time.perf_counter()
+        self._threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(max(1, workers))]
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(raise_errors=exc_type is None)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is _STOP:
+                    return
+                output_file, function, args = job
+                function(*args)
+                fileSize = os.path.getsize(output_file)
+                with self._lock:
+                    self._frames += 1
+                    self._bytes += fileSize
+            except Exception as error:
+                with self._lock:
+                    self._errors.append(error)
+            finally:
+                self._queue.task_done()
+
+    def _raise_errors(self):
+        if self._errors:
+            raise RuntimeError("Writing frames failed: {}".format(self._errors[0])) from self._errors[0]
+
+    def submit(self, output_file, function, *args):
+        """Queues function(*args) which writes output_file, blocks while the queue is full"""
+        self._raise_errors()
+        timeStart = time.perf_counter()
+        self._queue.put((output_file, function, args))
+        with self._lock:
+            self._blocked_seconds += time.perf_counter() - timeStart
+            self._queue_depth_max = max(self._queue_depth_max, self._queue.qsize())
+
+    def write_image(self, output_file, image):
+        """Writes a PIL image"""
+        self.submit(output_file, _save_image, image, output_file, self.png_compression)
+
+    def write_array(self, output_file, array):
+        """Writes an HxWx3 uint8 RGB array, it must not be modified after being passed in"""
+        self.submit(output_file, _save_array, array, output_file, self.png_compression)
+
+    def copy(self, source_file, output_file):
+        """Copies an already encoded frame (eg. duplicate frames)"""
+        self.submit(output_file, shutil.copyfile, source_file, output_file)
+
+    def join(self):
+        """Waits for every queued frame to be written"""
+        self._queue.join()
+        self._raise_errors()
+
+    def close(self, raise_errors=True):
+        """Waits for every queued frame to be written and stops the threads"""
+        self._queue.join()
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        if raise_errors is True:
+            self._raise_errors()
+
+    def stats(self):
+        """Current queue depth and throughput so far"""
+        with self._lock:
+            seconds = time.perf_counter() - self._time_start
+            return {"queue_depth": self._queue.qsize(),
+                    "queue_depth_max": self._queue_depth_max,
+                    "frames": self._frames,
+                    "bytes": self._bytes,
+                    "seconds": seconds,
+                    "frames_per_second": self._frames / seconds if seconds > 0 else 0.0,
+                    "blocked_seconds": self._blocked_seconds}
+
+    def report(self):
+        """One line summary of stats(), blocked time is how long the producer waited on a full queue"""
+        stats = self.stats()
+        return "Frame writer: {} frames, {:.1f} MB, {:.1f} frames/sec, max queue {}/{}, blocked {:.1f}s".format(
+            stats["frames"], stats["bytes"] / 1000000, stats["frames_per_second"], stats["queue_depth_max"],
+            self.queue_depth, stats["blocked_seconds"])
@@ -4,20 +4,46 @@ Module for calculating the visual difference
 between images via SSIM. This can be used to
 detect whether video frames are duplicates.
 
-Requires: pillow, SSIM-PIL, progress
+The default "ssim-pil" backend compares one pair at a time with SSIM-PIL.
+The "numpy" backend decodes every frame once into a downscaled
+grayscale array and computes windowed SSIM for batches of pairs at a time,
+with the frames sharded across a process pool. Its scores are not the same
+as SSIM-PIL's (grayscale, 256 px, 7x7 window) so thresholds need choosing for it.
+Fingerprints (thumbnail, perceptual hash and SSIM against the previous frame)
+can be cached in an sqlite file so re-running or re-thresholding is a lookup (numpy only).
+
+Requires: pillow, numpy, SSIM-PIL, progress
 Optional: pyopencl
 """
 # Built-in modules
+import concurrent.futures
 import logging
 import os
 import pathlib
+import sqlite3
+import zlib
+# Local modules
+import frame_store
 # External modules
 from PIL import Image
 from SSIM_PIL import compare_ssim
 from alive_progress import alive_bar
+import numpy
 
 DEFAULT_USE_GPU = True
 DEFAULT_SHOW_PROGRESS = False
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.ppm')  # Includes every intermediate format
+DEFAULT_BACKEND = "ssim-pil"  # Existing --duplicate-auto-delete thresholds were chosen with it
+DEFAULT_WORKERS = os.cpu_count() or 1
+DEFAULT_ANALYSIS_SIZE = 256  # Frames are downscaled to fit within this many pixels before comparison
+DEFAULT_BATCH_SIZE = 32  # Pairs compared per vectorized batch
+FINGERPRINT_CACHE_FILENAME = "fingerprints.sqlite"
+DEFAULT_SCENE_CUT_THRESHOLD = 0.4  # Pairs less similar than this are treated as a scene cut
+
+# SSIM constants (Wang et al. 2004) for 8-bit images and a uniform window
+SSIM_WINDOW = 7
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
 
 
 def calculate_ssim(image0_path, image1_path, use_gpu=True, resize_before_comparison=False):
@@ -31,29 +57,290 @@ def calculate_ssim(image0_path, image1_path, use_gpu=True, resize_before_compari
     return compare_ssim(image0, image1, GPU=use_gpu)
 
 
-def calculate_directory_ssim(directory_path, **kwargs):
-    """Calculates the SSIM for every image in a directory
-    based on it and the image that precedes it
-    """
-    # print(os.path.abspath(directoryPath))
+def _list_image_files(directory_path):
+    """Lists the images in a directory as sorted absolute paths"""
     directory_files = []
     for filePath in pathlib.Path(directory_path).glob('**/*'):  # List all files in the directory as their absolute path
         file_path_absolute = os.path.normpath(filePath.absolute())
-        if file_path_absolute.endswith(('.png', '.jpg', '.jpeg', '.webp', '.bmp')):
+        if file_path_absolute.endswith(IMAGE_EXTENSIONS):
             # Only adds files that have image extensions, fixes problems caused by "Thumbs.db"
             directory_files.append(file_path_absolute)
     directory_files.sort()
+    return directory_files
+
+
+def _load_grayscale_array(image_path, size=DEFAULT_ANALYSIS_SIZE):
+    """Decodes an image into a downscaled grayscale float array"""
+    image = Image.open(image_path)
+    image.draft("L", (size, size))  # Lets jpeg decode straight to a smaller size
+    image = image.convert("L")
+    image.thumbnail((size, size), Image.BILINEAR)
+    return numpy.asarray(image, dtype=numpy.float64)
+
+
+def _frame_grayscale_array(frame, size=DEFAULT_ANALYSIS_SIZE):
+    """Same as _load_grayscale_array for an rgb24 (height, width, 3) array, eg. a frame store view"""
+    image = Image.fromarray(frame).convert("L")
+    image.thumbnail((size, size), Image.BILINEAR)
+    return numpy.asarray(image, dtype=numpy.float64)
+
+
+def _box_filter(images):
+    """Mean of every SSIM_WINDOW x SSIM_WINDOW block ("valid" mode) for a stack of images via summed-area tables"""
+    integral = numpy.pad(images.cumsum(axis=1).cumsum(axis=2), ((0, 0), (1, 0), (1, 0)))
+    w = SSIM_WINDOW
+    sums = integral[:, w:, w:] - integral[:, :-w, w:] - integral[:, w:, :-w] + integral[:, :-w, :-w]
+    return sums / (w * w)
+
+
+def ssim_batch(images0, images1):
+    """Calculates the mean windowed SSIM of each pair in two (N, height, width) stacks of grayscale images"""
+    mu0 = _box_filter(images0)
+    mu1 = _box_filter(images1)
+    sigma0 = _box_filter(images0 * images0) - mu0 * mu0
+    sigma1 = _box_filter(images1 * images1) - mu1 * mu1
+    covariance = _box_filter(images0 * images1) - mu0 * mu1
+    ssim_map = ((2 * mu0 * mu1 + SSIM_C1) * (2 * covariance + SSIM_C2)) / \
+               ((mu0 * mu0 + mu1 * mu1 + SSIM_C1) * (sigma0 + sigma1 + SSIM_C2))
+    return ssim_map.mean(axis=(1, 2))
+
+
+def _perceptual_hash(image):
+    """64-bit difference hash (dHash) of a grayscale array, stored signed so it fits in an sqlite integer"""
+    small = numpy.asarray(Image.fromarray(image.astype(numpy.uint8)).resize((9, 8), Image.BILINEAR), dtype=numpy.int16)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    value = int("".join("1" if bit else "0" for bit in bits), 2)
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _calculate_shard_ssim(shard_files, size=DEFAULT_ANALYSIS_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                          fingerprints=False):
+    """Calculates the SSIM of every consecutive pair in shard_files, each frame is only decoded once
+    If fingerprints is True the (thumbnail, height, width, hash) of every frame is returned as well
+    Ran inside the process pool so it has to stay a top-level function
+    """
+    shard_ssim = []
+    shard_fingerprints = []
+    previous = None
+    for batch_start in range(0, len(shard_files), batch_size):
+        batch = [_load_grayscale_array(file, size) for file in shard_files[batch_start:batch_start + batch_size]]
+        if fingerprints is True:
+            for image in batch:
+                shard_fingerprints.append((zlib.compress(image.astype(numpy.uint8).tobytes(), 1),
+                                           image.shape[0], image.shape[1], _perceptual_hash(image)))
+        images = numpy.stack(batch if previous is None else [previous] + batch)
+        if len(images) > 1:
+            shard_ssim.extend(ssim_batch(images[:-1], images[1:]).tolist())
+        previous = batch[-1]
+    if fingerprints is True:
+        return shard_ssim, shard_fingerprints
+    return shard_ssim
+
+
+def _run_shards(shards, workers, fingerprints=False):
+    """Runs _calculate_shard_ssim on every shard, yields (shard, result) as they finish"""
+    if workers <= 1:
+        for shard in shards:
+            yield shard, _calculate_shard_ssim(shard, fingerprints=fingerprints)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_calculate_shard_ssim, shard, fingerprints=fingerprints): shard
+                       for shard in shards}
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future], future.result()
+
+
+def _split_shards(files, workers):
+    """Contiguous shards that overlap by one frame so no pair is lost at the edges
+    More shards than workers keeps every process busy until the end
+    """
+    shard_length = max(DEFAULT_BATCH_SIZE, -(-len(files) // (workers * 4)))
+    return [files[start:start + shard_length + 1] for start in range(0, max(len(files) - 1, 1), shard_length)]
+
+
+def _open_fingerprint_cache(cache_path):
+    connection = sqlite3.connect(cache_path)
+    connection.execute("CREATE TABLE IF NOT EXISTS fingerprints ("
+                       "path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, "
+                       "thumbnail BLOB, height INTEGER, width INTEGER, hash INTEGER, "
+                       "previous_path TEXT, previous_size INTEGER, previous_mtime INTEGER, ssim REAL)")
+    return connection
+
+
+def _file_key(file_path):
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _cached_thumbnail(connection, file_path):
+    thumbnail, height, width = connection.execute("SELECT thumbnail, height, width FROM fingerprints WHERE path = ?",
+                                                  (file_path,)).fetchone()
+    return numpy.frombuffer(zlib.decompress(thumbnail), dtype=numpy.uint8).reshape(height, width).astype(numpy.float64)
+
+
+def _calculate_directory_ssim_cached(directory_files, cache_path, workers):
+    """
+    numpy backend with an on-disk cache of per-frame fingerprints keyed by path, size and mtime:
+    frames with a valid entry aren't decoded again and pairs with a cached SSIM aren't recalculated
+    Pairs that changed (eg. after duplicates were deleted) are compared using the cached thumbnails
+    """
+    directory_files_ssim = {}
+    file_keys = [_file_key(file) for file in directory_files]
+    connection = _open_fingerprint_cache(cache_path)
+    with connection:
+        # Evict entries of frames that were changed or removed from this directory
+        cached = {}
+        directory_prefix = os.path.join(os.path.dirname(directory_files[0]), "")
+        current_keys = dict(zip(directory_files, file_keys))
+        stale = []
+        for path, size, mtime, previous_path, previous_size, previous_mtime, ssim in connection.execute(
+                "SELECT path, size, mtime, previous_path, previous_size, previous_mtime, ssim FROM fingerprints"):
+            if path in current_keys and current_keys[path] == (size, mtime):
+                cached[path] = (previous_path, (previous_size, previous_mtime), ssim)
+            elif (path in current_keys) or path.startswith(directory_prefix):
+                stale.append((path,))
+        connection.executemany("DELETE FROM fingerprints WHERE path = ?", stale)
+        logging.info("Fingerprint cache: {} valid, {} evicted".format(len(cached), len(stale)))
+
+    # Cached pairs are a lookup
+    pairs_missing = []
+    for i in range(1, len(directory_files)):
+        entry = cached.get(directory_files[i])
+        if (entry is not None) and (entry[0] == directory_files[i - 1]) and (entry[1] == file_keys[i - 1]) and \
+                (entry[2] is not None):
+            directory_files_ssim[directory_files[i]] = entry[2]
+        else:
+            pairs_missing.append(i)
+    if not pairs_missing:
+        connection.close()
+        return directory_files_ssim
+
+    with alive_bar(len(pairs_missing), enrich_print=False) as bar:
+        # Decode frames without an entry, each run also decodes the frame before it so its first pair is included
+        indexes_decode = [i for i in range(len(directory_files)) if directory_files[i] not in cached]
+        runs = []
+        for i in indexes_decode:
+            if runs and runs[-1][1] == i - 1:
+                runs[-1][1] = i
+            else:
+                runs.append([max(i - 1, 0), i])
+        shards = []
+        for first, last in runs:
+            shards.extend(_split_shards(directory_files[first:last + 1], workers))
+        file_indexes = {file: i for i, file in enumerate(directory_files)}
+        for shard, (shard_ssim, shard_fingerprints) in _run_shards(shards, workers, fingerprints=True):
+            first = file_indexes[shard[0]]
+            rows = []
+            for j, (thumbnail, height, width, image_hash) in enumerate(shard_fingerprints):
+                i = first + j
+                if (j == 0) and (directory_files[i] in cached):  # Overlap frame that's already cached
+                    continue
+                previous = (directory_files[i - 1],) + file_keys[i - 1] if (j > 0) else (None, None, None)
+                ssim = shard_ssim[j - 1] if (j > 0) else None
+                rows.append((directory_files[i],) + file_keys[i] + (thumbnail, height, width, image_hash) +
+                            previous + (ssim,))
+                cached[directory_files[i]] = (previous[0], previous[1:], ssim)
+            for j, file_ssim in enumerate(shard_ssim):
+                directory_files_ssim[shard[j + 1]] = file_ssim
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO fingerprints VALUES (?,?,?,?,?,?,?,?,?,?,?)", rows)
+            bar(incr=len(shard_ssim))
+
+        # Remaining pairs have both frames cached but weren't neighbours before, compare the cached thumbnails
+        pairs_remaining = [i for i in pairs_missing if directory_files[i] not in directory_files_ssim]
+        for batch_start in range(0, len(pairs_remaining), DEFAULT_BATCH_SIZE):
+            batch = pairs_remaining[batch_start:batch_start + DEFAULT_BATCH_SIZE]
+            images0 = numpy.stack([_cached_thumbnail(connection, directory_files[i - 1]) for i in batch])
+            images1 = numpy.stack([_cached_thumbnail(connection, directory_files[i]) for i in batch])
+            batch_ssim = ssim_batch(images0, images1).tolist()
+            with connection:
+                connection.executemany("UPDATE fingerprints SET previous_path = ?, previous_size = ?, "
+                                       "previous_mtime = ?, ssim = ? WHERE path = ?",
+                                       [(directory_files[i - 1],) + file_keys[i - 1] + (file_ssim, directory_files[i])
+                                        for i, file_ssim in zip(batch, batch_ssim)])
+            for i, file_ssim in zip(batch, batch_ssim):
+                directory_files_ssim[directory_files[i]] = file_ssim
+            bar(incr=len(batch))
+    connection.close()
+    return directory_files_ssim
+
+
+def calculate_directory_ssim(directory_path, backend=DEFAULT_BACKEND, workers=DEFAULT_WORKERS, cache_path=None,
+                             **kwargs):
+    """Calculates the SSIM for every image in a directory
+    based on it and the image that precedes it
+    cache_path: sqlite file to keep per-frame fingerprints in between runs (numpy backend only)
+    kwargs are calculate_ssim options (ssim-pil backend only)
+    """
+    if (backend == "ssim-pil") and (cache_path is not None):
+        raise ValueError("The fingerprint cache needs the numpy backend")
+    if (backend == "numpy") and kwargs:
+        raise TypeError("Options not supported by the numpy backend: {}".format(", ".join(sorted(kwargs))))
+    # print(os.path.abspath(directoryPath))
+    directory_files = _list_image_files(directory_path)
     # print(directory_files)
     directory_files_ssim = {}
-    with alive_bar(len(directory_files) - 1, enrich_print=False) as bar:
-        for i in range(1, len(directory_files)):
-            file_ssim = calculate_ssim(directory_files[i], directory_files[i - 1], **kwargs)
-            # print(file_ssim)
-            directory_files_ssim[directory_files[i]] = file_ssim
-            bar()
+    if len(directory_files) < 2:
+        return directory_files_ssim
+    if backend == "ssim-pil":
+        with alive_bar(len(directory_files) - 1, enrich_print=False) as bar:
+            for i in range(1, len(directory_files)):
+                file_ssim = calculate_ssim(directory_files[i], directory_files[i - 1], **kwargs)
+                # print(file_ssim)
+                directory_files_ssim[directory_files[i]] = file_ssim
+                bar()
+    elif (backend == "numpy") and (cache_path is not None):
+        directory_files_ssim = _calculate_directory_ssim_cached(directory_files, cache_path, workers)
+    elif backend == "numpy":
+        with alive_bar(len(directory_files) - 1, enrich_print=False) as bar:
+            for shard, shard_ssim in _run_shards(_split_shards(directory_files, workers), workers):
+                for j, file_ssim in enumerate(shard_ssim):
+                    directory_files_ssim[shard[j + 1]] = file_ssim
+                bar(incr=len(shard_ssim))
+    else:
+        raise ValueError("Invalid SSIM backend: {}".format(backend))
     return directory_files_ssim
 
 
+def detect_scene_cuts(directory_path, threshold=DEFAULT_SCENE_CUT_THRESHOLD, **kwargs):
+    """Returns the filenames of images that start a new scene (SSIM to the previous image below threshold)"""
+    ssimResults = calculate_directory_ssim(directory_path, **kwargs)
+    return [os.path.basename(file) for file in sorted(ssimResults.keys()) if ssimResults[file] < float(threshold)]
+
+
+def calculate_store_ssim(store_path, size=DEFAULT_ANALYSIS_SIZE, batch_size=DEFAULT_BATCH_SIZE):
+    """Calculates the SSIM of every live frame in a frame store and the live frame before it
+    Frames are read straight from the memory-mapped file, returns {store index: ssim}
+    """
+    store_ssim = {}
+    with frame_store.FrameStore(store_path) as store:
+        indices = store.live_indices()
+        previous = None
+        with alive_bar(max(len(indices) - 1, 0), enrich_print=False) as bar:
+            for batch_start in range(0, len(indices), batch_size):
+                batchIndices = indices[batch_start:batch_start + batch_size]
+                batch = [_frame_grayscale_array(store.frame(i), size) for i in batchIndices]
+                images = numpy.stack(batch if previous is None else [previous] + batch)
+                if len(images) > 1:
+                    pairIndices = batchIndices if previous is not None else batchIndices[1:]
+                    for i, file_ssim in zip(pairIndices, ssim_batch(images[:-1], images[1:]).tolist()):
+                        store_ssim[i] = file_ssim
+                    bar(incr=len(pairIndices))
+                previous = batch[-1]
+    return store_ssim
+
+
+def drop_similar_frames(store_path, threshold, **kwargs):
+    """Frame store version of delete_similar_images, frames over the threshold are flagged as dropped"""
+    ssimResults = calculate_store_ssim(store_path, **kwargs)
+    with frame_store.FrameStore(store_path, "r+") as store:
+        for i, file_ssim in ssimResults.items():
+            if file_ssim > float(threshold):
+                logging.info("Dropping frame: {}".format(store.index["number"][i]))
+                store.set_flags(i, store.index["flags"][i] | frame_store.FLAG_DROPPED)
+    return sum(1 for file_ssim in ssimResults.values() if file_ssim > float(threshold))
+
+
 def delete_similar_images(directory_path, threshold, **kwargs):
     """Deletes any image that has an SSIM higher then the specified threshold"""
     ssimResults = calculate_directory_ssim(directory_path, **kwargs)
@@ -72,17 +359,32 @@ if __name__ == "__main__":
     parser.add_argument("--delete-threshold", type=float, help="If specified, deletes duplicate images automatically"
                                                                " based on a similarity percentage (Eg. 0.95)")
     parser.add_argument("--disable-gpu", action="store_true", help="Force SSIM calculation to use CPU instead of GPU")
+    parser.add_argument("--backend", default=DEFAULT_BACKEND, choices=["numpy", "ssim-pil"],
+                        help="SSIM implementation used for --folder (default={})".format(DEFAULT_BACKEND))
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Processes used by the numpy backend (default={})".format(DEFAULT_WORKERS))
+    parser.add_argument("--cache", help="Path of an sqlite file to cache frame fingerprints in between runs "
+                                        "(numpy backend only)")
+    parser.add_argument("--scene-cuts", type=float, nargs="?", const=DEFAULT_SCENE_CUT_THRESHOLD,
+                        help="Print the images that start a new scene, optionally with a similarity threshold "
+                             "(default={})".format(DEFAULT_SCENE_CUT_THRESHOLD))
     args = vars(parser.parse_args())
     useGpu = not args["disable_gpu"]
+    folderOptions = {"backend": args["backend"], "workers": args["workers"], "cache_path": args["cache"]}
+    if args["backend"] == "ssim-pil":
+        folderOptions["use_gpu"] = useGpu
     if not ((args["image0"] and args["image1"]) or args["folder"]):
         parser.error('Requires either both --image0 and --image1 or --folder')
 
-    if (args["image0"] is not None) and (args["image1"] is not None):  # -image0 and -image1
+    if (args["folder"] is not None) and (args["scene_cuts"] is not None):  # -folder scene cut mode
+        for file in detect_scene_cuts(args["folder"], args["scene_cuts"], **folderOptions):
+            print(file)
+    elif (args["image0"] is not None) and (args["image1"] is not None):  # -image0 and -image1
         SSIM = calculate_ssim(args["image0"], args["image1"], use_gpu=useGpu)
         print("SSIM: {}".format(SSIM)) # -folder delete mode
     elif (args["folder"] is not None) and (args["delete_threshold"] is not None):
-        delete_similar_images(args["folder"], args["delete_threshold"], use_gpu=useGpu)
+        delete_similar_images(args["folder"], args["delete_threshold"], **folderOptions)
     elif args["folder"] is not None:  # -folder
-        directorySSIM = calculate_directory_ssim(args["folder"], use_gpu=useGpu)
+        directorySSIM = calculate_directory_ssim(args["folder"], **folderOptions)
         for file in sorted(directorySSIM.keys()):
             print("{}: {}".format(file, directorySSIM[file]))
@@ -2,126 +2,806 @@
 Module for handling interpolation (aka: "step 2")
 """
 # Built-in Modules
+import fractions
+import logging
+import math
 import os
 import pathlib
 import shutil
+import threading
 # Local Modules
 import dain_ncnn_vulkan
 import cain_ncnn_vulkan
+import frame_writer
+import progress
 import rife_ncnn_vulkan
+# External modules
+from PIL import Image
 
 DEFAULT_MULTIPLIER = 2
 DEFAULT_MULTIPLIER_DYNAMIC = 1
 DEFAULT_INTERPOLATOR = "dain-ncnn"
 
+FRAME_FILENAME = "{:08d}.png"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_IEND_CHUNK = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+RESUME_ATTEMPTS = 2  # Number of times missing frames are re-interpolated before giving up
+SHARD_MINIMUM_FRAMES = 16  # Smallest shard handed to a worker (except the remainder)
+PIPELINE_BLOCK_FRAMES = 64  # Frames a later pass waits for before its first window, doubled for every window after
+PIPELINE_MAX_BLOCK_FRAMES = 4096  # Largest window, every window is one engine process (Vulkan init + model load)
+PIPELINE_POLL_INTERVAL = 0.5  # Seconds between checks for new frames from the previous pass
+SCRATCH_PNG_COMPRESSION = 1  # Original frames in another intermediate format are converted to png at this level
+RESAMPLE_TOLERANCE = 0.1  # Largest timing error of a resampled cain/rife frame, in output frame intervals
+RESAMPLE_MAX_DEPTH = 8  # Deepest midpoint recursion a resample plan may use
 
-def _make_duplicate_frames(input_file, output_folder, output_count):
+_consumed_frames = {}  # Output folder -> number of leading frames an overlapped encoder already consumed
+_consumed_frames_lock = threading.Lock()  # Set from the encoder's thread, read by the interpolation threads
+
+
+def _make_duplicate_frames(input_file, output_folder, output_count, start_number=None, writer=None):
     """
     Copies the input_file a number of time
     Useful for creating duplicate frames before a scene change or at the end of a non-looping video
+    The copies are numbered from start_number, defaults to the frame after input_file
+    writer: frame_writer.FrameWriter to copy on in the background
     """
-    inputFileNumber = int(pathlib.Path(input_file).stem)  # Get Filename (without extension) from path
+    if start_number is None:
+        start_number = int(pathlib.Path(input_file).stem) + 1  # Get Filename (without extension) from path
     for i in range(output_count):
-        outputFile = "{:06d}.png".format(inputFileNumber + i + 1)
-        args = [os.path.join(output_folder, input_file), os.path.join(output_folder, outputFile)]
-        print("Duplicating:", " -> ".join(args))
-        shutil.copyfile(*args)
+        outputFile = os.path.join(output_folder, FRAME_FILENAME.format(start_number + i))
+        logging.info("Duplicating: {} -> {}".format(input_file, outputFile))
+        _copy_frame(input_file, outputFile, writer=writer)
+
+
+def set_consumed_frames(output_folder, count):
+    """
+    Marks frames 1-count of output_folder as done after an overlapped encoder read and deleted them,
+    so the missing frame checks don't interpolate them again (0 clears it)
+    """
+    outputFolder = os.path.abspath(output_folder)
+    with _consumed_frames_lock:
+        if count > 0:
+            _consumed_frames[outputFolder] = count
+        else:
+            _consumed_frames.pop(outputFolder, None)
+
+
+def consumed_frames(output_folder):
+    with _consumed_frames_lock:
+        return _consumed_frames.get(os.path.abspath(output_folder), 0)
+
+
+def is_valid_frame(file_path):
+    """
+    Checks a png frame is done: fully written (signature at the start and IEND chunk at the end)
+    or already consumed (frames 1-count of its folder after set_consumed_frames(folder, count), which may be deleted)
+    Every check of whether an output frame still needs interpolating goes through this, the overlapped encoder
+    uses it to wait for the next frame and set_consumed_frames to hand the frames it deleted back as done
+    """
+    filePath = pathlib.Path(file_path)
+    if filePath.stem.isdigit() and (int(filePath.stem) <= consumed_frames(filePath.parent)):
+        return True
+    try:
+        with open(file_path, "rb") as file:
+            if file.read(8) != PNG_SIGNATURE:
+                return False
+            file.seek(-len(PNG_IEND_CHUNK), os.SEEK_END)
+            return file.read() == PNG_IEND_CHUNK
+    except OSError:  # Missing or shorter than the chunk
+        return False
+
 
+def _link_or_copy(source_file, destination_file):
+    """Hardlinks a frame to avoid copying it, falls back to a copy across filesystems"""
+    try:
+        os.link(source_file, destination_file)
+    except OSError:
+        shutil.copyfile(source_file, destination_file)
 
-def folder_multiplier_handler(input_folder, output_folder, multiplier, engine, **kwargs):
+
+def _scratch_filename(number, source_file):
+    """Numbered filename for a frame linked into an engine's input folder, keeps the format of source_file"""
+    return "{:08d}{}".format(number, pathlib.Path(source_file).suffix)
+
+
+def _convert_frame(source_file, destination_file):
+    Image.open(source_file).convert("RGB").save(destination_file, compress_level=SCRATCH_PNG_COMPRESSION)
+
+
+def _copy_frame(source_file, destination_file, writer=None, link=False):
+    """
+    Copies a frame into an output folder, frames in another intermediate format (eg. bmp originals) are converted
+    writer: frame_writer.FrameWriter to copy on in the background
+    link: hardlink when possible instead of copying
+    """
+    if pathlib.Path(source_file).suffix.lower() != pathlib.Path(destination_file).suffix.lower():
+        if writer is None:
+            _convert_frame(source_file, destination_file)
+        else:
+            writer.submit(destination_file, _convert_frame, source_file, destination_file)
+    elif link is True:
+        _link_or_copy(source_file, destination_file)
+    elif writer is None:
+        shutil.copyfile(source_file, destination_file)
+    else:
+        writer.copy(source_file, destination_file)
+
+
+def find_missing_frames(output_folder, target_frames):
+    """Returns the (0-indexed) output frames that are missing or truncated"""
+    missingFrames = []
+    for i in range(target_frames):
+        if not is_valid_frame(os.path.join(output_folder, FRAME_FILENAME.format(i + 1))):
+            missingFrames.append(i)
+    return missingFrames
+
+
+def _missing_pair_ranges(missing_frames, multiplier):
+    """Groups missing output frames into contiguous [first, last] ranges of the input frames they come from
+    Output frame i is made from input frame (i // multiplier) and the frame after it
+    """
+    pairRanges = []
+    for pair in sorted({frame // multiplier for frame in missing_frames}):
+        if pairRanges and pairRanges[-1][1] == pair - 1:
+            pairRanges[-1][1] = pair
+        else:
+            pairRanges.append([pair, pair])
+    return pairRanges
+
+
+def _run_engine_folder_mode(input_folder, output_folder, multiplier, engine, **kwargs):
+    """Single folder-mode engine run (dain: any multiplier, cain/rife: 2x only)"""
+    if engine.startswith("dain-ncnn"):
+        dain_ncnn_vulkan.interpolate_folder_mode(input_folder, output_folder, multiplier, **kwargs)
+    elif multiplier != 2:
+        raise ValueError("{} only supports 2x per pass".format(engine))
+    elif engine.startswith("cain-ncnn"):
+        cain_ncnn_vulkan.interpolate_folder_mode(input_folder, output_folder, **kwargs)
+    elif engine.startswith("rife-ncnn"):
+        rife_ncnn_vulkan.interpolate_folder_mode(input_folder, output_folder, **kwargs)
+    else:
+        raise ValueError("Invalid Engine")
+
+
+def _interpolate_window(input_files, first, last, output_folder, multiplier, engine, folder_window=None,
+                        multi_pass=False, **kwargs):
+    """
+    Interpolates input_files[first:last + 1] (plus the next frame as overlap) in a scratch folder
+    and moves the outputs to their position in output_folder, used to fill in missing ranges and for shards
+    multi_pass: use interpolate_static so cain/rife can go past 2x (single engine pass otherwise)
+    """
+    if folder_window is None:
+        folderWindow = os.path.join(pathlib.Path(output_folder).parent, pathlib.Path(output_folder).name + "-window")
+    else:
+        folderWindow = folder_window
+    folderWindowInput = os.path.join(folderWindow, "input")
+    folderWindowOutput = os.path.join(folderWindow, "output")
+    if os.path.isdir(folderWindow):
+        shutil.rmtree(folderWindow)
+    pathlib.Path(folderWindowInput).mkdir(parents=True)
+    windowFiles = input_files[first:min(last + 2, len(input_files))]
+    for i, inputFile in enumerate(windowFiles):
+        _link_or_copy(inputFile, os.path.join(folderWindowInput, _scratch_filename(i + 1, inputFile)))
+    if len(windowFiles) == 1:  # Last frame on its own, the engine would duplicate it anyway
+        pathlib.Path(folderWindowOutput).mkdir(parents=True)
+        for i in range(multiplier):
+            _copy_frame(windowFiles[0], os.path.join(folderWindowOutput, FRAME_FILENAME.format(i + 1)), link=True)
+    elif multi_pass is True:
+        interpolate_static(folderWindowInput, folderWindowOutput, multiplier, engine, **kwargs)
+    else:
+        _run_engine_folder_mode(folderWindowInput, folderWindowOutput, multiplier, engine, **kwargs)
+    for i in range((last - first + 1) * multiplier):
+        windowOutputFile = os.path.join(folderWindowOutput, FRAME_FILENAME.format(i + 1))
+        if os.path.isfile(windowOutputFile):  # Frames the engine skipped again are picked up by the next check
+            os.replace(windowOutputFile, os.path.join(output_folder, FRAME_FILENAME.format(first * multiplier + i + 1)))
+    shutil.rmtree(folderWindow)
+
+
+def interpolate_folder_resumable(input_folder, output_folder, multiplier, engine, resume=False, checkpoint=None,
+                                 **kwargs):
+    """
+    Single folder-mode pass that only interpolates the frames that are missing from output_folder
+    resume: keep the valid frames already in output_folder instead of starting from zero
+    Frames the engine failed to write (fewer than target_frames) are filled in the same way
+    checkpoint: optional function called with the progress of the pass after every check
+    """
+    inputFiles = [os.path.join(input_folder, file) for file in sorted(os.listdir(input_folder))]
+    targetFrames = len(inputFiles) * multiplier
+    outputName = pathlib.Path(output_folder).name
+    if (resume is False) or (os.path.isdir(output_folder) is False) or (not os.listdir(output_folder)):
+        try:
+            _run_engine_folder_mode(input_folder, output_folder, multiplier, engine, **kwargs)
+        except RuntimeError as error:  # Crashed part way, the frames it wrote are kept and the rest filled in below
+            print("WARNING: \"{}\": {}".format(outputName, error))
+    for attempt in range(RESUME_ATTEMPTS + 1):
+        missingFrames = find_missing_frames(output_folder, targetFrames)
+        if checkpoint is not None:
+            checkpoint(outputName, {"target_frames": targetFrames, "missing_frames": len(missingFrames)})
+        if not missingFrames:
+            return
+        if attempt == RESUME_ATTEMPTS:
+            break
+        pairRanges = _missing_pair_ranges(missingFrames, multiplier)
+        print("\"{}\": {} frames missing, interpolating {} ranges".format(outputName, len(missingFrames),
+                                                                         len(pairRanges)))
+        for first, last in pairRanges:
+            _interpolate_window(inputFiles, first, last, output_folder, multiplier, engine, **kwargs)
+    raise RuntimeError("\"{}\": {} frames could not be interpolated".format(outputName, len(missingFrames)))
+
+
+def _contiguous_valid_frames(input_files, start):
+    """Returns the index of the first frame from start that isn't fully written yet (len(input_files) if none)"""
+    while (start < len(input_files)) and is_valid_frame(input_files[start]):
+        start += 1
+    return start
+
+
+def folder_multiplier_handler(input_folder, output_folder, multiplier, engine, resume=False, checkpoint=None,
+                              **kwargs):
     """
     Achieve interpolation past 2x without using target_frames (which cain/rife lacks)
     by interpolating from one folder to the next Eg. First (1x -> 2x) then (2x -> 4x)
-    Multiplies to a power of 2
+    Multiplies to a power of 2, the last pass is written straight to output_folder
+    The passes overlap: each pass after the first tails the folder of the one before it and interpolates
+    every frame that is complete in one window, deleting the frames it has consumed
+    (so the engine processes of two passes share the GPU at once)
+    Windows start at PIPELINE_BLOCK_FRAMES and double up to PIPELINE_MAX_BLOCK_FRAMES so long videos start
+    a few engine processes per pass instead of one per block
+    resume: only the frames of output_folder are kept (intermediate frames don't survive), missing ones are
+    interpolated again from input_folder
     """
-    folderParent = pathlib.Path(output_folder).parent
-    multiplierInternal = 1
-    interpolateFolderFrom = input_folder
-    interpolateFolderTo = None
     if not (multiplier > 1):
         raise ValueError("Multiplier must be higher than 1")
-    else:
-        if not ((multiplier & (multiplier - 1) == 0) and multiplier != 0):  # Check if not a power of 2
-            raise ValueError("Multiplier must be a power of 2 (2, 4, 8, etc.)")
-        else:
-            interpolateOutputFolders = []
-            while multiplierInternal < multiplier:
-                multiplierInternal = multiplierInternal * 2
-                print("From: \"{}\"".format(interpolateFolderFrom))
-                interpolateFolderTo = os.path.join(folderParent, ("interpolate-" + str(multiplierInternal) + "x"))
-                interpolateOutputFolders.append(interpolateFolderTo)
-                print("To: \"{}\"".format(interpolateFolderTo))
-                if engine == "cain-ncnn":
-                    cain_ncnn_vulkan.interpolate_folder_mode(interpolateFolderFrom, interpolateFolderTo, **kwargs)
-                elif engine == "rife-ncnn":
-                    rife_ncnn_vulkan.interpolate_folder_mode(interpolateFolderFrom, interpolateFolderTo, **kwargs)
-                else:
-                    raise ValueError("Invalid Engine")
-                interpolateFolderFrom = interpolateFolderTo  # Set last output folder to input folder for the next loop
-            print("Renaming \"{}\" to \"{}\"".format(interpolateFolderTo, output_folder))
-            if os.path.isdir(output_folder) is True:
-                print("\"{}\" already exists, deleting".format(output_folder))
-                shutil.rmtree(output_folder)
-            os.rename(interpolateFolderTo, output_folder)
-            if interpolateOutputFolders[:-1]:
-                print("Deleting leftover folders:", interpolateOutputFolders[:-1])
-                for folder in interpolateOutputFolders[:-1]:
-                    shutil.rmtree(folder)
+    if not ((multiplier & (multiplier - 1) == 0) and multiplier != 0):  # Check if not a power of 2
+        raise ValueError("Multiplier must be a power of 2 (2, 4, 8, etc.)")
+    if multiplier == 2:
+        interpolate_folder_resumable(input_folder, output_folder, 2, engine,
+                                     resume=resume, checkpoint=checkpoint, **kwargs)
+        return
+    if (resume is True) and os.path.isdir(output_folder) and os.listdir(output_folder):
+        interpolate_folder_resumable(input_folder, output_folder, multiplier, engine,
+                                     resume=True, checkpoint=checkpoint, multi_pass=True, **kwargs)
+        return
+
+    # Every pass doubles the frames, the last one goes straight to output_folder
+    folderParent = pathlib.Path(output_folder).parent
+    inputFiles = [os.path.join(input_folder, file) for file in sorted(os.listdir(input_folder))]
+    stageFolders = [os.path.join(folderParent, "interpolate-{}x".format(2 ** (i + 1)))
+                    for i in range(int(math.log2(multiplier)) - 1)] + [output_folder]
+    stageFiles = [[os.path.join(folder, FRAME_FILENAME.format(j + 1)) for j in range(len(inputFiles) * 2 ** (i + 1))]
+                  for i, folder in enumerate(stageFolders)]
+    stageDone = [threading.Event() for _ in stageFolders]
+    consumedFrames = [0 for _ in stageFolders]  # Frames of each pass the next pass is finished with (and deleted)
+    windowKwargs = dict(kwargs, show_progress=False)
+    lock = threading.Lock()
+    stopEvent = threading.Event()
+    errors = []
+    print("Passes: {}".format(" -> ".join(["\"{}\"".format(input_folder)] +
+                                            ["\"{}\"".format(folder) for folder in stageFolders])))
+
+    def stage_checkpoint(stage, frames_done):
+        if checkpoint is not None:
+            with lock:
+                checkpoint(pathlib.Path(stageFolders[stage]).name,
+                           {"target_frames": len(stageFiles[stage]), "frames_done": frames_done})
+
+    def first_stage():
+        """Single engine run over input_folder, then frames the engine skipped are filled in"""
+        _run_engine_folder_mode(input_folder, stageFolders[0], 2, engine, **kwargs)
+        for attempt in range(RESUME_ATTEMPTS + 1):
+            missingFrames = [i for i in range(consumedFrames[0], len(stageFiles[0]))
+                             if not is_valid_frame(stageFiles[0][i])]
+            with lock:  # Frames deleted by the next pass while scanning were valid
+                missingFrames = [i for i in missingFrames if i >= consumedFrames[0]]
+            if not missingFrames:
+                break
+            if attempt == RESUME_ATTEMPTS:
+                raise RuntimeError("\"{}\": {} frames could not be interpolated".format(
+                    pathlib.Path(stageFolders[0]).name, len(missingFrames)))
+            for first, last in _missing_pair_ranges(missingFrames, 2):
+                _interpolate_window(inputFiles, first, last, stageFolders[0], 2, engine, **windowKwargs)
+        stage_checkpoint(0, len(stageFiles[0]))
+
+    def tail_stage(stage):
+        """Interpolates the previous pass' frames a window at a time as they are written"""
+        stageInputFiles = stageFiles[stage - 1]
+        nextFrame = 0
+        readyFrame = 0
+        blockFrames = PIPELINE_BLOCK_FRAMES
+        while nextFrame < len(stageInputFiles):
+            if stopEvent.is_set():
+                return
+            previousDone = stageDone[stage - 1].is_set()  # Checked before scanning so no frame is missed
+            readyFrame = _contiguous_valid_frames(stageInputFiles, readyFrame)
+            # A window needs the frame after it as overlap, except at the end
+            windowEnd = len(stageInputFiles) if readyFrame == len(stageInputFiles) else readyFrame - 1
+            windowEnd = min(windowEnd, nextFrame + PIPELINE_MAX_BLOCK_FRAMES)
+            if (windowEnd - nextFrame < blockFrames) and (windowEnd < len(stageInputFiles)):
+                if previousDone:
+                    raise RuntimeError("\"{}\": frame {} is missing".format(
+                        pathlib.Path(stageFolders[stage - 1]).name, readyFrame + 1))
+                stopEvent.wait(PIPELINE_POLL_INTERVAL)
+                continue
+            last = windowEnd - 1
+            blockFrames = min(blockFrames * 2, PIPELINE_MAX_BLOCK_FRAMES)
+            pairRanges = [[nextFrame, last]]
+            for attempt in range(RESUME_ATTEMPTS + 1):
+                for first, lastPair in pairRanges:
+                    _interpolate_window(stageInputFiles, first, lastPair, stageFolders[stage], 2, engine,
+                                        **windowKwargs)
+                missingFrames = [i for i in range(nextFrame * 2, (last + 1) * 2)
+                                 if not is_valid_frame(stageFiles[stage][i])]
+                if not missingFrames:
+                    break
+                if attempt == RESUME_ATTEMPTS:
+                    raise RuntimeError("\"{}\": {} frames could not be interpolated".format(
+                        pathlib.Path(stageFolders[stage]).name, len(missingFrames)))
+                pairRanges = _missing_pair_ranges(missingFrames, 2)
+            # The overlap frame (last + 1) is kept for the next window
+            with lock:
+                consumedFrames[stage - 1] = last + 1
+            for inputFile in stageInputFiles[nextFrame:last + 1]:
+                os.remove(inputFile)
+            nextFrame = last + 1
+            stage_checkpoint(stage, nextFrame * 2)
+
+    def run_stage(stage):
+        try:
+            if stage == 0:
+                first_stage()
+            else:
+                tail_stage(stage)
+        except Exception as error:
+            errors.append(error)
+            stopEvent.set()
+        finally:
+            stageDone[stage].set()
+
+    for folder in stageFolders:  # Stale frames would look like finished output to the next pass
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        pathlib.Path(folder).mkdir(parents=True)
+    threads = [threading.Thread(target=progress.bind_job(run_stage), args=(stage,))
+               for stage in range(len(stageFolders))]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        print("Deleting leftover folders:", stageFolders[:-1])
+        for folder in stageFolders[:-1]:
+            shutil.rmtree(folder, ignore_errors=True)
+    if errors:
+        raise errors[0]
+
+
+def _interpolate_scenes(input_folder, output_folder, multiplier, interpolator, scene_cuts, resume=False,
+                        checkpoint=None, **kwargs):
+    """
+    Interpolates each scene on its own so no inference is spent on pairs that straddle a cut
+    The last frame of every scene is duplicated to fill its slots instead of blending into the next scene
+    """
+    scenes = []
+    for inputFile in sorted(os.listdir(input_folder)):
+        if (not scenes) or (inputFile in scene_cuts):
+            scenes.append([])
+        scenes[-1].append(inputFile)
+    print("Scenes: {}, pairs skipped at cuts: {}".format(len(scenes), len(scenes) - 1))
+
+    if (resume is False) and os.path.isdir(output_folder):
+        shutil.rmtree(output_folder)
+    pathlib.Path(output_folder).mkdir(parents=True, exist_ok=True)
+    folderScene = os.path.join(pathlib.Path(output_folder).parent, pathlib.Path(output_folder).name + "-scene")
+    outputOffset = 0
+    for sceneIndex, scene in enumerate(scenes):
+        sceneOutputFiles = [os.path.join(output_folder, FRAME_FILENAME.format(outputOffset + i + 1))
+                            for i in range(len(scene) * multiplier)]
+        if (resume is True) and all(is_valid_frame(file) for file in sceneOutputFiles):
+            outputOffset += len(sceneOutputFiles)
+            continue
+        if len(scene) > 1:
+            print("Scene {}/{}: {} frames".format(sceneIndex + 1, len(scenes), len(scene)))
+            folderSceneInput = os.path.join(folderScene, "input")
+            folderSceneOutput = os.path.join(folderScene, "output")
+            if os.path.isdir(folderScene):
+                shutil.rmtree(folderScene)
+            pathlib.Path(folderSceneInput).mkdir(parents=True)
+            for i, inputFile in enumerate(scene):
+                _link_or_copy(os.path.join(input_folder, inputFile),
+                              os.path.join(folderSceneInput, _scratch_filename(i + 1, inputFile)))
+            interpolate_static(folderSceneInput, folderSceneOutput, multiplier, interpolator, **kwargs)
+            for i in range((len(scene) - 1) * multiplier):
+                os.replace(os.path.join(folderSceneOutput, FRAME_FILENAME.format(i + 1)), sceneOutputFiles[i])
+            shutil.rmtree(folderScene)
+        # Cut boundary (or end of the video): duplicate the last frame of the scene
+        lastOutputFile = sceneOutputFiles[(len(scene) - 1) * multiplier]
+        _copy_frame(os.path.join(input_folder, scene[-1]), lastOutputFile)
+        _make_duplicate_frames(lastOutputFile, output_folder, multiplier - 1)
+        outputOffset += len(sceneOutputFiles)
+        if checkpoint is not None:
+            checkpoint(pathlib.Path(output_folder).name, {"scenes": len(scenes), "scenes_done": sceneIndex + 1})
+
+
+def interpolate_sharded(input_folder, output_folder, multiplier, interpolator, workers, resume=False,
+                        checkpoint=None, **kwargs):
+    """
+    Splits the input frames into contiguous shards (overlapping by one frame) and runs one engine process per worker
+    workers: gpu ids, one engine process runs on each at a time (an id can be listed twice for two processes)
+    Shards are handed out on demand and shrink as the work runs out (guided scheduling)
+    so a worker that falls behind is given less work, shards of a failed worker are retried by the others
+    """
+    inputFiles = [os.path.join(input_folder, file) for file in sorted(os.listdir(input_folder))]
+    targetFrames = len(inputFiles) * multiplier
+    outputName = pathlib.Path(output_folder).name
+    if (resume is False) and os.path.isdir(output_folder):
+        shutil.rmtree(output_folder)
+    pathlib.Path(output_folder).mkdir(parents=True, exist_ok=True)
+
+    kwargs.pop("gpu_id", None)  # Each worker sets its own
+    lock = threading.Lock()
+    state = {"next_frame": 0, "frames_done": 0}
+    aliveWorkers = dict(enumerate(workers))
+    retryShards = []
+    errors = []
+
+    def next_shard():
+        with lock:
+            if retryShards:
+                return retryShards.pop()
+            first = state["next_frame"]
+            if first >= len(inputFiles):
+                return None
+            remaining = len(inputFiles) - first
+            shardLength = max(min(SHARD_MINIMUM_FRAMES, remaining), -(-remaining // (2 * len(workers))))
+            state["next_frame"] = first + shardLength
+            return first, first + shardLength - 1
+
+    def worker(workerIndex, gpuId):
+        folderShard = os.path.join(pathlib.Path(output_folder).parent, "{}-shard-{}".format(outputName, workerIndex))
+        while True:
+            shard = next_shard()
+            if shard is None:
+                break
+            first, last = shard
+            shardOutputFiles = [os.path.join(output_folder, FRAME_FILENAME.format(first * multiplier + i + 1))
+                                for i in range((last - first + 1) * multiplier)]
+            if (resume is False) or not all(is_valid_frame(file) for file in shardOutputFiles):
+                print("Worker {} (GPU {}): frames {}-{}".format(workerIndex, gpuId, first, last))
+                try:
+                    _interpolate_window(inputFiles, first, last, output_folder, multiplier, interpolator,
+                                        folder_window=folderShard, multi_pass=True, gpu_id=gpuId,
+                                        show_progress=False, **kwargs)
+                except Exception as error:  # Give the shard back and retire this worker
+                    print("Worker {} (GPU {}) failed: {}".format(workerIndex, gpuId, error))
+                    shutil.rmtree(folderShard, ignore_errors=True)
+                    with lock:
+                        retryShards.append(shard)
+                        errors.append(error)
+                        del aliveWorkers[workerIndex]
+                    return
+            with lock:
+                state["frames_done"] += len(shardOutputFiles)
+                if checkpoint is not None:
+                    checkpoint(outputName, {"target_frames": targetFrames, "frames_done": state["frames_done"]})
+
+    # Workers that are still alive start again if a failed worker gave shards back after they had finished
+    while aliveWorkers and (retryShards or (state["next_frame"] < len(inputFiles))):
+        threads = [threading.Thread(target=progress.bind_job(worker), args=(i, gpuId))
+                   for i, gpuId in list(aliveWorkers.items())]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    if not aliveWorkers:
+        raise RuntimeError("All workers failed, last error: {}".format(errors[-1]))
+    missingFrames = find_missing_frames(output_folder, targetFrames)
+    if missingFrames:
+        raise RuntimeError("\"{}\": {} frames could not be interpolated".format(outputName, len(missingFrames)))
 
 
 def interpolate_static(input_folder, output_folder,
-                       mulitplier=DEFAULT_MULTIPLIER, interpolator=None, loop=False, **kwargs):
+                       multiplier=DEFAULT_MULTIPLIER, interpolator=DEFAULT_INTERPOLATOR, loop=False, resume=False,
+                       checkpoint=None, scene_cuts=None, workers=None, **kwargs):
     """
     Creates a static number of new frames between the original frames
     Eg: 2x = 1 original, 1 interpolated; 3x = 1 original, 2 interpolated
+    loop: the frames after the last original lead into the first one instead of duplicating it
+    scene_cuts: filenames that start a new scene, pairs across a cut are filled with duplicates
+    workers: gpu ids to shard the frames across, one engine process per worker
+    Returns the number of output frames
+    """
+    if scene_cuts:
+        _interpolate_scenes(input_folder, output_folder, multiplier, interpolator, set(scene_cuts),
+                            resume=resume, checkpoint=checkpoint, workers=workers, **kwargs)
+    elif workers and (len(workers) > 1):
+        interpolate_sharded(input_folder, output_folder, multiplier, interpolator, workers,
+                            resume=resume, checkpoint=checkpoint, **kwargs)
+    elif interpolator.startswith("dain-ncnn"):
+        interpolate_folder_resumable(input_folder, output_folder, multiplier, "dain-ncnn",
+                                     resume=resume, checkpoint=checkpoint, **kwargs)
+    elif interpolator.startswith("cain-ncnn"):
+        folder_multiplier_handler(input_folder, output_folder, multiplier, engine="cain-ncnn",
+                                  resume=resume, checkpoint=checkpoint, **kwargs)
+    elif interpolator.startswith("rife-ncnn"):
+        folder_multiplier_handler(input_folder, output_folder, multiplier, engine="rife-ncnn",
+                                  resume=resume, checkpoint=checkpoint, **kwargs)
+    else:
+        raise ValueError("Invalid Engine")
+    if loop is True:
+        _interpolate_loop_pair(input_folder, output_folder, multiplier, interpolator, **kwargs)
+    return len(os.listdir(input_folder)) * multiplier
+
+
+def _interpolate_loop_pair(input_folder, output_folder, multiplier, interpolator, **kwargs):
+    """
+    Replaces the duplicates after the last original frame of a static interpolation
+    with the frames between the last and the first original (the video loops)
+    The pair is interpolated on its own through interpolate_static so multi-pass engines work the same way,
+    it's always done again on resume (valid duplicates look the same as finished loop frames)
     """
-    pass
+    inputFiles = [os.path.join(input_folder, file) for file in sorted(os.listdir(input_folder))]
+    loopFiles = [os.path.join(output_folder, FRAME_FILENAME.format((len(inputFiles) - 1) * multiplier + n + 1))
+                 for n in range(1, multiplier)]
+    folderLoop = os.path.join(pathlib.Path(output_folder).parent, pathlib.Path(output_folder).name + "-loop")
+    folderLoopInput = os.path.join(folderLoop, "input")
+    folderLoopOutput = os.path.join(folderLoop, "output")
+    if os.path.isdir(folderLoop):
+        shutil.rmtree(folderLoop)
+    pathlib.Path(folderLoopInput).mkdir(parents=True)
+    for i, inputFile in enumerate([inputFiles[-1], inputFiles[0]]):
+        _link_or_copy(inputFile, os.path.join(folderLoopInput, _scratch_filename(i + 1, inputFile)))
+    print("Loop: interpolating the last frame into the first")
+    interpolate_static(folderLoopInput, folderLoopOutput, multiplier, interpolator, **kwargs)
+    # Output 1 is the last original, outputs 2 to multiplier lead into the first original
+    for n, loopFile in enumerate(loopFiles, start=2):
+        os.replace(os.path.join(folderLoopOutput, FRAME_FILENAME.format(n)), loopFile)
+    shutil.rmtree(folderLoop)
 
 
-def interpolate_dynamic(input_folder, output_folder, original_frame_count, loop=False, **kwargs):
+def _interpolate_pairs(pairs, folder_scratch, multiplier, engine, **kwargs):
+    """
+    Interpolates a list of arbitrary pairs with one folder-mode engine run
+    Pairs that follow on from each other share their frames, separate runs of pairs are concatenated
+    (costs one wasted pair per run instead of a process start per interpolated frame)
+    pairs: (image0_file, image1_file, output_files) where output_files are the (multiplier - 1) in-betweens
+    """
+    # Chain pairs into runs of consecutive frames
+    runs = []
+    for pair in pairs:
+        if runs and runs[-1][-1][1] == pair[0]:
+            runs[-1].append(pair)
+        else:
+            runs.append([pair])
+
+    # Sequence of input frames, each sequence position that starts a real pair remembers its outputs
+    sequenceFiles = []
+    sequenceOutputFiles = {}
+    for run in runs:
+        for image0File, image1File, outputFiles in run:
+            sequenceOutputFiles[len(sequenceFiles)] = outputFiles
+            sequenceFiles.append(image0File)
+        sequenceFiles.append(run[-1][1])
+
+    folderScratchInput = os.path.join(folder_scratch, "input")
+    folderScratchOutput = os.path.join(folder_scratch, "output")
+    if os.path.isdir(folder_scratch):
+        shutil.rmtree(folder_scratch)
+    pathlib.Path(folderScratchInput).mkdir(parents=True)
+    for i, inputFile in enumerate(sequenceFiles):
+        _link_or_copy(inputFile, os.path.join(folderScratchInput, _scratch_filename(i + 1, inputFile)))
+    print("{}x: {} pairs in {} runs".format(multiplier, len(pairs), len(runs)))
+    _run_engine_folder_mode(folderScratchInput, folderScratchOutput, multiplier, engine, **kwargs)
+
+    # Output j is at time-step (j % multiplier) / multiplier between sequence frames j // multiplier
+    for position, outputFiles in sequenceOutputFiles.items():
+        for n, outputFile in enumerate(outputFiles, start=1):
+            scratchOutputFile = os.path.join(folderScratchOutput, FRAME_FILENAME.format(position * multiplier + n + 1))
+            if os.path.isfile(scratchOutputFile):  # Frames the engine skipped are picked up by the caller
+                os.replace(scratchOutputFile, outputFile)
+    shutil.rmtree(folder_scratch)
+
+
+def plan_resample(input_frame_count, input_fps, target_fps, depth=None):
+    """
+    Works out where every output frame of an exact target framerate falls between the input frames
+    Returns one (input_index, fraction) per output frame, the frame is at input_index + fraction
+    depth: round fractions to multiples of 1 / 2^depth for engines that can only make midpoints
+    """
+    inputFps = fractions.Fraction(str(input_fps)).limit_denominator(100000)
+    targetFps = fractions.Fraction(str(target_fps)).limit_denominator(100000)
+    outputFrameCount = max(1, round(input_frame_count * targetFps / inputFps))
+    plan = []
+    for k in range(outputFrameCount):
+        position = fractions.Fraction(k * input_frame_count, outputFrameCount)
+        index = math.floor(position)
+        fraction = position - index
+        if depth is not None:
+            fraction = fractions.Fraction(round(fraction * 2 ** depth), 2 ** depth)
+            if fraction == 1:
+                index, fraction = index + 1, fractions.Fraction(0)
+        if (index > input_frame_count - 1) or ((index == input_frame_count - 1) and fraction > 0):
+            index, fraction = input_frame_count - 1, fractions.Fraction(0)  # Nothing after the last frame
+        plan.append((index, fraction))
+    return plan
+
+
+def resample_depth(input_fps, target_fps, tolerance=RESAMPLE_TOLERANCE):
+    """
+    Smallest midpoint depth that keeps every resampled frame within tolerance output frame intervals of its
+    exact position, rounding to 1 / 2^depth is off by up to 1 / 2^(depth + 1) input frame intervals
+    """
+    if tolerance <= 0:
+        raise ValueError("Resample tolerance must be positive, got {}".format(tolerance))
+    ratio = float(target_fps) / float(input_fps)  # Output frame intervals per input frame interval
+    depth = max(1, math.ceil(math.log2(ratio / tolerance) - 1))
+    if depth > RESAMPLE_MAX_DEPTH:
+        raise ValueError("A resample tolerance of {} needs {} midpoint levels, the limit is {}".format(
+            tolerance, depth, RESAMPLE_MAX_DEPTH))
+    return depth
+
+
+def interpolate_resample(input_folder, output_folder, input_fps, target_fps, interpolator=DEFAULT_INTERPOLATOR,
+                         depth=None, tolerance=RESAMPLE_TOLERANCE, **kwargs):
+    """
+    Interpolates to an exact target framerate, only the frames the output needs are computed
+    dain: one folder-mode run with the output frame count as target_frames, every frame at its exact time
+    cain/rife: only the recursive midpoints the planned output positions depend on
+    depth: midpoint precision for cain/rife (default: from tolerance, see resample_depth)
+    Returns the number of output frames
+    """
+    inputFiles = [os.path.join(input_folder, file) for file in sorted(os.listdir(input_folder))]
+    if depth is None:
+        depth = resample_depth(input_fps, target_fps, tolerance)
+    if interpolator.startswith("dain-ncnn"):
+        outputFrameCount = len(plan_resample(len(inputFiles), input_fps, target_fps))
+        print("Resampling {} frames to {} frames".format(len(inputFiles), outputFrameCount))
+        dain_ncnn_vulkan.interpolate_folder_mode(input_folder, output_folder, target_frames=outputFrameCount, **kwargs)
+        return outputFrameCount
+    plan = plan_resample(len(inputFiles), input_fps, target_fps, depth=depth)
+
+    # Collect every midpoint the planned positions depend on
+    folderResample = os.path.join(pathlib.Path(output_folder).parent, pathlib.Path(output_folder).name + "-resample")
+    folderNodes = os.path.join(folderResample, "nodes")
+    if os.path.isdir(folderResample):
+        shutil.rmtree(folderResample)
+    pathlib.Path(folderNodes).mkdir(parents=True)
+
+    def node_file(index, fraction):
+        if fraction == 0:
+            return inputFiles[index]
+        if fraction == 1:
+            return inputFiles[index + 1]
+        return os.path.join(folderNodes, "{:08d}_{}_{}.png".format(index, fraction.numerator, fraction.denominator))
+
+    nodes = set()
+    pending = [(index, fraction) for index, fraction in plan if fraction != 0]
+    while pending:
+        index, fraction = pending.pop()
+        if (index, fraction) in nodes:
+            continue
+        nodes.add((index, fraction))
+        step = fractions.Fraction(1, fraction.denominator)
+        for parent in (fraction - step, fraction + step):
+            if 0 < parent < 1:
+                pending.append((index, parent))
+    print("Resampling {} frames to {} frames, {} midpoints needed".format(len(inputFiles), len(plan), len(nodes)))
+
+    # Compute level by level (1/2, then 1/4 and 3/4, etc.) each level in one batched engine run
+    for level in range(1, depth + 1):
+        levelNodes = sorted((index, fraction) for index, fraction in nodes if fraction.denominator == 2 ** level)
+        if levelNodes:
+            step = fractions.Fraction(1, 2 ** level)
+            pairs = [(node_file(index, fraction - step), node_file(index, fraction + step),
+                      [node_file(index, fraction)]) for index, fraction in levelNodes]
+            _interpolate_pairs(pairs, os.path.join(folderResample, "level"), 2, interpolator, **kwargs)
+        missingNodes = [node for node in levelNodes if not is_valid_frame(node_file(*node))]
+        if missingNodes:
+            raise RuntimeError("{} midpoints could not be interpolated".format(len(missingNodes)))
+
+    if os.path.isdir(output_folder):
+        shutil.rmtree(output_folder)
+    pathlib.Path(output_folder).mkdir(parents=True)
+    for k, (index, fraction) in enumerate(plan):
+        _copy_frame(node_file(index, fraction), os.path.join(output_folder, FRAME_FILENAME.format(k + 1)), link=True)
+    shutil.rmtree(folderResample)
+    return len(plan)
+
+
+def _timestamp_frame_numbers(input_files, file_numbers, timestamps, framerate):
+    """Places frames at round((pts - first pts) * framerate) + 1, frames sharing a position with the frame before
+    are left out like ffmpeg's -vsync cfr would drop them
+    """
+    files = []
+    frameNumbers = []
+    for inputFile, fileNumber in zip(input_files, file_numbers):
+        if fileNumber > len(timestamps):
+            print("WARNING: No timestamp for {}, leaving it out".format(inputFile))
+            continue
+        frameNumber = round((timestamps[fileNumber - 1] - timestamps[0]) * framerate) + 1
+        if frameNumbers and (frameNumber <= frameNumbers[-1]):
+            continue
+        files.append(inputFile)
+        frameNumbers.append(frameNumber)
+    return files, frameNumbers
+
+
+def interpolate_dynamic(input_folder, output_folder, original_frame_count, loop=False, resume=False, scene_cuts=None,
+                        timestamps=None, framerate=None, **kwargs):
     """
     Creates a dynamic number of new frames that depends on the length of time between each original frame
     Reads frame position from original file names so removed frames are replaced
     Example at 2x: 1.png -> 2.png, 1 interpolated frame inbetween; 1.png -> 3.png, 3 interpolated frames inbetween
     ((gap_frames + 1) * multiplier) - 1 = interpolated_frames
+    The full job list is built up front then ran as one folder-mode batch per frame difference
+    resume: frames that already exist and are valid aren't interpolated again
+    scene_cuts: filenames that start a new scene, gaps before a cut are filled with duplicates
+    timestamps: pts of every frame by file number (ffmpeg.extract_frames_vfr), frame positions are then taken
+    from the real time between frames in 1/framerate steps instead of from file names
     """
-    def dynamic_internal(image0_filename, image1_filename, custom_frame_difference=None):
-        shutil.copyfile(os.path.join(input_folder, image0_filename),os.path.join(output_folder, image0_filename))
-        image0Number = int(image0_filename.split(".")[0])
-        image1Number = int(image1_filename.split(".")[0])
-        print("Image0: {}".format(image0_filename))
-        print("Image1: {}".format(image1_filename))
-        frameDifference = (image1Number - image0Number) if custom_frame_difference is None else custom_frame_difference
-        inbetweenFrames = frameDifference - 1
-        print("Inbetween frames: {}".format(inbetweenFrames))
-        if inbetweenFrames >= 1:
-            for n in range(inbetweenFrames):
-                interpolatedFrameNumber = image0Number + n + 1
-                interpolatedFrameName = "{:06d}.png".format(interpolatedFrameNumber)
-                interpolatedFrameTimeStep = (n + 1) / frameDifference
-                print("Interpolated frame: {} at time-step {}".format(interpolatedFrameName, interpolatedFrameTimeStep))
-                dain_ncnn_vulkan.interpolate_file_mode(os.path.join(input_folder, image0_filename),
-                                                       os.path.join(input_folder, image1_filename),
-                                                       os.path.join(output_folder, interpolatedFrameName),
-                                                       time_step=interpolatedFrameTimeStep,
-                                                       **kwargs)
-        print("")
-
     # Create output_folder if it doesn't exist
     pathlib.Path(output_folder).mkdir(parents=True, exist_ok=True)
-
-    # Run against all frames except last
     inputFolderFiles = sorted(os.listdir(input_folder))
-    for i in range(len(inputFolderFiles)-1):
-        dynamic_internal(inputFolderFiles[i], inputFolderFiles[i+1])
-
-    # Last frame handling
-    frameDifferenceToEnd = (original_frame_count - int(inputFolderFiles[-1].split(".")[0]) + 1)
-    if loop is True:  # image1 is first frame
-        dynamic_internal(inputFolderFiles[-1], inputFolderFiles[0],
-                         custom_frame_difference=frameDifferenceToEnd)
-    else:  # create duplicates til original frame count met
-        shutil.copyfile(os.path.join(input_folder, inputFolderFiles[-1]),
-                        os.path.join(output_folder, inputFolderFiles[-1]))
-        _make_duplicate_frames(os.path.join(input_folder, inputFolderFiles[-1]), output_folder,
-                               (frameDifferenceToEnd - 1))
+
+    # Output frame number of every input frame
+    inputFrameNumbers = [int(filename.split(".")[0]) for filename in inputFolderFiles]
+    if timestamps is not None:
+        inputFolderFiles, inputFrameNumbers = _timestamp_frame_numbers(inputFolderFiles, inputFrameNumbers,
+                                                                       timestamps, framerate)
+
+    # Job list: (image0, image1, image0 number, frame difference)
+    jobs = []
+    for i in range(len(inputFolderFiles) - 1):
+        jobs.append((inputFolderFiles[i], inputFolderFiles[i + 1], inputFrameNumbers[i],
+                     inputFrameNumbers[i + 1] - inputFrameNumbers[i]))
+    # Originals and duplicates are copied in the background while the batches are interpolated
+    with frame_writer.FrameWriter() as writer:
+        # Last frame handling
+        lastNumber = inputFrameNumbers[-1]
+        frameDifferenceToEnd = (original_frame_count - lastNumber + 1)
+        if loop is True:  # image1 is first frame
+            jobs.append((inputFolderFiles[-1], inputFolderFiles[0], lastNumber, frameDifferenceToEnd))
+        else:  # create duplicates til original frame count met
+            _copy_frame(os.path.join(input_folder, inputFolderFiles[-1]),
+                        os.path.join(output_folder, FRAME_FILENAME.format(lastNumber)), writer=writer)
+            _make_duplicate_frames(os.path.join(input_folder, inputFolderFiles[-1]), output_folder,
+                                   (frameDifferenceToEnd - 1), start_number=lastNumber + 1, writer=writer)
+
+        # Originals are copied, gaps are either duplicated (scene cut) or grouped by frame difference
+        pairsByDifference = {}
+        for image0Filename, image1Filename, image0Number, frameDifference in jobs:
+            _copy_frame(os.path.join(input_folder, image0Filename),
+                        os.path.join(output_folder, FRAME_FILENAME.format(image0Number)), writer=writer)
+            if frameDifference < 2:
+                continue
+            interpolatedFiles = [os.path.join(output_folder, FRAME_FILENAME.format(image0Number + n))
+                                 for n in range(1, frameDifference)]
+            if (resume is True) and all(is_valid_frame(file) for file in interpolatedFiles):
+                continue
+            if (scene_cuts is not None) and (image1Filename in scene_cuts):
+                _make_duplicate_frames(os.path.join(input_folder, image0Filename), output_folder, frameDifference - 1,
+                                       start_number=image0Number + 1, writer=writer)
+                continue
+            pairsByDifference.setdefault(frameDifference, []).append((image0Filename, image1Filename, image0Number))
+        print("Interpolating {} gaps in {} batches".format(sum(len(pairs) for pairs in pairsByDifference.values()),
+                                                          len(pairsByDifference)))
+        for frameDifference in sorted(pairsByDifference):
+            pairs = [(os.path.join(input_folder, image0Filename), os.path.join(input_folder, image1Filename),
+                      [os.path.join(output_folder, FRAME_FILENAME.format(image0Number + n))
+                       for n in range(1, frameDifference)])
+                     for image0Filename, image1Filename, image0Number in pairsByDifference[frameDifference]]
+            _interpolate_pairs(pairs, os.path.join(pathlib.Path(output_folder).parent,
+                                                   "{}-batch".format(pathlib.Path(output_folder).name)),
+                               frameDifference, "dain-ncnn", **kwargs)
+
+    # Fall back to file-mode for anything the batches didn't write
+    for image0Filename, image1Filename, image0Number, frameDifference in jobs:
+        if (scene_cuts is not None) and (image1Filename in scene_cuts):
+            continue
+        for n in range(1, frameDifference):
+            interpolatedFile = os.path.join(output_folder, FRAME_FILENAME.format(image0Number + n))
+            if not is_valid_frame(interpolatedFile):
+                print("Interpolated frame: {} at time-step {}".format(interpolatedFile, n / frameDifference))
+                dain_ncnn_vulkan.interpolate_file_mode(os.path.join(input_folder, image0Filename),
+                                                       os.path.join(input_folder, image1Filename),
+                                                       interpolatedFile, time_step=n / frameDifference, **kwargs)
@@ -0,0 +1,165 @@
+"""
+Batch job queue
+
+Runs DAINVulkanCLI.main on many inputs, one step at a time per job so the steps of different jobs overlap:
+step 2 (interpolation) holds the GPU while steps 1 and 3 (ffprobe, extract, dedupe, encode, audio mux)
+of other jobs run on the CPU. Each resource class has its own limit on how many steps use it at once.
+The queue is saved to queue.json in the output folder after every step, running the batch again
+continues from the steps that weren't finished (a step that was interrupted resumes through info.json).
+"""
+# Built-in modules
+import json
+import os
+import pathlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+# Local modules
+import DAINVulkanCLI
+import progress
+
+QUEUE_FILENAME = "queue.json"
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.webm', '.mov', '.avi', '.gif', '.apng')
+DEFAULT_GPU_JOBS = 1
+DEFAULT_CPU_JOBS = 2
+STEP_RESOURCES = {"1": "cpu", "2": "gpu", "3": "cpu"}
+
+
+def find_inputs(inputs):
+    """Expands folders in inputs into the videos they contain"""
+    inputFiles = []
+    for inputPath in inputs:
+        if os.path.isdir(inputPath):
+            inputFiles.extend(sorted(os.path.join(inputPath, file) for file in os.listdir(inputPath)
+                                     if file.lower().endswith(VIDEO_EXTENSIONS)))
+        else:
+            inputFiles.append(inputPath)
+    return [os.path.abspath(inputFile) for inputFile in inputFiles]
+
+
+class JobQueue:
+    """
+    Queue of jobs persisted to output_folder/queue.json
+    Jobs are {"input_file": path, "steps": ["1", "2", "3"], "steps_done": [], "status": "pending"/"done"/"failed"}
+    """
+    def __init__(self, output_folder):
+        self.output_folder = os.path.abspath(output_folder)
+        self.path = os.path.join(self.output_folder, QUEUE_FILENAME)
+        self._lock = threading.Lock()
+        self.jobs = []
+        if os.path.isfile(self.path):
+            with open(self.path) as file:
+                self.jobs = json.load(file)["jobs"]
+
+    def add(self, input_files, steps):
+        """Adds jobs for input_files that aren't queued yet, failed jobs are retried"""
+        with self._lock:
+            queued = {job["input_file"]: job for job in self.jobs}
+            workingFolders = {pathlib.Path(job["input_file"]).stem: job["input_file"] for job in self.jobs}
+            for inputFile in input_files:
+                if inputFile in queued:
+                    if queued[inputFile]["status"] == "failed":
+                        queued[inputFile]["status"] = "pending"
+                        queued[inputFile].pop("error", None)
+                    continue
+                # Jobs share output_folder/<input name> as their working folder
+                inputName = pathlib.Path(inputFile).stem
+                if inputName in workingFolders:
+                    print("WARNING: Skipping \"{}\", it has the same name as \"{}\"".format(
+                        inputFile, workingFolders[inputName]))
+                    continue
+                workingFolders[inputName] = inputFile
+                job = {"input_file": inputFile, "steps": list(steps), "steps_done": [], "status": "pending"}
+                self.jobs.append(job)
+                queued[inputFile] = job
+            self._save()
+
+    def _save(self):
+        pathlib.Path(self.output_folder).mkdir(parents=True, exist_ok=True)
+        queueTempPath = self.path + ".tmp"
+        with open(queueTempPath, "w") as file:
+            json.dump({"jobs": self.jobs}, file, indent=2)
+        os.replace(queueTempPath, self.path)  # Never left half written
+
+    def update(self, job, **values):
+        with self._lock:
+            job.update(values)
+            self._save()
+
+    def pending(self):
+        with self._lock:
+            return [job for job in self.jobs if job["status"] == "pending"]
+
+
+def _run_job(jobs, job, limits, pipelined_steps, final_options, **kwargs):
+    """
+    Runs the remaining steps of job, each while holding its resource
+    final_options: main options only passed with the last step (copying the output, deleting the working folder)
+    """
+    try:
+        for step in job["steps"]:
+            if step in job["steps_done"]:
+                continue
+            stepOptions = dict(kwargs, **final_options) if step == job["steps"][-1] else kwargs
+            # Stream/chunked pipelines run everything in step 3, it needs both resources
+            resources = ["gpu", "cpu"] if pipelined_steps is False else [STEP_RESOURCES[step]]
+            for resource in resources:
+                limits[resource].acquire()
+            try:
+                print("\nBatch: step {} of \"{}\"".format(step, job["input_file"]))
+                DAINVulkanCLI.main(job["input_file"], jobs.output_folder, steps=step, **stepOptions)
+            finally:
+                for resource in resources:
+                    limits[resource].release()
+            jobs.update(job, steps_done=job["steps_done"] + [step])
+        jobs.update(job, status="done")
+    except (Exception, SystemExit) as error:  # main exits on invalid options
+        print("ERROR: \"{}\" failed: {}".format(job["input_file"], error))
+        jobs.update(job, status="failed", error=str(error))
+
+
+def run_batch(inputs, output_folder, gpu_jobs=DEFAULT_GPU_JOBS, cpu_jobs=DEFAULT_CPU_JOBS, **kwargs):
+    """
+    Interpolates every video in inputs (files and/or folders of videos) into output_folder
+    gpu_jobs: steps using the GPU at once, cpu_jobs: steps using the CPU at once
+    kwargs are DAINVulkanCLI.main options, applied to every job
+    """
+    steps = ["1", "2", "3"]
+    if kwargs.get("steps") is not None:
+        steps = [step for step in steps if step in kwargs["steps"].split(",")]
+    kwargs = {key: value for key, value in kwargs.items() if key not in ("steps", "input_file")}
+    # The working folder is needed by every step, it's only copied from/deleted after the last one
+    finalOptions = {key: kwargs.pop(key) for key in ("output_file", "delete_output_folder") if key in kwargs}
+    pipelinedSteps = kwargs.get("pipeline") in (None, "folder")
+    if not pipelinedSteps:
+        steps = ["3"]  # Every step runs in step 3
+
+    jobs = JobQueue(output_folder)
+    jobs.add(find_inputs(inputs), steps)
+    pendingJobs = jobs.pending()
+    print("Batch: {} jobs ({} pending), {} GPU and {} CPU steps at once".format(len(jobs.jobs), len(pendingJobs),
+                                                                              gpu_jobs, cpu_jobs))
+
+    # Events go to one sink for the whole batch instead of one per job, their "job" key tells the jobs apart
+    progressListener = None
+    if kwargs.get("progress_json") is not None:
+        progressListener = progress.JsonLinesSink(kwargs.pop("progress_json"))
+        progress.add_listener(progressListener)
+    if gpu_jobs + cpu_jobs > 1:
+        progress.set_bars_enabled(False)  # Several progress bars at once would draw over each other
+    limits = {"gpu": threading.Semaphore(gpu_jobs), "cpu": threading.Semaphore(cpu_jobs)}
+    try:
+        # A job only waits on one resource at a time, more jobs in flight than steps would only add frames on disk
+        with ThreadPoolExecutor(max_workers=gpu_jobs + cpu_jobs) as executor:
+            for job in pendingJobs:
+                executor.submit(_run_job, jobs, job, limits, pipelinedSteps, finalOptions, **kwargs)
+    finally:
+        progress.set_bars_enabled(True)
+        if progressListener is not None:
+            progress.remove_listener(progressListener)
+            progressListener.close()
+
+    failedJobs = [job for job in jobs.jobs if job["status"] == "failed"]
+    print("\nBatch finished: {} done, {} failed".format(len(jobs.jobs) - len(failedJobs), len(failedJobs)))
+    for job in failedJobs:
+        print("  {}: {}".format(job["input_file"], job.get("error")))
+    return not failedJobs
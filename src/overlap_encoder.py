@@ -0,0 +1,100 @@
+"""
+Overlapped encoding (--overlap-encode)
+
+Starts step 3 while step 2 is still running: a feeder thread watches the interpolated frames folder
+and pipes every frame to ffmpeg as soon as it and every frame before it are fully written,
+so encoding runs on the CPU while the engines use the GPU instead of after them.
+Frames are waited for with interpolator.is_valid_frame and can be deleted once they're piped,
+they're marked with interpolator.set_consumed_frames first so is_valid_frame keeps reporting them as done
+and the missing frame checks of step 2 don't interpolate them again.
+"""
+# Built-in modules
+import os
+import threading
+# Local modules
+import ffmpeg
+import interpolator
+import progress
+
+
+class OverlapEncoder:
+    """
+    Encodes input_folder/00000001.png, 00000002.png, ... into output_file while they're written
+    delete_frames: delete every frame once it's piped to the encoder
+    Call finish() with the number of frames once step 2 is done, stop() abandons the video
+    """
+    def __init__(self, input_folder, output_file, framerate, delete_frames=False, preset=None, threads=None,
+                 verbose=False):
+        self.input_folder = os.path.abspath(input_folder)
+        self.output_file = output_file
+        self.framerate = framerate
+        self.delete_frames = delete_frames
+        self.preset = preset
+        self.threads = threads
+        self.verbose = verbose
+        self.frames_done = 0
+        self._frame_count = None  # Known once step 2 is done
+        self._stopped = threading.Event()
+        self._error = None
+        self._process = None
+        self._thread = None
+
+    def start(self):
+        interpolator.set_consumed_frames(self.input_folder, 0)
+        self._process = ffmpeg.encode_frames_pipe(self.output_file, self.framerate, preset=self.preset,
+                                                  threads=self.threads, verbose=self.verbose)
+        self._thread = threading.Thread(target=progress.bind_job(self._feed), daemon=True)
+        self._thread.start()
+
+    def _feed(self):
+        try:
+            # The engines draw their own bars at the same time
+            with progress.StageProgress("encode", show_bar=False) as stageProgress:
+                while not self._stopped.is_set():
+                    frameCount = self._frame_count
+                    if (frameCount is not None) and (self.frames_done >= frameCount):
+                        break
+                    frameFile = os.path.join(self.input_folder,
+                                             interpolator.FRAME_FILENAME.format(self.frames_done + 1))
+                    if not interpolator.is_valid_frame(frameFile):
+                        if frameCount is not None:  # Step 2 is done, it won't be written anymore
+                            raise RuntimeError("\"{}\" is missing".format(frameFile))
+                        self._stopped.wait(interpolator.PIPELINE_POLL_INTERVAL)
+                        continue
+                    with open(frameFile, "rb") as file:
+                        self._process.stdin.write(file.read())
+                    self.frames_done += 1
+                    if self.delete_frames is True:
+                        # Marked before it's deleted so step 2 never sees it as missing
+                        interpolator.set_consumed_frames(self.input_folder, self.frames_done)
+                        os.remove(frameFile)
+                    stageProgress.update(self.frames_done)
+        except Exception as error:  # Raised by finish()
+            self._error = error
+        finally:
+            try:
+                self._process.stdin.close()  # Finishes the video
+            except OSError:  # ffmpeg already exited
+                pass
+
+    def finish(self, frame_count):
+        """Waits until frame_count frames are encoded"""
+        self._frame_count = frame_count
+        self._thread.join()
+        returnCode = self._process.wait()
+        interpolator.set_consumed_frames(self.input_folder, 0)
+        if self._error is not None:
+            raise RuntimeError("Overlapped encoding failed: {}".format(self._error))
+        if returnCode != 0:
+            raise RuntimeError("FFmpeg encoding failed with exit code {}".format(returnCode))
+
+    def stop(self):
+        """Abandons the video (eg. step 2 failed), does nothing once finished"""
+        if (self._thread is None) or ((not self._thread.is_alive()) and (self._process.poll() is not None)):
+            return
+        self._stopped.set()
+        if self._process.poll() is None:
+            self._process.kill()
+        self._thread.join()
+        self._process.wait()
+        interpolator.set_consumed_frames(self.input_folder, 0)
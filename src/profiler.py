@@ -0,0 +1,199 @@
+"""
+Per-stage profiling (--profile)
+
+Profiler.stage() measures a block of a job: wall time, CPU time of this process and its finished children,
+bytes read/written by this process and its finished children (/proc/self/io, Linux only),
+the size change of a folder and the peak RSS of the largest child process (ffmpeg, engines) that ran during
+the stage, sampled from /proc while the stage runs (Linux only).
+Engine passes and other stages that report through the progress module are recorded as sub-stages
+of the stage that was running when they ended, only the stages of the job the profiler was entered in.
+"""
+# Built-in modules
+import contextlib
+import os
+import threading
+import time
+try:
+    import resource  # Unix only, CPU time and RSS aren't reported without it
+except ImportError:
+    resource = None
+# Local modules
+import progress
+
+RSS_POLL_INTERVAL = 0.5  # Seconds between samples of the child processes' peak RSS
+
+
+def _cpu_time():
+    """User + system CPU time of this process and every finished child process"""
+    if resource is None:
+        return None
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def _children_peak_rss():
+    """Largest peak resident set size (bytes) of the running descendant processes, None without /proc"""
+    parents = {}
+    try:
+        pids = [int(pid) for pid in os.listdir("/proc") if pid.isdigit()]
+    except OSError:
+        return None
+    for pid in pids:
+        try:
+            with open("/proc/{}/stat".format(pid)) as file:
+                parents[pid] = int(file.read().rsplit(")", 1)[1].split()[1])  # The name can contain spaces
+        except (OSError, IndexError, ValueError):  # Exited while listing
+            pass
+    descendants = []
+    searchPids = [os.getpid()]
+    while searchPids:
+        children = [pid for pid, parent in parents.items() if parent in searchPids]
+        descendants.extend(children)
+        searchPids = children
+    peakRss = 0
+    for pid in descendants:
+        try:
+            with open("/proc/{}/status".format(pid)) as file:
+                for line in file:
+                    if line.startswith("VmHWM:"):  # Peak RSS of the process so far
+                        peakRss = max(peakRss, int(line.split()[1]) * 1024)  # Reported in kB
+        except (OSError, ValueError):
+            pass
+    return peakRss
+
+
+def _io_bytes():
+    """(read_bytes, write_bytes) of this process and its waited for children, None if unavailable"""
+    try:
+        with open("/proc/self/io") as file:
+            counters = dict(line.split(": ") for line in file.read().splitlines())
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _folder_size(folder):
+    if (folder is None) or (not os.path.isdir(folder)):
+        return 0
+    total = 0
+    for root, _, files in os.walk(folder):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file))
+            except OSError:  # Deleted while walking (eg. by a pipelined stage)
+                pass
+    return total
+
+
+class Profiler:
+    """
+    Collects one record per stage, disabled profilers measure nothing
+    folder: working folder whose size change is recorded for every stage
+    """
+    def __init__(self, enabled=True, folder=None):
+        self.enabled = enabled
+        self.folder = folder
+        self.records = []
+        self._open = []  # Records of the stages currently running, innermost last
+        self._lock = threading.Lock()
+        self._rss_stop = None  # Set to stop the RSS sampling thread, which runs while a stage is open
+
+    def __enter__(self):
+        if self.enabled is True:
+            progress.add_listener(self._progress_event, job_id=progress.current_job())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.enabled is True:
+            progress.remove_listener(self._progress_event)
+
+    def _progress_event(self, event):
+        if event["event"] != "end":
+            return
+        with self._lock:
+            if not self._open:
+                return
+            self._open[-1]["substages"].append({"name": event["stage"], "frames": event["frames_done"],
+                                                "wall": event["elapsed"], "fps": event["fps_average"]})
+
+    def _sample_rss(self, stop_event):
+        while not stop_event.wait(RSS_POLL_INTERVAL):
+            self._update_rss()
+
+    def _update_rss(self):
+        """Raises the peak child RSS of every open stage to what the running children use now"""
+        peakRss = _children_peak_rss()
+        if peakRss is None:
+            return
+        with self._lock:
+            for record in self._open:
+                record["_rss"] = max(record["_rss"], peakRss)
+
+    def stage(self, name, frames=None):
+        """Context manager measuring a stage, yields its record so frames can be set once they're known"""
+        if self.enabled is False:
+            return contextlib.nullcontext({})
+        return self._stage(name, frames)
+
+    @contextlib.contextmanager
+    def _stage(self, name, frames):
+        record = self.start(name, frames)
+        try:
+            yield record
+        finally:
+            self.finish(record)
+
+    def start(self, name, frames=None):
+        """Starts measuring a stage that doesn't fit in a with block, returns the record to pass to finish()"""
+        record = {"name": name, "frames": frames, "substages": []}
+        if self.enabled is False:
+            return record
+        record["_start"] = (time.perf_counter(), _cpu_time(), _io_bytes(), _folder_size(self.folder))
+        record["_rss"] = None if _children_peak_rss() is None else 0
+        with self._lock:
+            self._open.append(record)
+            if (self._rss_stop is None) and (record["_rss"] is not None):
+                self._rss_stop = threading.Event()
+                threading.Thread(target=self._sample_rss, args=(self._rss_stop,), daemon=True).start()
+        return record
+
+    def finish(self, record):
+        if self.enabled is False:
+            return
+        wallStart, cpuStart, ioStart, folderStart = record.pop("_start")
+        record["wall"] = time.perf_counter() - wallStart
+        record["cpu"] = None if cpuStart is None else _cpu_time() - cpuStart
+        ioEnd = _io_bytes()
+        record["read_bytes"] = None if ioStart is None else ioEnd[0] - ioStart[0]
+        record["write_bytes"] = None if ioStart is None else ioEnd[1] - ioStart[1]
+        record["folder_bytes"] = _folder_size(self.folder) - folderStart
+        self._update_rss()  # Children that are still running
+        record["fps"] = record["frames"] / record["wall"] if record["frames"] and record["wall"] > 0 else None
+        with self._lock:
+            record["child_max_rss"] = record.pop("_rss")
+            self._open.remove(record)
+            self.records.append(record)
+            if (not self._open) and (self._rss_stop is not None):
+                self._rss_stop.set()
+                self._rss_stop = None
+
+    def summary(self):
+        """Summary table of the records as a string"""
+        def value(number, scale=1, form="{:.2f}"):
+            return "-" if number is None else form.format(number / scale)
+
+        lines = ["{:<24} {:>9} {:>9} {:>8} {:>9} {:>10} {:>10} {:>11} {:>9}".format(
+            "stage", "wall s", "cpu s", "frames", "fps", "read MB", "write MB", "folder MB", "rss MB")]
+        for record in self.records:
+            lines.append("{:<24} {:>9} {:>9} {:>8} {:>9} {:>10} {:>10} {:>11} {:>9}".format(
+                record["name"], value(record["wall"]), value(record["cpu"]), value(record["frames"], form="{:.0f}"),
+                value(record["fps"]), value(record["read_bytes"], 1000000, "{:.1f}"),
+                value(record["write_bytes"], 1000000, "{:.1f}"), value(record["folder_bytes"], 1000000, "{:.1f}"),
+                value(record["child_max_rss"], 1000000, "{:.0f}")))
+            for substage in record["substages"]:
+                lines.append("  {:<22} {:>9} {:>9} {:>8} {:>9}".format(
+                    substage["name"], value(substage["wall"]), "-", substage["frames"], value(substage["fps"])))
+        return "\n".join(lines)
@@ -0,0 +1,168 @@
+"""
+Progress events
+
+Every long running stage (ffmpeg extraction/encoding, interpolation engines) reports through StageProgress,
+which draws the alive_bar and sends events to the listeners added with add_listener
+so the CLI, the GUI and external monitoring all get the same data.
+Stages started inside job_scope(job_id) are tagged with the job, listeners added with a job_id only get
+the events of that job so jobs running at the same time (batch mode) don't mix.
+
+Events are dicts:
+{"stage": "extract", "job": input file of the job (None outside of a job), "event": "start"/"progress"/"end"/"error",
+ "time": unix time, "elapsed": seconds since start,
+ "frames_done": 120, "frames_total": 480 (None if unknown), "fps": 31.2 (since the last event), "fps_average": 29.8,
+ "eta": 12.0 (seconds, None if unknown), "message": error message (error events only)}
+"""
+# Built-in modules
+import contextlib
+import json
+import sys
+import threading
+import time
+# External modules
+from alive_progress import alive_bar
+
+PROGRESS_INTERVAL = 0.5  # Minimum seconds between progress events of a stage
+
+_listeners = []  # (callback, job_id)
+_lock = threading.Lock()
+_bars_enabled = True
+_job_local = threading.local()
+
+
+def add_listener(callback, job_id=None):
+    """
+    callback(event) is called for every event, from the thread running the stage
+    job_id: only the events of stages started in that job, every event if None
+    """
+    with _lock:
+        _listeners.append((callback, job_id))
+
+
+def remove_listener(callback):
+    with _lock:
+        _listeners[:] = [listener for listener in _listeners if listener[0] != callback]
+
+
+def current_job():
+    """Job of the calling thread, None outside of job_scope"""
+    return getattr(_job_local, "job_id", None)
+
+
+@contextlib.contextmanager
+def job_scope(job_id):
+    """Stages started by this thread inside the block belong to job_id"""
+    previousJob = current_job()
+    _job_local.job_id = job_id
+    try:
+        yield
+    finally:
+        _job_local.job_id = previousJob
+
+
+def bind_job(target):
+    """Wraps a thread target so the stages it starts belong to the job of the thread creating it"""
+    jobId = current_job()
+
+    def run(*args, **kwargs):
+        with job_scope(jobId):
+            return target(*args, **kwargs)
+    return run
+
+
+def set_bars_enabled(enabled):
+    """Turns alive_bar drawing on/off for every stage (eg. while several jobs run at once), events are still sent"""
+    global _bars_enabled
+    _bars_enabled = enabled
+
+
+def emit(event):
+    with _lock:
+        listeners = list(_listeners)
+    for callback, jobId in listeners:
+        if (jobId is None) or (event.get("job") == jobId):
+            callback(event)
+
+
+class JsonLinesSink:
+    """Listener that writes one JSON object per line to a file ("-" for stdout)"""
+    def __init__(self, path):
+        self._file = sys.stdout if path == "-" else open(path, "a")
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self._file.write(json.dumps(event) + "\n")
+            self._file.flush()
+
+    def close(self):
+        if self._file is not sys.stdout:
+            self._file.close()
+
+
+class StageProgress:
+    """
+    Tracks the frames done by one stage, use as a context manager around the stage
+    An exception leaving the context is reported as an error event
+    show_bar: draw an alive_bar (disabled when several stages run at once)
+    """
+    def __init__(self, stage, frames_total=None, show_bar=True):
+        self.stage = stage
+        self.job = current_job()  # Events sent from other threads still belong to the job that started the stage
+        self.frames_total = frames_total
+        self.frames_done = 0
+        self._show_bar = show_bar
+        self._bar_context = None
+        self._bar = None
+        self._time_start = None
+        self._last_time = None
+        self._last_frames = 0
+
+    def __enter__(self):
+        if (self._show_bar is True) and (_bars_enabled is True):
+            self._bar_context = alive_bar(self.frames_total, enrich_print=False)
+            self._bar = self._bar_context.__enter__()
+        self._time_start = self._last_time = time.time()
+        self._emit("start")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._emit("end")
+        else:
+            self._emit("error", message=str(exc_value) or exc_type.__name__)
+        if self._bar_context is not None:
+            self._bar_context.__exit__(exc_type, exc_value, traceback)
+
+    def update(self, frames_done):
+        """Sets the absolute number of frames done"""
+        if (self._bar is not None) and (frames_done > self.frames_done):
+            self._bar(incr=frames_done - self.frames_done)
+        self.frames_done = frames_done
+        self._emit("progress")
+
+    def advance(self, frames=1):
+        self.update(self.frames_done + frames)
+
+    def error(self, message):
+        """Reports an error that doesn't stop the stage"""
+        self._emit("error", message=message)
+
+    def _emit(self, event_type, message=None):
+        now = time.time()
+        if (event_type == "progress") and (now - self._last_time < PROGRESS_INTERVAL):
+            return
+        elapsed = now - self._time_start
+        fpsAverage = self.frames_done / elapsed if elapsed > 0 else 0.0
+        fps = (self.frames_done - self._last_frames) / (now - self._last_time) if now > self._last_time else 0.0
+        eta = None
+        if (self.frames_total is not None) and (fpsAverage > 0):
+            eta = max(self.frames_total - self.frames_done, 0) / fpsAverage
+        event = {"stage": self.stage, "job": self.job, "event": event_type, "time": now, "elapsed": elapsed,
+                 "frames_done": self.frames_done, "frames_total": self.frames_total, "fps": fps,
+                 "fps_average": fpsAverage, "eta": eta}
+        if message is not None:
+            event["message"] = message
+        self._last_time = now
+        self._last_frames = self.frames_done
+        emit(event)
@@ -11,8 +11,7 @@ import shutil
 import subprocess
 # Local modules
 import definitions
-# External modules
-from alive_progress import alive_bar
+import progress
 
 # Interpolation Defaults
 DEFAULT_GPU_ID = "auto"
@@ -36,7 +35,7 @@ def interpolate_file_mode(input0_file, input1_file, output_file,
 
 def interpolate_folder_mode(input_folder, output_folder,
                             gpu_id=DEFAULT_GPU_ID, threads=DEFAULT_THREADS,
-                            verbose=False, **kwargs):
+                            verbose=False, show_progress=True, **kwargs):
     """Folder-mode Interpolation"""
     target_frames = len(os.listdir(input_folder)) * 2
 
@@ -53,14 +52,15 @@ def interpolate_folder_mode(input_folder, output_folder,
     if verbose is True:
         print(" ".join(cmd))
     # subprocess.run(cmd, cwd=definitions.RIFE_NCNN_VULKAN_LOCATION)
-    with alive_bar(target_frames, enrich_print=False) as bar:
+    # Progress bar can be disabled when several engine processes run at once
+    with progress.StageProgress("rife-ncnn", target_frames, show_bar=show_progress) as stageProgress:
         with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                               cwd=definitions.RIFE_NCNN_VULKAN_LOCATION, bufsize=1, universal_newlines=True) as process:
             for line in process.stderr:
                 if line.startswith("["):  # Starting GPU info
                     print(line, end="")
                 elif line.endswith("done\n"):  # Verbose progress output
-                    bar()
+                    stageProgress.advance()
                 elif line.startswith(("find_blob_index_by_name", "fopen")):  # Model not found error
                     raise OSError("Model not found: {}".format(line.replace("\n", "")))
                 elif line.startswith("vkAllocateMemory failed"):  # VRAM memory error
@@ -69,3 +69,5 @@ def interpolate_folder_mode(input_folder, output_folder,
                     raise RuntimeError("Vulkan error: {}".format(line.replace("\n", "")))
                 else:
                     print(line, end="")
+        if process.wait() != 0:  # Crashes without one of the errors above
+            raise RuntimeError("rife-ncnn-vulkan exited with code {}".format(process.returncode))
@@ -2,83 +2,263 @@
 RIFE PyTorch implementation
 """
 # Built-in modules
-# import numpy
 import os
 import pathlib
 import shutil
+import sys
+import time
 import warnings
 # Local modules
 import definitions
-import RIFE.model.RIFE as RIFE  # import from submodule
+import frame_store
+import frame_writer
 # External modules
 from alive_progress import alive_bar
-import cv2
-import torch
-from torch.nn import functional
 
 DEFAULT_MULTIPLIER = 2
+DEFAULT_BATCH_SIZE = 4  # Pairs stacked into one forward pass
+DEFAULT_BENCHMARK_BATCH_SIZES = [1, 2, 4, 8]
+DEFAULT_DEVICE = "auto"  # CUDA when it's available, else CPU
+DEFAULT_PRECISION = "fp32"
+PRECISIONS = ["fp32", "fp16"]
 
-# Init device and model on import
-if torch.cuda.is_available():
-    print("RIFE: Using PyTorch CUDA backend")
-    pytorch_device = torch.device("cuda")
-    torch.set_grad_enabled(False)
-    torch.backends.cudnn.enabled = True
-    torch.backends.cudnn.benchmark = True
-else:
-    print("RIFE: Using PyTorch CPU backend")
-    pytorch_device = torch.device("cpu")
+# torch, cv2 and the model are only imported/loaded on first use so importing this module is cheap
+cv2 = None
+numpy = None
+torch = None
+functional = None
+RIFE = None
+_model_handle = None
 
-rife_model = RIFE.Model()
-rife_model.load_model(definitions.RIFE_MODEL)
-rife_model.eval()
-rife_model.device()
 
-warnings.filterwarnings("ignore")  # Supress console warnings
+def _import_backend():
+    global cv2, numpy, torch, functional, RIFE
+    if torch is None:
+        import cv2
+        import numpy
+        import torch
+        from torch.nn import functional
+        import RIFE.model.RIFE as RIFE  # import from submodule
+
+
+def _rife_modules():
+    """RIFE's modules, they pick a device at import that tensors they create (eg. the warp grid) are put on"""
+    modules = {RIFE}
+    for name in ("warp", "IFNet", "ContextNet", "FusionNet"):
+        if hasattr(RIFE, name):
+            modules.add(sys.modules[getattr(RIFE, name).__module__])
+    return modules
+
+
+class ModelHandle:
+    """
+    Loaded RIFE model and the settings it was loaded with, reused by every interpolate_* call
+    device: "auto", "cpu", "cuda" or "cuda:N"; precision: "fp32" or "fp16" (CUDA only)
+    fp16 runs under autocast, weights and frames stay fp32 since RIFE's warp grid is always created in fp32
+    threads: torch intra-op threads (None keeps torch's default)
+    """
+    def __init__(self, device=DEFAULT_DEVICE, precision=DEFAULT_PRECISION, threads=None):
+        _import_backend()
+        if precision not in PRECISIONS:
+            raise ValueError("Invalid precision: {} (available: {})".format(precision, ", ".join(PRECISIONS)))
+        if device == "auto":
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        if (self.device.type == "cuda") and not torch.cuda.is_available():
+            raise ValueError("Device {} requested but CUDA isn't available".format(device))
+        if self.device.type not in ("cpu", "cuda"):
+            raise ValueError("Invalid device: {} (available: auto, cpu, cuda, cuda:N)".format(device))
+        if (self.device.type == "cpu") and (precision == "fp16"):
+            raise ValueError("fp16 precision requires a CUDA device")
+        self.precision = precision
+        self.dtype = torch.float32
+        print("RIFE: Using PyTorch {} backend ({})".format(self.device.type.upper(), precision))
+        if self.device.type == "cuda":
+            torch.backends.cudnn.enabled = True
+            torch.backends.cudnn.benchmark = True
+        set_threads(intra_op_threads=threads)
+        warnings.filterwarnings("ignore")  # Supress console warnings
+
+        # model.device() would always pick CUDA when present, RIFE's modules are pointed at our device instead
+        for module in _rife_modules():
+            if hasattr(module, "device"):
+                module.device = self.device
+            if hasattr(module, "backwarp_tenGrid"):
+                module.backwarp_tenGrid.clear()  # Grids cached on another device
+        self.model = RIFE.Model()
+        self.model.load_model(definitions.RIFE_MODEL)
+        self.model.eval()
+        for subnet in vars(self.model).values():  # flownet, contextnet, fusionnet
+            if isinstance(subnet, torch.nn.Module):
+                subnet.to(self.device)
+
+    def inference(self, images0, images1):
+        with torch.no_grad(), torch.autocast(self.device.type, dtype=torch.float16,
+                                             enabled=self.precision == "fp16"):
+            return self.model.inference(images0, images1).to(self.dtype)
+
+    def warmup(self, width=256, height=256):
+        """Runs one inference so allocations (and cudnn autotuning) happen before the first real frame"""
+        image = torch.rand(1, 3, height, width, device=self.device, dtype=self.dtype)
+        self.inference(_pad_tensor(image), _pad_tensor(image))
+        if self.device.type == "cuda":
+            torch.cuda.synchronize()
+
+
+def load_model(device=DEFAULT_DEVICE, precision=DEFAULT_PRECISION, threads=None, warmup=False):
+    """Loads the model used by the interpolate_* functions, replacing the cached one"""
+    global _model_handle
+    _model_handle = ModelHandle(device, precision, threads)
+    if warmup is True:
+        _model_handle.warmup()
+    return _model_handle
+
+
+def get_model():
+    """Returns the cached model, loading it with the default settings on first use"""
+    if _model_handle is None:
+        load_model()
+    return _model_handle
 
 
 def _read_image_dimensions(image_path):
-    image = cv2.imread(image_path)
-    image = (torch.tensor(image.transpose(2, 0, 1)).to(pytorch_device) / 255.).unsqueeze(0)
-    n, c, height, width = image.shape
+    _import_backend()
+    height, width = cv2.imread(image_path).shape[:2]
     return [height, width]
 
 
+def _to_tensor(image):
+    """HxWx3 uint8 BGR array -> padded 1x3xHxW tensor on the model's device"""
+    handle = get_model()
+    image = (torch.tensor(image.transpose(2, 0, 1).copy()).to(handle.device, dtype=handle.dtype) / 255.).unsqueeze(0)
+    return _pad_tensor(image)
+
+
 def _read_image(image_path):
-    image = cv2.imread(image_path)
-    image = (torch.tensor(image.transpose(2, 0, 1)).to(pytorch_device) / 255.).unsqueeze(0)
+    _import_backend()
+    return _to_tensor(cv2.imread(image_path))
+
+
+def _tensor_to_array(image, height, width):
+    """Padded 1x3xHxW tensor -> HxWx3 uint8 BGR array"""
+    return (image[0] * 255).byte().cpu().numpy().transpose(1, 2, 0)[:height, :width]
+
+
+def _write_image(output_file, image, height, width, writer=None):
+    """Writes a padded tensor, on the writer's threads when one is given so inference doesn't wait on compression"""
+    array = _tensor_to_array(image, height, width)
+    if writer is None:
+        cv2.imwrite(output_file, array)
+    else:
+        writer.write_array(output_file, numpy.ascontiguousarray(array[:, :, ::-1]))  # BGR -> RGB
+
+
+def _pad_tensor(image):
     n, c, height, width = image.shape
     padding_height = ((height - 1) // 32 + 1) * 32
     padding_width = ((width - 1) // 32 + 1) * 32
     padding = (0, padding_width - width, 0, padding_height - height)
-    image = functional.pad(image, padding)
-    return image
+    return functional.pad(image, padding)
+
 
+def set_threads(intra_op_threads=None, inter_op_threads=None):
+    """Sets the threads torch uses inside an operation (intra-op) and to run operations in parallel (inter-op)
+    None keeps torch's default, inter-op threads can only be changed before the first forward pass
+    """
+    _import_backend()
+    if intra_op_threads is not None:
+        torch.set_num_threads(int(intra_op_threads))
+    if inter_op_threads is not None:
+        try:
+            torch.set_num_interop_threads(int(inter_op_threads))
+        except RuntimeError:
+            warnings.warn("RIFE: inter-op threads can't be changed after inference has started")
 
-# def _write_image():
-#     pass
 
+def _inference_batch(pairs):
+    """Interpolates the middle frame of several (image0, image1) pairs in one forward pass
+    Pairs of different sizes can't be stacked so they fall back to one pass each
+    """
+    handle = get_model()
+    if (len(pairs) == 1) or any(image.shape != pairs[0][0].shape for pair in pairs for image in pair):
+        return [handle.inference(image0, image1) for image0, image1 in pairs]
+    images0 = torch.cat([image0 for image0, image1 in pairs])
+    images1 = torch.cat([image1 for image0, image1 in pairs])
+    return list(handle.inference(images0, images1).split(1))
 
-def interpolate_file_mode(input0_file, input1_file, output_file):
+
+def _interpolate_block(images, depth, batch_size=DEFAULT_BATCH_SIZE):
+    """Interpolates every pair of consecutive images to 2^depth, one level at a time in batches of batch_size pairs
+    Returns the frames for every pair in order (each image followed by its in-betweens, the last image excluded)
+    """
+    frames = list(images)
+    for _ in range(depth):
+        pairs = list(zip(frames[:-1], frames[1:]))
+        mids = []
+        for i in range(0, len(pairs), batch_size):
+            mids.extend(_inference_batch(pairs[i:i + batch_size]))
+        framesNext = []
+        for frame, mid in zip(frames[:-1], mids):
+            framesNext.extend([frame, mid])
+        framesNext.append(frames[-1])
+        frames = framesNext
+    return frames[:-1]
+
+
+def _interpolate_recursive(image0, image1, depth):
+    """Yields the (2^depth - 1) evenly spaced frames between image0 and image1 in order
+    Only the frames on the current branch (at most depth) are held in memory
+    """
+    if depth == 0:
+        return
+    mid = get_model().inference(image0, image1)
+    yield from _interpolate_recursive(image0, mid, depth - 1)
+    yield mid
+    yield from _interpolate_recursive(mid, image1, depth - 1)
+
+
+def interpolate_frame_bytes(frame0, frame1, width, height, multiplier=DEFAULT_MULTIPLIER):
+    """Interpolates between two raw rgb24 frames (used by the streaming pipeline)
+    Returns the (multiplier - 1) in-between frames as raw rgb24 bytes
+    """
+    if not ((multiplier & (multiplier - 1) == 0) and multiplier > 1):  # Check if not a power of 2
+        raise ValueError("Multiplier must be a power of 2 (2, 4, 8, etc.)")
+    _import_backend()
+    images = [_to_tensor(numpy.frombuffer(frame, dtype=numpy.uint8).reshape(height, width, 3)[:, :, ::-1])  # -> BGR
+              for frame in (frame0, frame1)]
+    outputs = _interpolate_recursive(images[0], images[1], multiplier.bit_length() - 1)
+    return [numpy.ascontiguousarray((output[0] * 255).byte().cpu().numpy().transpose(1, 2, 0)[:height, :width, ::-1])
+            .tobytes() for output in outputs]
+
+
+def interpolate_file_mode(input0_file, input1_file, output_file, writer=None):
+    """File-mode Interpolation, a shared frame_writer.FrameWriter can be passed in when calling it repeatedly"""
     height, width = _read_image_dimensions(input0_file)
     image0 = _read_image(input0_file)
     image1 = _read_image(input1_file)
 
-    output = rife_model.inference(image0, image1)  # Interpolation
+    output = get_model().inference(image0, image1)  # Interpolation
 
     pathlib.Path(os.path.dirname(output_file)).mkdir(parents=True, exist_ok=True)  # Create output_folder
 
-    cv2.imwrite(output_file,
-                (output[0] * 255).byte().cpu().numpy().transpose(1, 2, 0)[:height, :width])  # Write to output
+    _write_image(output_file, output, height, width, writer)  # Write to output
 
 
-def interpolate_folder_mode(input_folder, output_folder, multiplier=DEFAULT_MULTIPLIER):
-    # TODO srite images during interpolation to avoid disk write bottleneck at end
+def interpolate_folder_mode(input_folder, output_folder, multiplier=DEFAULT_MULTIPLIER, batch_size=DEFAULT_BATCH_SIZE,
+                            png_compression=frame_writer.DEFAULT_PNG_COMPRESSION):
+    """Folder-mode Interpolation
+    Frames are read batch_size pairs at a time and every multiplier is done on that block,
+    outputs are handed to a frame writer as soon as the block is done so memory use doesn't depend on the length
+    of the clip and inference doesn't wait on png compression
+    batch_size: pairs stacked into one forward pass, higher keeps more cores busy on CPU
+    """
+    if not ((multiplier & (multiplier - 1) == 0) and multiplier > 1):  # Check if not a power of 2
+        raise ValueError("Multiplier must be a power of 2 (2, 4, 8, etc.)")
     # List images in folder
     input_files_path = []
     for filePath in pathlib.Path(input_folder).glob('**/*'):  # List all files in the directory as their absolute path
         file_path_absolute = os.path.normpath(filePath.absolute())
-        if file_path_absolute.endswith(('.png', '.jpg', '.jpeg', '.webp', '.bmp')):
+        if file_path_absolute.endswith(('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.ppm')):
             # Only adds files that have image extensions, fixes problems caused by "Thumbs.db"
             input_files_path.append(file_path_absolute)
     input_files_path.sort()
@@ -86,35 +266,116 @@ def interpolate_folder_mode(input_folder, output_folder, multiplier=DEFAULT_MULT
     # Read frame dimensions from first frame
     height, width = _read_image_dimensions(input_files_path[0])
 
-    # Read files
-    input_files = []
-    for i in range(len(input_files_path)):
-        # print(i)
-        input_files.append(_read_image(input_files_path[i]))
-
-    # Interpolate
-    multiplier_internal = 1
-    while multiplier_internal < multiplier:
-        multiplier_internal = multiplier_internal * 2
-        print("Interpolating to {}x:".format(multiplier_internal))
-        with alive_bar(len(input_files) * 2, enrich_print=False) as bar:
-            output_files = []
-            for j in range(len(input_files) - 1):
-                # print(input_files_path[j], input_files_path[j + 1])
-                mid = rife_model.inference(input_files[j], input_files[j + 1])
-                output_files.append(input_files[j])
-                bar()
-                output_files.append(mid)
-                bar()
-            for _ in range(2):  # Duplicate last frame twice
-                output_files.append(input_files[-1])
-                bar()
-        if multiplier_internal < multiplier:
-            input_files = output_files
-
     if os.path.isdir(output_folder):  # Delete output_folder if it exists to avoid conflicts
         shutil.rmtree(output_folder)
     pathlib.Path(output_folder).mkdir(parents=True, exist_ok=True)  # Create output_folder
-    for i in range(len(output_files)):
-        cv2.imwrite(os.path.join(output_folder, "{:06d}.png".format(i + 1)),
-                    (output_files[i][0] * 255).byte().cpu().numpy().transpose(1, 2, 0)[:height, :width])
+
+    # Interpolate, only the current block of batch_size + 1 input frames is kept in memory
+    depth = multiplier.bit_length() - 1
+    output_count = 0
+    with frame_writer.FrameWriter(png_compression=png_compression) as writer, \
+            alive_bar(len(input_files_path) * multiplier, enrich_print=False) as bar:
+        block = [_read_image(input_files_path[0])]
+        for j in range(1, len(input_files_path) + 1):
+            if j < len(input_files_path):
+                block.append(_read_image(input_files_path[j]))
+                if (len(block) <= batch_size) and (j + 1 < len(input_files_path)):
+                    continue
+                outputs = _interpolate_block(block, depth, batch_size)
+            else:  # Duplicate last frame
+                outputs = [block[0]] * multiplier
+            for output in outputs:
+                output_count += 1
+                _write_image(os.path.join(output_folder, "{:06d}.png".format(output_count)), output, height, width,
+                             writer)
+                bar()
+            block = block[-1:]  # Last frame of the block starts the next one
+    print(writer.report())
+
+
+def interpolate_frame_store(input_store, output_store, multiplier=DEFAULT_MULTIPLIER, batch_size=DEFAULT_BATCH_SIZE):
+    """Same as interpolate_folder_mode between two frame stores (frame_store module)
+    Input frames are read from the memory-mapped store, dropped frames are skipped
+    """
+    if not ((multiplier & (multiplier - 1) == 0) and multiplier > 1):  # Check if not a power of 2
+        raise ValueError("Multiplier must be a power of 2 (2, 4, 8, etc.)")
+    depth = multiplier.bit_length() - 1
+    with frame_store.FrameStore(input_store) as inputStore, \
+            frame_store.FrameStore(output_store, "w", inputStore.width, inputStore.height) as outputStore:
+        height, width = inputStore.height, inputStore.width
+        indices = inputStore.live_indices()
+        with alive_bar(len(indices) * multiplier, enrich_print=False) as bar:
+            block = [_to_tensor(inputStore.frame(indices[0])[:, :, ::-1])]  # RGB -> BGR
+            for j in range(1, len(indices) + 1):
+                if j < len(indices):
+                    block.append(_to_tensor(inputStore.frame(indices[j])[:, :, ::-1]))
+                    if (len(block) <= batch_size) and (j + 1 < len(indices)):
+                        continue
+                    outputs = _interpolate_block(block, depth, batch_size)
+                else:  # Duplicate last frame
+                    outputs = [block[0]] * multiplier
+                for output in outputs:
+                    outputStore.append(_tensor_to_array(output, height, width)[:, :, ::-1])
+                    bar()
+                block = block[-1:]  # Last frame of the block starts the next one
+
+
+def benchmark(batch_sizes=None, width=640, height=360, frames=32, **kwargs):
+    """Measures output frames per second of batched inference for each batch size on this machine
+    Uses random frames so no input files are needed, returns {batch_size: fps}
+    """
+    if batch_sizes is None:
+        batch_sizes = DEFAULT_BENCHMARK_BATCH_SIZES
+    set_threads(**kwargs)
+    handle = get_model()
+    images = [_pad_tensor(torch.rand(1, 3, height, width, device=handle.device, dtype=handle.dtype))
+              for _ in range(frames + 1)]
+    handle.warmup(width, height)
+    results = {}
+    for batch_size in batch_sizes:
+        timeStart = time.perf_counter()
+        _interpolate_block(images, 1, batch_size)
+        if handle.device.type == "cuda":
+            torch.cuda.synchronize()
+        results[batch_size] = frames / (time.perf_counter() - timeStart)
+        print("Batch size {}: {:.2f} frames/sec".format(batch_size, results[batch_size]))
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input-folder", help="Path of directory containing frames")
+    parser.add_argument("-o", "--output-folder", help="Path of directory to write the interpolated frames to")
+    parser.add_argument("-m", "--multiplier", type=int, default=DEFAULT_MULTIPLIER,
+                        help="Frame multiplier, a power of 2 (default={})".format(DEFAULT_MULTIPLIER))
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Pairs interpolated in one forward pass (default={})".format(DEFAULT_BATCH_SIZE))
+    parser.add_argument("--device", default=DEFAULT_DEVICE,
+                        help="Torch device: auto, cpu, cuda or cuda:N (default={})".format(DEFAULT_DEVICE))
+    parser.add_argument("--precision", default=DEFAULT_PRECISION, choices=PRECISIONS,
+                        help="Model precision, fp16 requires CUDA (default={})".format(DEFAULT_PRECISION))
+    parser.add_argument("--png-compression", type=int, default=frame_writer.DEFAULT_PNG_COMPRESSION,
+                        help="PNG compression level 0-9 (default={})".format(frame_writer.DEFAULT_PNG_COMPRESSION))
+    parser.add_argument("--intra-op-threads", type=int, help="Threads used inside an operation (default=torch's)")
+    parser.add_argument("--inter-op-threads", type=int, help="Threads used across operations (default=torch's)")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Report frames/sec for each batch size in --benchmark-batch-sizes on this machine")
+    parser.add_argument("--benchmark-batch-sizes", default=",".join(map(str, DEFAULT_BENCHMARK_BATCH_SIZES)),
+                        help="Comma separated batch sizes to benchmark (default=%(default)s)")
+    parser.add_argument("--benchmark-size", default="640x360", help="Frame size used by the benchmark (WxH)")
+    parser.add_argument("--benchmark-frames", type=int, default=32, help="Frames interpolated per batch size")
+    args = vars(parser.parse_args())
+    if not (args["benchmark"] or (args["input_folder"] and args["output_folder"])):
+        parser.error("Requires either --benchmark or both --input-folder and --output-folder")
+    threadOptions = {"intra_op_threads": args["intra_op_threads"], "inter_op_threads": args["inter_op_threads"]}
+    set_threads(**threadOptions)  # Before the model is loaded, inter-op threads can't change after first use
+    load_model(args["device"], args["precision"])
+
+    if args["benchmark"] is True:
+        benchmarkWidth, benchmarkHeight = (int(value) for value in args["benchmark_size"].split("x"))
+        benchmark([int(size) for size in args["benchmark_batch_sizes"].split(",")], benchmarkWidth, benchmarkHeight,
+                  args["benchmark_frames"])
+    else:
+        interpolate_folder_mode(args["input_folder"], args["output_folder"], args["multiplier"], args["batch_size"],
+                                args["png_compression"])
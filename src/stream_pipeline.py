@@ -0,0 +1,150 @@
+"""
+Streaming pipeline (steps 1, 2 and 3 without intermediate files)
+
+FFmpeg decodes the input to rawvideo on stdout, frames go through a bounded queue
+into the interpolator and the results are piped straight into an ffmpeg encoder on stdin.
+Memory use is capped by the queue depth instead of the length of the video.
+
+Engines are plain functions: engine(frame0, frame1, width, height, multiplier)
+returning the (multiplier - 1) in-between frames as raw rgb24 bytes
+"""
+# Built-in modules
+import queue
+import threading
+# Local modules
+import ffmpeg
+import ffprobe
+# External modules
+from alive_progress import alive_bar
+
+DEFAULT_QUEUE_DEPTH = 16
+DEFAULT_MULTIPLIER = 2
+
+_END_OF_STREAM = None  # Queue sentinel
+
+
+def _engine_blend(frame0, frame1, width, height, multiplier):
+    """CPU engine: linear cross-fade between the two frames, no AI model required"""
+    from PIL import Image
+    image0 = Image.frombytes("RGB", (width, height), frame0)
+    image1 = Image.frombytes("RGB", (width, height), frame1)
+    return [Image.blend(image0, image1, i / multiplier).tobytes() for i in range(1, multiplier)]
+
+
+def _engine_rife_pytorch(frame0, frame1, width, height, multiplier):
+    import rife_pytorch  # Imported here since torch is an optional dependency
+    return rife_pytorch.interpolate_frame_bytes(frame0, frame1, width, height, multiplier)
+
+
+STREAM_ENGINES = {
+    "blend": _engine_blend,
+    "rife": _engine_rife_pytorch
+}
+
+
+def register_engine(name, engine):
+    """Adds an engine function that can then be selected by name"""
+    STREAM_ENGINES[name] = engine
+
+
+def _queue_put(frame_queue, item, stop_event):
+    """Put that gives up once the pipeline has been stopped, avoids deadlocking on a full queue"""
+    while not stop_event.is_set():
+        try:
+            frame_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _queue_get(frame_queue, stop_event):
+    """Get that returns the end of stream once the pipeline has been stopped, even if the sentinel never came"""
+    while True:
+        try:
+            return frame_queue.get(timeout=0.1)
+        except queue.Empty:
+            if stop_event.is_set():
+                return _END_OF_STREAM
+
+
+def interpolate_stream(input_file, output_file, framerate, multiplier=DEFAULT_MULTIPLIER, engine="blend",
+                       queue_depth=DEFAULT_QUEUE_DEPTH, verbose=False):
+    """Decode, interpolate and encode a video in one pass
+    At most queue_depth decoded frames and queue_depth * multiplier output frames are held in memory
+    """
+    if engine not in STREAM_ENGINES:
+        raise ValueError("Invalid stream engine: {} (available: {})".format(engine, ", ".join(STREAM_ENGINES)))
+    engine_function = STREAM_ENGINES[engine]
+    stream_metadata = ffprobe.analyze_video_stream_metadata(input_file)
+    width, height = int(stream_metadata["width"]), int(stream_metadata["height"])
+    frame_count = int(stream_metadata["packetCount"])
+
+    input_queue = queue.Queue(maxsize=queue_depth)
+    output_queue = queue.Queue(maxsize=queue_depth * multiplier)
+    stop_event = threading.Event()
+    errors = []
+
+    def reader():
+        try:
+            for frame in ffmpeg.decode_frames_raw(input_file, width, height, verbose=verbose):
+                if not _queue_put(input_queue, frame, stop_event):
+                    break
+        except Exception as error:
+            errors.append(error)
+            stop_event.set()
+        finally:
+            _queue_put(input_queue, _END_OF_STREAM, stop_event)  # Not queued after an error, the get gives up then
+
+    def writer():
+        process = ffmpeg.encode_frames_raw(output_file, width, height, framerate, verbose=verbose)
+        try:
+            while True:
+                frame = output_queue.get()
+                if frame is _END_OF_STREAM:
+                    break
+                process.stdin.write(frame)
+        except Exception as error:
+            errors.append(error)
+            stop_event.set()
+        finally:
+            process.stdin.close()
+            if process.wait() != 0:
+                errors.append(RuntimeError("FFmpeg encoding failed with exit code {}".format(process.returncode)))
+
+    reader_thread = threading.Thread(target=reader, daemon=True)
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    reader_thread.start()
+    writer_thread.start()
+
+    try:
+        with alive_bar(frame_count * multiplier, enrich_print=False) as bar:
+            frame0 = _queue_get(input_queue, stop_event)
+            while (frame0 is not _END_OF_STREAM) and not stop_event.is_set():
+                frame1 = _queue_get(input_queue, stop_event)
+                if frame1 is _END_OF_STREAM:  # Duplicate the last frame to keep the output length at N * multiplier
+                    outputs = [frame0] * multiplier
+                else:
+                    outputs = [frame0] + engine_function(frame0, frame1, width, height, multiplier)
+                for frame in outputs:
+                    if not _queue_put(output_queue, frame, stop_event):
+                        break
+                    bar()
+                frame0 = frame1
+    except BaseException:
+        stop_event.set()
+        raise
+    finally:
+        # Unblock the writer then wait for the encoder to finish writing the file
+        while writer_thread.is_alive():
+            try:
+                output_queue.put(_END_OF_STREAM, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        writer_thread.join()
+        stop_event.set()
+        reader_thread.join()
+
+    if errors:
+        raise errors[0]
@@ -3,18 +3,25 @@ Module for handling video frame extraction (aka: "step 1")
 """
 # Built-in modules
 import pathlib
+# Local modules
+import frame_writer
 # External modules
 from PIL import Image
 
 
-def png_remove_alpha_channel(file_path):
+def png_remove_alpha_channel(file_path, writer=None):
+    """Puts a png on a white background, written on the writer's threads if one is given"""
     png = Image.open(file_path).convert("RGBA")
     background = Image.new("RGBA", png.size, (255, 255, 255))  # White background created
     alpha_composite = Image.alpha_composite(background, png)  # Transparent png put on background
-    alpha_composite.convert("RGB").save(file_path)
+    if writer is None:
+        alpha_composite.convert("RGB").save(file_path)
+    else:
+        writer.write_image(file_path, alpha_composite.convert("RGB"))
 
 
-def png_directory_remove_alpha_channel(directory_path):
+def png_directory_remove_alpha_channel(directory_path, png_compression=frame_writer.DEFAULT_PNG_COMPRESSION):
     """Converts all .png files in a folder to be alpha-less"""
-    for i in pathlib.Path(directory_path).glob('**/*.png'):
-        png_remove_alpha_channel(i.absolute())
+    with frame_writer.FrameWriter(png_compression=png_compression) as writer:
+        for i in pathlib.Path(directory_path).glob('**/*.png'):
+            png_remove_alpha_channel(i.absolute(), writer)